@@ -9,6 +9,7 @@ https://docs.djangoproject.com/en/4.1/topics/settings/
 For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.1/ref/settings/
 """
+
 import os
 import os
 from urllib.parse import urlparse
@@ -139,3 +140,23 @@ CRISPY_TEMPLATE_PACK = "bootstrap4"
 
 # whitenoise
 STATICFILES_STORAGE = "whitenoise.storage.CompressedManifestStaticFilesStorage"
+
+# map generation jobs, run on a local thread pool
+MAPS_ASYNC_JOBS = True
+MAP_JOB_WORKERS = 2
+
+# carte dessinée dans le navigateur (h3-js) plutôt que générée par folium
+MAPS_CLIENT_RENDERING = False
+
+# chaleur des cartes folium en tuiles raster (maps:heat_tile) plutôt qu'en hexagones
+MAPS_HEAT_TILES = False
+
+# couches de points en marqueurs regroupés, popups chargées au clic (maps:point_attributes)
+MAPS_CLUSTER_POINTS = False
+
+# cartes assemblées à partir de fragments en cache, sans folium (tuiles et marqueurs regroupés ignorés)
+MAPS_ASSEMBLED_MAPS = False
+
+# processus de calcul de la chaleur des couches, par worker, lancés seulement quand des
+# couches ne sont pas encore publiées (1 : calcul dans le worker)
+MAPS_LAYER_WORKERS = 2
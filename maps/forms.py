@@ -41,6 +41,25 @@ class TransportationModesForm(forms.Form):
         label="🛥️ J’utilise la navette fluviale (emplacement des stations)",
         required=False,
     )
+    communes = forms.CharField(
+        label="🏙️ Communes (noms ou codes INSEE séparés par des virgules, toute la Métropole si vide)",
+        required=False,
+    )
+
+    def clean_communes(self):
+        """Codes INSEE triés des communes saisies"""
+        values = [
+            value for value in self.cleaned_data["communes"].split(",") if value.strip()
+        ]
+        if not values:
+            return []
+        # import ici : numpy et h3 ne sont chargés que si des communes sont saisies
+        from .scores import commune_codes
+
+        try:
+            return commune_codes(values)
+        except ValueError as error:
+            raise forms.ValidationError(str(error))
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
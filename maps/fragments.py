@@ -0,0 +1,207 @@
+# Assemblage rapide des cartes sans folium : le JS de chaque couche (GeoJSON déjà sérialisé)
+# est mis en cache une fois par version des données, une carte n'est plus qu'une concaténation
+# des fragments de sa sélection et du vecteur de chaleur dans le gabarit de page.
+import contextlib
+import json
+import os
+import shutil
+import string
+import threading
+
+from .map_cache import DATA_FOLDER
+
+# pas de verrou de fichier hors POSIX, seul le verrou entre threads s'applique
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+FRAGMENTS_FOLDER = DATA_FOLDER + "fragments/"
+# à incrémenter quand le format des fragments ou du gabarit change, pour invalider le cache
+FRAGMENTS_CODE_VERSION = 1
+# versions des données dont les fragments sont gardés : les processus pas encore basculés
+# sur les nouvelles données lisent encore l'ancienne
+FRAGMENTS_VERSIONS_KEPT = 2
+
+_lock = threading.Lock()
+
+# gabarit de page : mêmes bibliothèques que les cartes folium, fonctions de dessin des couches
+PAGE_TEMPLATE = string.Template("""<!DOCTYPE html>
+<html>
+<head>
+    <meta http-equiv="content-type" content="text/html; charset=UTF-8" />
+    <meta name="viewport" content="width=device-width, initial-scale=1.0, maximum-scale=1.0, user-scalable=no" />
+    <link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/leaflet@1.9.3/dist/leaflet.css"/>
+    <link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/@fortawesome/fontawesome-free@6.2.0/css/all.min.css"/>
+    <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/Leaflet.awesome-markers/2.0.2/leaflet.awesome-markers.css"/>
+    <script src="https://cdn.jsdelivr.net/npm/leaflet@1.9.3/dist/leaflet.js"></script>
+    <script src="https://cdnjs.cloudflare.com/ajax/libs/Leaflet.awesome-markers/2.0.2/leaflet.awesome-markers.js"></script>
+    <style>
+        html, body, #map { width: 100%; height: 100%; margin: 0; padding: 0; }
+        .legend { background: white; padding: 6px 8px; font: 12px sans-serif; }
+        .legend .scale { width: 200px; height: 10px; margin: 4px 0; }
+    </style>
+</head>
+<body>
+<div id="map"></div>
+<script>
+    var PLASMA = ["#0d0887", "#4c02a1", "#7e03a8", "#a92395", "#cc4778", "#e56b5d", "#f89540", "#fdc527", "#f0f921"];
+    var map = L.map("map", {center: [45.75, 4.85], zoom: 11, preferCanvas: true});
+    L.tileLayer("https://{s}.basemaps.cartocdn.com/light_all/{z}/{x}/{y}{r}.png", {
+        attribution: "&copy; OpenStreetMap &copy; CARTO", maxZoom: 20
+    }).addTo(map);
+    L.control.scale().addTo(map);
+
+    function table(properties) {
+        var html = "<table>";
+        Object.keys(properties).forEach(function (name) {
+            html += "<tr><th>" + name + "</th><td>" + properties[name] + "</td></tr>";
+        });
+        return html + "</table>";
+    }
+
+    function icon(name, color) {
+        return L.AwesomeMarkers.icon({icon: name, prefix: "fa", markerColor: color});
+    }
+
+    // couche GeoJSON d'un jeu de données : cercles pour les points, infobulle de ses attributs
+    function addLayer(data, color, marker) {
+        L.geoJSON(data, {
+            style: {color: color, weight: 2, fillOpacity: 0.5},
+            pointToLayer: function (feature, latlng) {
+                if (marker) return L.marker(latlng, {icon: icon(marker[0], marker[1])});
+                return L.circleMarker(latlng, {radius: 3, color: color, fillOpacity: 0.5});
+            },
+            onEachFeature: function (feature, layer) {
+                layer.bindTooltip(table(feature.properties));
+            }
+        }).addTo(map);
+    }
+
+    // marqueurs [lat, lon, popup] avec une icône font awesome
+    function addMarkers(markers, name, color) {
+        markers.forEach(function (marker) {
+            L.marker([marker[0], marker[1]], {icon: icon(name, color)}).bindPopup(marker[2]).addTo(map);
+        });
+    }
+
+    // hexagones colorés par leur chaleur (heat, dans l'ordre des hexagones), échelle plasma
+    function addHeat(hexagons, heat) {
+        var max = Math.max.apply(null, heat.concat([0]));
+        L.geoJSON(hexagons, {
+            style: function (feature) {
+                var t = max ? heat[feature.id] / max : 0;
+                return {
+                    fillColor: PLASMA[Math.round(t * (PLASMA.length - 1))],
+                    fillOpacity: 0.5, color: "#3388ff", opacity: 0.05, weight: 1
+                };
+            },
+            onEachFeature: function (feature, layer) {
+                layer.bindTooltip(function () {
+                    return table({nom: feature.properties.nom, heat: heat[feature.id]});
+                });
+            }
+        }).addTo(map);
+        var legend = L.control({position: "topright"});
+        legend.onAdd = function () {
+            var div = L.DomUtil.create("div", "legend");
+            div.innerHTML = "heat<div class='scale' style='background: linear-gradient(to right, "
+                + PLASMA.join(", ") + ")'></div>0 – " + max;
+            return div;
+        };
+        legend.addTo(map);
+    }
+</script>
+<script>
+$fragments
+</script>
+</body>
+</html>
+""")
+
+
+def fragments_folder(version):
+    return f"{FRAGMENTS_FOLDER}v{FRAGMENTS_CODE_VERSION}-{version}/"
+
+
+@contextlib.contextmanager
+def fragments_lock():
+    """Verrou des écritures dans le cache de fragments, entre threads et entre processus"""
+    with _lock:
+        os.makedirs(FRAGMENTS_FOLDER, exist_ok=True)
+        if fcntl is None:
+            yield
+            return
+        with open(f"{FRAGMENTS_FOLDER}.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def prune():
+    """Supprime les dossiers des anciennes versions, sauf les FRAGMENTS_VERSIONS_KEPT plus récents
+
+    À appeler sous fragments_lock : aucun fragment n'est alors en cours d'écriture.
+    """
+    entries = sorted(
+        (entry for entry in os.scandir(FRAGMENTS_FOLDER) if entry.is_dir()),
+        key=lambda entry: entry.stat().st_mtime,
+    )
+    for entry in entries[:-FRAGMENTS_VERSIONS_KEPT]:
+        shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def cached_fragment(name, version, build):
+    """Fragment JS name de cette version des données, construit par build() s'il manque"""
+    folder = fragments_folder(version)
+    path = f"{folder}{name}.js"
+    try:
+        with open(path) as file:
+            return file.read()
+    except FileNotFoundError:
+        pass
+
+    fragment = build()
+    with fragments_lock():
+        # le dossier a pu être supprimé entre-temps : un processus pas encore basculé sur
+        # les nouvelles données le recrée
+        new_version = not os.path.isdir(folder)
+        os.makedirs(folder, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as file:
+            file.write(fragment)
+        os.replace(tmp_path, path)
+        if new_version:
+            prune()
+    return fragment
+
+
+def layer_fragment(geojson, color, marker=None):
+    """Fragment d'une couche GeoJSON (chaîne déjà sérialisée) ; marker : (icône, couleur)"""
+    return f"addLayer({geojson}, {json.dumps(color)}, {json.dumps(marker)});\n"
+
+
+def markers_fragment(markers, icon, color):
+    """Fragment de marqueurs [lat, lon, popup] avec une icône font awesome"""
+    return f"addMarkers({json.dumps(markers, ensure_ascii=False)}, {json.dumps(icon)}, {json.dumps(color)});\n"
+
+
+def hexagons_fragment(geojson):
+    """Fragment des hexagones de la grille (GeoJSON dont les id sont les rangs des hexagones)"""
+    return f"var hexagons = {geojson};\n"
+
+
+def assemble(hexagons, heat, fragments, bounds=None):
+    """Page HTML d'une carte : hexagones, chaleur (liste alignée sur les hexagones) et couches
+
+    bounds ([[sud, ouest], [nord, est]]), si fourni, est la zone affichée à l'ouverture.
+    """
+    # la chaleur d'abord : les couches des jeux de données sont dessinées par-dessus
+    heat_script = f"addHeat(hexagons, {json.dumps(heat)});\n"
+    if bounds is not None:
+        heat_script += f"map.fitBounds({json.dumps(bounds)});\n"
+    return PAGE_TEMPLATE.substitute(
+        fragments="".join([hexagons, heat_script, *fragments])
+    )
@@ -4,8 +4,32 @@ import numpy as np
 import geopandas as gpd
 import folium
 import os
-import h3pandas
+import functools
+import multiprocessing
+import shutil
+import threading
+import time
+import hashlib
+import json
+import h3
+import h3pandas  # noqa: F401 (accesseur .h3 des GeoDataFrame)
+import shapely
 import warnings
+from . import fragments, map_cache, scores, snapshots, store
+from .layers import (
+    COARSE_RESOLUTIONS,
+    LAYER_SPECS,
+    LAYERS,
+    RESOLUTION,
+    layer_weights,
+    selected_layers,
+)
+from branca.colormap import LinearColormap
+from folium.plugins import FastMarkerCluster
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from matplotlib import colormaps
+from matplotlib.colors import to_hex
+from scipy import sparse
 
 warnings.simplefilter(action="ignore", category=pd.errors.PerformanceWarning)
 
@@ -47,589 +71,1317 @@ MARKER_COLORS = [
     "lightgray",
 ]
 
-RESOLUTION = 9
+DOWNLOAD_TIMEOUT = 60  # secondes
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_WORKERS = 8
+# durée (en secondes) pendant laquelle un fichier téléchargé est utilisé sans être revalidé
+DOWNLOAD_MAX_AGE = 24 * 3600
+_session = None
+
+INGESTED_FOLDER = DATA_FOLDER + "parquet/"
+
+# vecteurs de chaleur en cache, un fichier {clé}.npy par clé : la clé est une empreinte du contenu
+HEAT_CACHE_FOLDER = DATA_FOLDER + "heat_cache/"
+# taille maximale du cache de chaleur, les vecteurs les moins récemment utilisés sont supprimés au-delà
+HEAT_CACHE_MAX_BYTES = 100 * 1024 * 1024
+# à incrémenter quand un moteur de calcul de chaleur change, pour invalider le cache
+HEAT_CODE_VERSION = 1
+
+# moteur de calcul de chaque couche
+LAYER_ENGINES = {layer: spec["engine"] for layer, spec in LAYER_SPECS.items()}
+LAYER_PARAMS = {layer: spec.get("params", {}) for layer, spec in LAYER_SPECS.items()}
+# processus qui chargent les couches et calculent leur chaleur en parallèle, hors Django
+# (réglage MAPS_LAYER_WORKERS sinon)
+LAYER_WORKERS = os.cpu_count() or 1
+_layer_executor = None
+# moteurs dont la chaleur est une somme des contributions de chaque élément : un rafraîchissement
+# n'y recalcule que les éléments ajoutés, supprimés ou modifiés (les gares diffusent, non linéaire)
+DELTA_ENGINES = {"points", "lines"}
+
+# sources des jeux de données : url de téléchargement, nom du fichier dans DATA_FOLDER,
+# colonnes conservées à l'ingestion (toutes si absent) et types de ces colonnes
+DATASETS = {
+    "communes": {
+        "url": "https://download.data.grandlyon.com/wfs/grandlyon?SERVICE=WFS&VERSION=2.0.0&request=GetFeature&typename=adr_voie_lieu.adrcomgl&outputFormat=application/json; subtype=geojson&SRSNAME=EPSG:4171",
+        "filename": "communes.geojson",
+        "columns": ["nom", "nomreduit", "insee", "trigramme", "geometry"],
+    },
+    "stationnement_velo": {
+        "url": "https://download.data.grandlyon.com/wfs/grandlyon?SERVICE=WFS&VERSION=2.0.0&request=GetFeature&typename=pvo_patrimoine_voirie.pvostationnementvelo&outputFormat=application/json; subtype=geojson&SRSNAME=EPSG:4171",
+        "filename": "stationnement_velo.geojson",
+        "columns": [
+            "avancement",
+            "nom",
+            "adresse",
+            "commune",
+            "capacite",
+            "gid",
+            "geometry",
+        ],
+        "dtypes": {"avancement": "category", "commune": "category"},
+    },
+    "velov": {
+        "url": "https://download.data.grandlyon.com/wfs/rdata?SERVICE=WFS&VERSION=2.0.0&request=GetFeature&typename=jcd_jcdecaux.jcdvelov&outputFormat=application/json; subtype=geojson&SRSNAME=EPSG:4171",
+        "filename": "velov.geojson",
+        "columns": [
+            "status",
+            "name",
+            "address",
+            "commune",
+            "bike_stands",
+            "gid",
+            "geometry",
+        ],
+        "dtypes": {"status": "category", "commune": "category"},
+    },
+    "amenagements_cyclables": {
+        "url": "https://download.data.grandlyon.com/wfs/grandlyon?SERVICE=WFS&VERSION=2.0.0&request=GetFeature&typename=pvo_patrimoine_voirie.pvoamenagementcyclable&outputFormat=application/json; subtype=geojson&SRSNAME=EPSG:4171",
+        "filename": "amenagements_cyclables.geojson",
+        "columns": ["gid", "geometry"],
+    },
+    "gares": {
+        "url": "https://download.data.grandlyon.com/wfs/grandlyon?SERVICE=WFS&VERSION=2.0.0&request=GetFeature&typename=adr_voie_lieu.adrgarefer&outputFormat=application/json; subtype=geojson&SRSNAME=EPSG:4171",
+        "filename": "gares.geojson",
+        "columns": ["nom", "idexterne", "gid", "geometry"],
+    },
+    "trafic_voyageurs_gares": {
+        "url": "https://data.sncf.com/api/explore/v2.1/catalog/datasets/frequentation-gares/exports/csv?lang=fr&timezone=Europe%2FBerlin&use_labels=true&delimiter=%3B",
+        "filename": "trafic_voyageurs_gares.csv",
+        "columns": ["Code UIC", "Total Voyageurs 2021"],
+    },
+    "parkings": {
+        "url": "https://download.data.grandlyon.com/wfs/grandlyon?SERVICE=WFS&VERSION=2.0.0&request=GetFeature&typename=pvo_patrimoine_voirie.pvoparking&outputFormat=application/json; subtype=geojson&SRSNAME=EPSG:4171",
+        "filename": "parkings.geojson",
+        "columns": ["nom", "commune", "reglementation", "gid", "geometry"],
+        "dtypes": {"commune": "category"},
+    },
+    "autopartage": {
+        "url": "https://download.data.grandlyon.com/wfs/grandlyon?SERVICE=WFS&VERSION=2.0.0&request=GetFeature&typename=pvo_patrimoine_voirie.pvostationautopartage&outputFormat=application/json; subtype=geojson&SRSNAME=EPSG:4171",
+        "filename": "autopartage.geojson",
+        "columns": ["nom", "adresse", "commune", "typeautopartage", "gid", "geometry"],
+        "dtypes": {"commune": "category", "typeautopartage": "category"},
+    },
+    "parcs_relais": {
+        "url": "https://download.data.grandlyon.com/wfs/rdata?SERVICE=WFS&VERSION=2.0.0&request=GetFeature&typename=tcl_sytral.tclparcrelaisst&outputFormat=application/json; subtype=geojson&SRSNAME=EPSG:4171",
+        "filename": "parcs_relais.geojson",
+        "columns": ["nom", "capacite", "gid", "geometry"],
+    },
+    "cars": {
+        "url": "https://download.data.grandlyon.com/wfs/rdata?SERVICE=WFS&VERSION=2.0.0&request=GetFeature&typename=cdr_cardurhone.cdrarret&outputFormat=application/json; subtype=geojson&SRSNAME=EPSG:4171",
+        "filename": "cars.geojson",
+    },
+    "points_arret": {
+        "url": "https://download.data.grandlyon.com/wfs/rdata?SERVICE=WFS&VERSION=2.0.0&request=GetFeature&typename=tcl_sytral.tclarret&outputFormat=application/json; subtype=geojson&SRSNAME=EPSG:4171",
+        "filename": "points_arret.geojson",
+        "columns": ["nom", "desserte", "gid", "geometry"],
+    },
+    "stations_taxi": {
+        "url": "https://download.data.grandlyon.com/wfs/grandlyon?SERVICE=WFS&VERSION=2.0.0&request=GetFeature&typename=pvo_patrimoine_voirie.pvostationtaxi&outputFormat=application/json; subtype=geojson&SRSNAME=EPSG:4171",
+        "filename": "stations_taxi.geojson",
+        "columns": ["nom", "gid", "geometry"],
+    },
+    "navette_fluviale": {
+        "url": "https://download.data.grandlyon.com/wfs/rdata?SERVICE=WFS&VERSION=2.0.0&request=GetFeature&typename=tca_transports_alternatifs.tcaarretvaporetto&outputFormat=application/json; subtype=geojson&SRSNAME=EPSG:4171",
+        "filename": "navette_fluviale.geojson",
+        "columns": ["nom", "gid", "geometry"],
+    },
+    "pmr": {
+        "url": "https://download.data.grandlyon.com/ws/grandlyon/com_donnees_communales.comstationnementpmr_1_0_0/all.csv?maxfeatures=-1",
+        "filename": "pmr.csv",
+        "columns": ["nom", "commune", "gid", "geometry"],
+        "dtypes": {"commune": "category"},
+        # csv avec des coordonnées à virgule décimale, converti en points
+        "decimal": ",",
+        "coordinates": ["lon", "lat"],
+    },
+}
 
 
-def download_file(url, filename):
-    os.makedirs(DATA_FOLDER, exist_ok=True)
-    if filename in os.listdir(DATA_FOLDER):
-        print(f"Fichier {filename} déjà téléchargé")
-        return True
-    response = requests.get(url)
-    if response.status_code == 200:
-        with open(f"{DATA_FOLDER}{filename}", "wb") as file:
-            file.write(response.content)
-        print(f"Fichier {filename} enregistré")
-        return True
-    else:
-        print(f"La requête n’a pas abouti : status {response.status_code}.")
-        return False
+def get_session():
+    """Session HTTP partagée : les connexions aux serveurs de données sont réutilisées"""
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=DOWNLOAD_WORKERS, pool_maxsize=DOWNLOAD_WORKERS
+        )
+        _session.mount("https://", adapter)
+        _session.mount("http://", adapter)
+    return _session
+
+
+def download_file(url, filename, max_age=DOWNLOAD_MAX_AGE):
+    """Télécharge url dans DATA_FOLDER/filename, renvoie True si le fichier est disponible
+
+    Un fichier déjà téléchargé est revalidé (ETag / Last-Modified) au plus une fois
+    toutes les max_age secondes. Si le serveur ne répond pas, l'ancien fichier est gardé.
+    """
+    downloads_folder = f"{DATA_FOLDER}downloads/"
+    os.makedirs(downloads_folder, exist_ok=True)
+    path = f"{DATA_FOLDER}{filename}"
+    # les validateurs HTTP sont rangés à part : ils ne changent pas la version des données
+    meta_path = f"{downloads_folder}{filename}.json"
+
+    meta = {}
+    if os.path.exists(path):
+        try:
+            with open(meta_path) as file:
+                meta = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            # fichier téléchargé sans validateurs : considéré vérifié à sa date d'écriture
+            meta = {"checked": os.path.getmtime(path)}
+        if time.time() - meta["checked"] < max_age:
+            print(f"Fichier {filename} déjà téléchargé")
+            return True
+
+    headers = {}
+    if meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    if meta.get("last_modified"):
+        headers["If-Modified-Since"] = meta["last_modified"]
+
+    try:
+        with get_session().get(
+            url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT
+        ) as response:
+            if response.status_code == 304:
+                print(f"Fichier {filename} à jour")
+            elif response.status_code == 200:
+                # écriture par morceaux dans un fichier temporaire puis renommage atomique
+                tmp_path = f"{downloads_folder}{filename}.{os.getpid()}.{threading.get_ident()}.part"
+                with open(tmp_path, "wb") as file:
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        file.write(chunk)
+                os.replace(tmp_path, path)
+                meta = {
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                }
+                print(f"Fichier {filename} enregistré")
+            else:
+                print(f"La requête n’a pas abouti : status {response.status_code}.")
+                return os.path.exists(path)
+    except requests.RequestException as error:
+        print(f"La requête n’a pas abouti : {error}.")
+        return os.path.exists(path)
+
+    meta["checked"] = time.time()
+    tmp_path = f"{meta_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(meta, file)
+    os.replace(tmp_path, meta_path)
+    return True
+
+
+def download_files(names):
+    """Télécharge en parallèle les jeux de données names (clés de DATASETS)
+
+    Renvoie {nom: True si le fichier est disponible}. Les jeux de données de l'instantané
+    servi ne sont pas retéléchargés : il n'est pas modifié.
+    """
+    if snapshots.current_name():
+        names = [name for name in names if snapshot_dataset_path(name) is None]
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        results = executor.map(
+            lambda name: download_file(
+                DATASETS[name]["url"], DATASETS[name]["filename"]
+            ),
+            names,
+        )
+        return dict(zip(names, results))
 
 
-def get_data(url, filename):
-    if download_file(url, filename):
-        if filename.endswith("csv"):
-            return pd.read_csv(f"{DATA_FOLDER}{filename}", sep=";")
-        elif filename.endswith("geojson"):
-            return gpd.read_file(f"{DATA_FOLDER}{filename}")
-    else:
-        print("Rien à ouvrir")
+def dataset_digest(df):
+    """Empreinte du contenu d'un jeu de données tel qu'il est passé au calcul de chaleur"""
+    digest = hashlib.sha256()
+    # géométries absentes : aucun octet
+    digest.update(b"".join(wkb or b"" for wkb in shapely.to_wkb(df.geometry.values)))
+    # le trafic des gares pondère la chaleur, il fait donc partie du contenu
+    if "voyageurs" in df.columns:
+        digest.update(df["voyageurs"].to_numpy(dtype=float).tobytes())
+    return digest.hexdigest()
+
+
+def heat_cache_key(hex_map, df, engine, coeff, **params):
+    """Clé du cache de chaleur : contenu du jeu de données, grille, moteur, coeff, résolution et version du code"""
+    digest = hashlib.sha256()
+    digest.update(dataset_digest(df).encode())
+    # le vecteur en cache est aligné sur l'ordre de la grille
+    digest.update("\n".join(hex_map.index).encode())
+    parameters = {
+        "engine": engine,
+        "coeff": coeff,
+        "resolution": h3.get_resolution(hex_map.index[0]),
+        "version": HEAT_CODE_VERSION,
+        **params,
+    }
+    digest.update(json.dumps(parameters, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def load_cached_heat(key):
+    """Vecteur de chaleur en cache pour cette clé, ou None"""
+    path = f"{HEAT_CACHE_FOLDER}{key}.npy"
+    try:
+        heat = np.load(path)
+        # on date l'accès pour l'éviction LRU
+        os.utime(path)
+    except FileNotFoundError:
         return None
+    return heat
 
 
-def compute_heat_from_points(hex_map, df, name, coeff=1):
-    colname = name
+def save_cached_heat(key, heat):
+    os.makedirs(HEAT_CACHE_FOLDER, exist_ok=True)
+    # écriture dans un fichier temporaire puis renommage atomique : pas de fichier à moitié écrit
+    tmp_path = f"{HEAT_CACHE_FOLDER}{key}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as file:
+        np.save(file, heat)
+    os.replace(tmp_path, f"{HEAT_CACHE_FOLDER}{key}.npy")
+    # un vecteur par version de chaque jeu de données : le cache est borné
+    map_cache.evict(HEAT_CACHE_MAX_BYTES, HEAT_CACHE_FOLDER, ".npy")
 
-    # TODO check if data already there
-    heat_csv_name = f"{name}_heat.csv"
-    heat_csv_path = f"data/{heat_csv_name}"
-    if heat_csv_name in os.listdir("data/"):
-        # load the data and return the hex map
-        print("loading heat column from cache")
-        heat = pd.read_csv(heat_csv_path)
-        hex_map = pd.merge(left=hex_map.reset_index(), right=heat)
 
-        hex_map.heat += hex_map.loaded_heat
+def ingested_path(name):
+    """Chemin du fichier (Geo)Parquet du jeu de données name, qui dépend des colonnes déclarées"""
+    source = DATASETS[name]
+    spec = json.dumps(
+        [source.get("columns"), source.get("dtypes"), source.get("coordinates")]
+    )
+    digest = hashlib.sha256(spec.encode()).hexdigest()[:8]
+    return f"{INGESTED_FOLDER}{name}-{digest}.parquet"
+
+
+def ingest(name):
+    """Convertit une fois le fichier téléchargé du jeu de données name en (Geo)Parquet
+
+    Seules les colonnes déclarées dans DATASETS sont conservées, avec leurs types.
+    Le fichier n'est reconverti que si le fichier téléchargé est plus récent.
+    """
+    source = DATASETS[name]
+    raw_path = f"{DATA_FOLDER}{source['filename']}"
+    path = ingested_path(name)
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(raw_path):
+        return path
+
+    if raw_path.endswith("csv"):
+        df = pd.read_csv(raw_path, sep=";", decimal=source.get("decimal", "."))
+        if "coordinates" in source:
+            x, y = source["coordinates"]
+            df = gpd.GeoDataFrame(
+                df, geometry=gpd.points_from_xy(df[x], df[y]), crs="EPSG:4326"
+            )
+    else:
+        df = gpd.read_file(raw_path)
+
+    if "columns" in source:
+        df = df[[column for column in source["columns"] if column in df.columns]]
+    df = df.astype(
+        {
+            column: dtype
+            for column, dtype in source.get("dtypes", {}).items()
+            if column in df.columns
+        }
+    )
 
-        return hex_map.set_index("h3_polyfill").drop(columns="loaded_heat")
+    os.makedirs(INGESTED_FOLDER, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    df.to_parquet(tmp_path)
+    os.replace(tmp_path, path)
+    print(f"Fichier {source['filename']} converti en parquet")
+    return path
 
-    # on itere sur chaque ligne de la dataframe df, et donc sur chaque point positionné
-    for index, (gid, line) in df[["gid", "geometry"]].iterrows():
-        # on stocke le résultat du test "l'hexagone contient ce point" dans une colonne de la table hex_map créée à ce effet
-        hex_map[f"{colname}_{gid}"] = hex_map.geometry.contains(line)
 
-    # On constitue la liste des colonnes ainsi créée
-    column_names = [name for name in hex_map.columns if name.startswith(f"{colname}_")]
+def ingest_dataset(name):
+    """Télécharge si besoin puis ingère le jeu de données name, renvoie le chemin du Parquet ou None"""
+    source = DATASETS[name]
+    if not download_file(source["url"], source["filename"]):
+        print("Rien à ouvrir")
+        return None
+    return ingest(name)
 
-    # On incrémente la colonne 'heat' dans hex_map avec la somme des lignes : un dénombrement des stations de vélov présentes dans le hex multiplié par le coeff
-    new_heat = hex_map[column_names].sum(axis=1) * coeff
-    hex_map["heat"] += new_heat
 
-    hex_map = hex_map[["nom", "geometry", "heat"]]
-    print(f"hex_map mise à jour avec les {index} points de la dataframe")
-    # on sauvegarde la colonne heat dans un csv pour usage futur
-    if heat_csv_name not in os.listdir("data/"):
-        print("heat column saved for later use")
-        new_heat = pd.DataFrame(new_heat, columns=["loaded_heat"])
-        new_heat.to_csv(heat_csv_path)
-    return hex_map
+def snapshot_dataset_path(name):
+    """Parquet du jeu de données name dans l'instantané servi, ou None"""
+    if not snapshots.current_name():
+        return None
+    path = f"{snapshots.root()}parquet/{os.path.basename(ingested_path(name))}"
+    return path if os.path.exists(path) else None
 
 
-def compute_heat_from_lines(hex_map, df, name, coeff=1):
-    colname = name
+def load_dataset(name, columns=None):
+    """Télécharge si besoin, ingère puis lit le jeu de données name (clé de DATASETS)
 
-    # TODO check if data already there
-    heat_csv_name = f"{name}_heat.csv"
-    heat_csv_path = f"data/{heat_csv_name}"
-    if heat_csv_name in os.listdir("data/"):
-        # load the data and return the hex map
-        print("loading heat column from cache")
-        heat = pd.read_csv(heat_csv_path)
-        hex_map = pd.merge(left=hex_map.reset_index(), right=heat)
+    Le jeu de données de l'instantané servi est lu tel quel. columns restreint la lecture à
+    ces colonnes ; le fichier est lu en mémoire mappée.
+    """
+    path = snapshot_dataset_path(name) or ingest_dataset(name)
+    if path is None:
+        return None
+    source = DATASETS[name]
+    if source["filename"].endswith("geojson") or "coordinates" in source:
+        return gpd.read_parquet(path, columns=columns, memory_map=True)
+    return pd.read_parquet(path, columns=columns, memory_map=True)
+
+
+def points_to_cells(geometry, resolution=RESOLUTION):
+    """Convertit une GeoSeries de points en identifiants de cellules H3, en un seul appel vectorisé"""
+    # les géométries non ponctuelles (multipoints...) sont ramenées à un point représentatif
+    points = geometry[geometry.notna() & ~geometry.is_empty].representative_point()
+    lng, lat = points.x.to_numpy(), points.y.to_numpy()
+    # on écarte les coordonnées manquantes (lat/lon vides dans les csv)
+    valid = np.isfinite(lat) & np.isfinite(lng)
+    latlng_to_cell = np.frompyfunc(h3.latlng_to_cell, 3, 1)
+    return latlng_to_cell(lat[valid], lng[valid], resolution).astype(str)
+
+
+def points_heat(hex_map, df):
+    """Nombre de points de df dans chaque hexagone de hex_map, dans l'ordre de hex_map"""
+    resolution = h3.get_resolution(hex_map.index[0])
+    positions = hex_map.index.get_indexer(points_to_cells(df.geometry, resolution))
+    # les points hors de la grille (position -1) sont ignorés
+    return np.bincount(positions[positions >= 0], minlength=len(hex_map)).astype(float)
+
+
+def lines_heat(hex_map, df):
+    """Nombre de lignes de df qui traversent chaque hexagone de hex_map, dans l'ordre de hex_map"""
+    # l'index spatial (STRtree) filtre les hexagones candidats par boîte englobante avant le test exact "crosses"
+    tree = shapely.STRtree(hex_map.geometry.values)
+    lines = df.geometry[df.geometry.notna()].values
+    _, positions = tree.query(lines, predicate="crosses")
+    return np.bincount(positions, minlength=len(hex_map)).astype(float)
+
+
+def stations_heat(hex_map, df):
+    """Somme du trafic (ou nombre) des gares de df qui sont contenues dans chaque hexagone ou le chevauchent"""
+    tree = shapely.STRtree(hex_map.geometry.values)
+    if "voyageurs" in df.columns:
+        # les gares sans données de trafic ne comptent pas
+        weights = np.nan_to_num(df["voyageurs"].to_numpy(dtype=float))
+    else:
+        weights = np.ones(len(df))
+    heat = np.zeros(len(hex_map))
+    # "l'hexagone contient la gare" équivaut à "la gare est dans l'hexagone"
+    for predicate in ["within", "overlaps"]:
+        stations, positions = tree.query(df.geometry.values, predicate=predicate)
+        heat += np.bincount(
+            positions, weights=weights[stations], minlength=len(hex_map)
+        )
+    return heat
+
+
+@functools.lru_cache(maxsize=8)
+def ring_matrices(cells, k):
+    """Matrices creuses d'adjacence de la grille, une par distance d'anneau de 1 à k
+
+    cells est le tuple des identifiants H3 de la grille, dans l'ordre de hex_map.
+    """
+    index = pd.Index(cells)
+    matrices = []
+    for distance in range(1, k + 1):
+        rings = [h3.grid_ring(cell, distance) for cell in cells]
+        rows = np.repeat(np.arange(len(cells)), [len(ring) for ring in rings])
+        columns = index.get_indexer([cell for ring in rings for cell in ring])
+        # les voisins hors de la grille (bordure de la métropole) sont ignorés
+        inside = columns >= 0
+        matrices.append(
+            sparse.csr_matrix(
+                (np.ones(inside.sum()), (rows[inside], columns[inside])),
+                shape=(len(cells), len(cells)),
+            )
+        )
+    return matrices
+
+
+def diffuse_heat(hex_map, source, ring_weights=(1, 0.5)):
+    """Diffuse la chaleur source sur les anneaux voisins de chaque hexagone
+
+    ring_weights[d] est le poids appliqué à distance d : le premier pour l'hexagone lui-même,
+    les suivants pour les anneaux 1, 2... Les hexagones qui ont déjà une source ne reçoivent
+    pas la chaleur de leurs voisins.
+    """
+    k = len(ring_weights) - 1
+    heat = ring_weights[0] * source
+    if k == 0:
+        return heat
+    # noyau : somme pondérée des matrices d'anneaux, appliquée en un seul produit
+    kernel = sum(
+        weight * matrix
+        for weight, matrix in zip(
+            ring_weights[1:], ring_matrices(tuple(hex_map.index), k)
+        )
+    )
+    return heat + np.where(source == 0, kernel @ source, 0)
 
-        hex_map.heat += hex_map.loaded_heat
 
-        return hex_map.set_index("h3_polyfill").drop(columns="loaded_heat")
+def station_diffusion_heat(hex_map, df, ring_weights=(1, 0.5)):
+    return diffuse_heat(hex_map, stations_heat(hex_map, df), ring_weights)
 
-    # on itere sur chaque ligne de la dataframe df, et donc sur chaque point positionné
-    for index, (gid, line) in df[["gid", "geometry"]].iterrows():
-        # on stocke le résultat du test "l'hexagone contient ce point" dans une colonne de la table hex_map créée à ce effet
-        hex_map[f"{colname}_{gid}"] = hex_map.geometry.crosses(line)
 
-    # On constitue la liste des colonnes ainsi créée
-    column_names = [name for name in hex_map.columns if name.startswith(f"{colname}_")]
+# moteurs de calcul de chaleur : renvoient un vecteur aligné sur hex_map, pour coeff=1
+ENGINES = {
+    "points": points_heat,
+    "lines": lines_heat,
+    "stations": station_diffusion_heat,
+}
 
-    # On incrémente la colonne 'heat' dans hex_map avec la somme des lignes : un dénombrement des stations de vélov présentes dans le hex multiplié par le coeff
-    new_heat = hex_map[column_names].sum(axis=1) * coeff
-    hex_map["heat"] += new_heat
 
-    hex_map = hex_map[["nom", "geometry", "heat"]]
-    print(f"hex_map mise à jour avec les {index} points de la dataframe")
-    # on sauvegarde la colonne heat dans un csv pour usage futur
-    if heat_csv_name not in os.listdir("data/"):
-        print("heat column saved for later use")
-        new_heat = pd.DataFrame(new_heat, columns=["loaded_heat"])
-        new_heat.to_csv(heat_csv_path)
-    return hex_map
+def layer_heat(hex_map, df, name, engine, coeff=1, **params):
+    """Vecteur de chaleur d'un jeu de données, aligné sur hex_map, depuis le cache si possible"""
+    key = heat_cache_key(hex_map, df, engine, coeff, **params)
+    heat = load_cached_heat(key)
+    if heat is not None:
+        print(f"loading {name} heat column from cache")
+        return heat
 
+    heat = ENGINES[engine](hex_map, df, **params) * coeff
+    print(f"hex_map mise à jour avec les {len(df)} éléments de {name}")
+    save_cached_heat(key, heat)
+    print("heat column saved for later use")
+    return heat
 
-def compute_heat_train_station(hex_map, df, name="gare", coeff=1):
-    """#compute_heat_train_station : avoir un moyen que les gares rayonnent leur chaleur sur les hexagones qui les contiennent et les adjacents"""
-    colname = name
 
-    # TODO check if data already there
-    heat_csv_name = f"{name}_heat.csv"
-    heat_csv_path = f"data/{heat_csv_name}"
-    if heat_csv_name in os.listdir("data/"):
-        # load the data and return the hex map
-        print("loading heat column from cache")
-        heat = pd.read_csv(heat_csv_path)
-        hex_map = pd.merge(left=hex_map.reset_index(), right=heat)
+# zoom maximal auquel la carte exportée reste fidèle : les géométries y sont simplifiées
+# à un demi-pixel près, puis leurs coordonnées arrondies (6 décimales, ~10 cm)
+EXPORT_ZOOM = 16
+EXPORT_DECIMALS = 6
 
-        hex_map.heat += hex_map.loaded_heat
 
-        return hex_map.set_index("h3_polyfill").drop(columns="loaded_heat")
+def simplify_tolerance(zoom):
+    """Tolérance de simplification, en degrés : un demi-pixel d'une tuile 256 à ce zoom"""
+    return 360 / (256 * 2**zoom) / 2
 
-    if "voyageurs" in df.columns:
-        for index, (gid, trafic, polygon) in df[
-            ["gid", "voyageurs", "geometry"]
-        ].iterrows():
-            # on stocke le résultat du test "l'hexagone contient cette gare" ou bien la gare et l'hexagone overlappent dans une colonne de la table hex_map créée à ce effet
-            hex_map[f"{colname}_contains_{gid}"] = (
-                hex_map.geometry.contains(polygon) * trafic
-            )
-            hex_map[f"{colname}_overlaps_{gid}"] = (
-                hex_map.geometry.overlaps(polygon) * trafic
-            )
-    else:
-        for index, (gid, polygon) in df[["gid", "geometry"]].iterrows():
-            # on stocke le résultat du test "l'hexagone contient cette gare" ou bien la gare et l'hexagone overlappent dans une colonne de la table hex_map créée à ce effet
-            hex_map[f"{colname}_contains_{gid}"] = hex_map.geometry.contains(polygon)
-            hex_map[f"{colname}_overlaps_{gid}"] = hex_map.geometry.overlaps(polygon)
-
-    # On constitue la liste des colonnes ainsi créées
-    column_names = [name for name in hex_map.columns if name.startswith(f"{colname}_")]
-
-    # On crée une colonne "has_trainstation" dans hex_map
-    hex_map["has_train_station"] = hex_map[column_names].sum(axis=1)
-
-    # on ajoute une colonne : 'close_to_train_station'
-    hex_map["close_to_train_station"] = False
-
-    # d'abord on calcule la liste des hex adjacents à chaque hex
-    hex_map = hex_map.h3.hex_ring()
-
-    # on itère sur chaque ligne, et sur chaque hex indiqué dans la colonne h3_hex_ring
-    for i, row in hex_map.iterrows():
-        if row.has_train_station:  # si on a une gare sur l'hexagone
-            for (
-                hex_code
-            ) in row.h3_hex_ring:  # on prend la liste des hexagones adjacents
-                try:
-                    if not hex_map.loc[
-                        hex_code, "has_train_station"
-                    ]:  # s'il n"y a pas déjà une gare dessus
-                        hex_map.loc[
-                            hex_code, "close_to_train_station"
-                        ] = (
-                            row.has_train_station
-                        )  # on le flagge comme voisin d'une gare
-                except (
-                    KeyError
-                ):  # exception pour les hex_code non existants (liés à la bordure de notre hex map)
-                    pass
-
-    # on retire les lignes avec des nans ajoutés
-    hex_map = hex_map.dropna(axis=0)
-    # on calcule la heat : +coeff si has_train_station, +coeff/2 si close_to_train_station
-    new_heat = (
-        hex_map["has_train_station"] * coeff
-        + hex_map["close_to_train_station"] * coeff / 2
+
+def export_geometries(df, zoom=EXPORT_ZOOM):
+    """Copie de df aux géométries simplifiées (topologie préservée) et coordonnées arrondies"""
+    geometry = df.geometry.simplify(simplify_tolerance(zoom), preserve_topology=True)
+    df = df.copy()
+    df[df.geometry.name] = shapely.transform(
+        geometry.to_numpy(), lambda coords: np.round(coords, EXPORT_DECIMALS)
     )
+    return df
+
+
+def popup_frame(layer, df):
+    """Colonnes d'un jeu de données affichées dans les infobulles, avec le type de la couche"""
+    spec = LAYER_SPECS[layer]
+    frame = df.drop(columns=["gid", "stop_id", "centroid"], errors="ignore")
+    if "popup_columns" in spec:
+        frame = frame[spec["popup_columns"] + ["geometry"]]
+    if "label" in spec:
+        frame.insert(0, "type", spec["label"])
+    return frame
+
+
+def layer_fragment(layer, df, export_zoom=EXPORT_ZOOM):
+    """Fragment JS d'une couche de la carte assemblée, géométries allégées pour export_zoom"""
+    spec = LAYER_SPECS[layer]
+    frame = popup_frame(layer, export_geometries(df, export_zoom))
+    geojson = frame.to_json(drop_id=True, ensure_ascii=False, separators=(",", ":"))
+    fragment = fragments.layer_fragment(
+        geojson, COLORS[spec["color"]], spec.get("marker")
+    )
+    if "markers" in spec:
+        markers = [
+            [round(point.y, EXPORT_DECIMALS), round(point.x, EXPORT_DECIMALS), nom]
+            for point, nom in zip(df["centroid"], df["nom"])
+        ]
+        fragment += fragments.markers_fragment(markers, *spec["markers"])
+    return fragment
 
-    hex_map["heat"] += new_heat
 
-    # on limite hex_map aux colonnes qui nous intéressent
-    hex_map_columns = [
-        "nom",
-        "geometry",
-        "heat",
-    ]
-    hex_map = hex_map[hex_map_columns]
-    # on sauvegarde la colonne heat dans un csv pour usage futur
-    if heat_csv_name not in os.listdir("data/"):
-        print("heat column saved for later use")
-        new_heat = pd.DataFrame(new_heat, columns=["loaded_heat"])
-        new_heat.to_csv(heat_csv_path)
-    return hex_map
+def hexagons_fragment(hex_map, export_zoom=EXPORT_ZOOM):
+    """Fragment JS des hexagones de la grille, identifiés par leur rang"""
+    frame = export_geometries(hex_map[["nom", "geometry"]], export_zoom)
+    geojson = frame.reset_index(drop=True).to_json(
+        ensure_ascii=False, separators=(",", ":")
+    )
+    return fragments.hexagons_fragment(geojson)
 
 
-def create_hex_map(resolution=RESOLUTION):
-    url_communes = "https://download.data.grandlyon.com/wfs/grandlyon?SERVICE=WFS&VERSION=2.0.0&request=GetFeature&typename=adr_voie_lieu.adrcomgl&outputFormat=application/json; subtype=geojson&SRSNAME=EPSG:4171"
-    communes_filename = "communes.geojson"
+def assemble_map(hex_map, datasets, export_zoom=EXPORT_ZOOM, communes=None):
+    """Page HTML de la carte, assemblée à partir des fragments en cache pour cette version des données
 
-    communes = get_data(url_communes, communes_filename)
+    Les fragments manquants sont construits depuis hex_map et datasets ({couche: dataframe}),
+    déjà restreints aux communes (codes INSEE) s'il y en a. Les fragments d'une carte filtrée
+    ne sont pas mis en cache : il y aurait un jeu de fragments par sous-ensemble de communes.
+    """
+    version = f"{map_cache.data_version()}-z{export_zoom}"
 
-    communes_columns = ["nom", "nomreduit", "insee", "trigramme", "geometry"]
-    communes = communes[communes_columns]
+    def fragment(name, build):
+        return build() if communes else fragments.cached_fragment(name, version, build)
 
-    # Resample to H3 cells
-    hex_map = communes.h3.polyfill_resample(resolution)
+    hexagons = fragment("hexagons", lambda: hexagons_fragment(hex_map, export_zoom))
+    layer_fragments = [
+        fragment(layer, lambda: layer_fragment(layer, df, export_zoom))
+        for layer, df in datasets.items()
+        if LAYER_SPECS[layer]["color"] is not None
+    ]
+    heat = hex_map["heat"].astype("float64").round(4).tolist()
+    bounds = map_bounds(hex_map) if communes else None
+    return fragments.assemble(hexagons, heat, layer_fragments, bounds)
+
+
+# marqueur d'un point regroupé (FastMarkerCluster) : ses attributs sont chargés au premier clic
+CLUSTER_CALLBACK = """
+function (row) {
+    var marker = L.circleMarker(new L.LatLng(row[0], row[1]), {radius: 3, color: %(color)s});
+    marker.on("click", function () {
+        if (marker.getPopup()) return;
+        fetch(%(url)s + row[2]).then(function (response) {
+            return response.json();
+        }).then(function (attributes) {
+            var table = document.createElement("table");
+            Object.keys(attributes).forEach(function (name) {
+                var line = table.insertRow();
+                line.insertCell().textContent = name;
+                line.insertCell().textContent = attributes[name];
+            });
+            marker.bindPopup(table).openPopup();
+        });
+    });
+    return marker;
+}
+"""
+
+
+def publish_point_attributes(layer, df):
+    """Publie dans le magasin les attributs (hors géométrie) des points d'une couche, pour les popups"""
+    columns = [column for column in df.columns if column != "geometry"]
+    # la clé suit aussi les attributs : un nom ou un nombre de places changé republie les popups
+    attributes = pd.util.hash_pandas_object(pd.DataFrame(df[columns]), index=False)
+    digest = hashlib.sha256(attributes.to_numpy().tobytes()).hexdigest()
+    key = f"{dataset_digest(df)}:{digest}:{','.join(columns)}"
+    if store.read_manifest().get("attributes", {}).get(layer) != key:
+        records = json.loads(
+            pd.DataFrame(df[columns]).to_json(orient="records", force_ascii=False)
+        )
+        store.write_point_attributes(layer, records, key)
+
+
+def cluster_points(layer, df, color, popups_url, positions=None):
+    """Marqueurs regroupés d'une couche de points, les popups sont chargées au clic
+
+    Seules les coordonnées (arrondies à 6 décimales) et le rang de chaque point sont écrits dans
+    la page ; les attributs, publiés par publish_point_attributes, sont servis par popups_url
+    suivie de ce rang. positions : rangs des points de df dans le jeu de données publié.
+    Les coordonnées sont lues dans les points publiés de la couche (store.open_points) s'ils
+    sont à jour. Les points sans coordonnées (géométrie absente ou vide) ne sont pas
+    dessinés, les autres gardent leur rang.
+    """
+    positions = np.arange(len(df)) if positions is None else np.asarray(positions)
+    points = shared_points(layer)
+    if points is None or len(points) <= positions.max(initial=-1):
+        points = layer_points(df)
+    else:
+        points = points[positions]
+    valid = np.isfinite(points["lat"]) & np.isfinite(points["lon"])
+    data = [
+        [lat, lon, i]
+        for i, lat, lon in zip(
+            positions[valid].tolist(),
+            points["lat"][valid].round(6).tolist(),
+            points["lon"][valid].round(6).tolist(),
+        )
+    ]
+    callback = CLUSTER_CALLBACK % {
+        "color": json.dumps(color),
+        "url": json.dumps(popups_url),
+    }
+    return FastMarkerCluster(data, callback=callback, name=layer)
 
-    hex_map = hex_map[["nom", "geometry"]]
 
-    hex_map["heat"] = 0
-    return hex_map
+def shared_points(layer):
+    """Points publiés d'une couche (store.open_points), alignés sur son jeu de données, s'ils
+    ont été publiés avec sa chaleur actuelle ; sinon None"""
+    key = store.read_manifest().get("points", {}).get(layer)
+    if key is None or key != store.heat_layers(RESOLUTION).get(layer):
+        return None
+    return store.open_points(layer)
 
 
-def gen_maps(
-    own_bike_used=False,
-    velov_used=False,
-    trains_used=False,
-    cars_used=False,
-    rhone_buses_used=False,
-    public_transports_used=False,
-    taxis_used=False,
-    river_boat_used=False,
-    pmr_used=False,
-):
-    # map preparation
+def clip_positions(df, hexagons):
+    """Rangs des éléments de df qui recoupent ces hexagones (GeoSeries)
 
-    lyon = (45.75, 4.85)
-    tiles = [
-        "OpenStreetMap",
-        "Stamen Terrain",
-        "Stamen Toner",
-        "Stamen Watercolor",
-        "CartoDB positron",
-        "CartoDB dark_matter",
-    ]
+    Filtre d'abord par la boîte englobante des hexagones, puis test exact avec un index spatial.
+    """
+    minx, miny, maxx, maxy = hexagons.total_bounds
+    bounds = df.geometry.bounds
+    candidates = np.flatnonzero(
+        (bounds["minx"] <= maxx)
+        & (bounds["maxx"] >= minx)
+        & (bounds["miny"] <= maxy)
+        & (bounds["maxy"] >= miny)
+    )
+    tree = shapely.STRtree(hexagons.values)
+    inputs, _ = tree.query(df.geometry.values[candidates], predicate="intersects")
+    return candidates[np.unique(inputs)]
+
+
+def map_bounds(hex_map):
+    """[[sud, ouest], [nord, est]] des hexagones de hex_map"""
+    minx, miny, maxx, maxy = hex_map.total_bounds
+    return [[miny, minx], [maxy, maxx]]
+
+
+def layer_points(df):
+    """Points d'un jeu de données : tableau structuré (lon, lat, gid) aligné sur ses lignes
+
+    lon et lat valent NaN pour les géométries absentes ou vides.
+    """
+    points = df.geometry.representative_point()
+    array = np.zeros(len(df), dtype=[("lon", "f8"), ("lat", "f8"), ("gid", "i8")])
+    array["lon"] = points.x.to_numpy()
+    array["lat"] = points.y.to_numpy()
+    if "gid" in df.columns:
+        array["gid"] = df["gid"].to_numpy()
+    return array
+
+
+def heat_matrix(hex_map, datasets):
+    """Matrice (n_hex × n_couches) float32 de la chaleur de chaque couche pour un coeff de 1
+
+    Les colonnes des couches de datasets ({couche: dataframe}) qui ne sont pas encore
+    publiées dans le magasin partagé, ou dont le jeu de données a changé, y sont écrites,
+    depuis le cache de chaleur si possible. La matrice est renvoyée en mémoire mappée.
+    """
+    resolution = h3.get_resolution(hex_map.index[0])
+    published = store.heat_layers(resolution)
+    for layer, df in datasets.items():
+        engine, params = LAYER_ENGINES[layer], LAYER_PARAMS[layer]
+        key = heat_cache_key(hex_map, df, engine, 1, **params)
+        if published.get(layer) != key:
+            heat = layer_heat(hex_map, df, layer, engine, **params)
+            store.write_heat_column(
+                resolution, LAYERS.index(layer), len(LAYERS), layer, heat, key
+            )
+            store.write_points(layer, layer_points(df), key)
+            save_layer_snapshot(layer, df)
 
-    m = folium.Map(location=lyon, zoom_start=11, tiles=tiles[4], control_scale=True)
+    return published_matrix(hex_map)
 
-    # kwargs for gpd.explore()
-    kwargs = {
-        "m": m,
-        "marker_kwds": {"radius": 3},
-    }
 
-    # own_bike_used part
-    if own_bike_used:
-        stationnement_velo_url = "https://download.data.grandlyon.com/wfs/grandlyon?SERVICE=WFS&VERSION=2.0.0&request=GetFeature&typename=pvo_patrimoine_voirie.pvostationnementvelo&outputFormat=application/json; subtype=geojson&SRSNAME=EPSG:4171"
-        stationnement_velo_filename = "stationnement_velo.geojson"
-        stationnement_velo = get_data(
-            stationnement_velo_url, stationnement_velo_filename
+def published_matrix(hex_map):
+    """Matrice de chaleur publiée dans le magasin pour la grille de hex_map (zéros si absente)"""
+    matrix = store.open_heat_matrix(h3.get_resolution(hex_map.index[0]))
+    if matrix is None or len(matrix) != len(hex_map):
+        return np.zeros((len(hex_map), len(LAYERS)), dtype=np.float32)
+    return matrix
+
+
+def get_layer_executor():
+    global _layer_executor
+    if _layer_executor is None:
+        # spawn : pas de fork d'un processus qui a déjà des threads (serveur, tâches)
+        _layer_executor = ProcessPoolExecutor(
+            max_workers=layer_workers(), mp_context=multiprocessing.get_context("spawn")
         )
-        # on filtre les stationnements seulement en projet
-        stationnement_velo = stationnement_velo[
-            stationnement_velo.avancement == "Existant"
-        ]
+    return _layer_executor
+
+
+def layer_workers():
+    """Taille du pool de calcul des couches : réglage MAPS_LAYER_WORKERS, LAYER_WORKERS hors Django"""
+    # import ici : ce module s'utilise aussi sans Django
+    from django.conf import settings
+
+    if not settings.configured:
+        return LAYER_WORKERS
+    return getattr(settings, "MAPS_LAYER_WORKERS", LAYER_WORKERS)
+
+
+def run_layer(layer, resolution=RESOLUTION, root=None):
+    """Charge le jeu de données d'une couche et publie sa chaleur dans le magasin partagé
+
+    root : dossier des données du processus appelant, que les processus du pool ignorent.
+    """
+    if root is not None:
+        snapshots.set_root(root)
+    df = LOADERS[layer]()
+    heat_matrix(create_hex_map(resolution), {layer: df})
+    return df
+
+
+def run_layers(layers, resolution=RESOLUTION):
+    """Jeux de données des couches ({couche: dataframe}), chaleur publiée dans le magasin
+
+    Chaque couche est chargée et sa chaleur calculée dans un processus du pool ; les colonnes
+    de chaleur se rejoignent dans la matrice partagée du magasin. Si toutes les couches sont
+    déjà publiées, il ne reste qu'à les charger : elles le sont dans ce processus.
+    """
+    published = store.heat_layers(resolution)
+    if (
+        len(layers) <= 1
+        or layer_workers() <= 1
+        or all(layer in published for layer in layers)
+    ):
+        return {layer: run_layer(layer, resolution) for layer in layers}
+    executor = get_layer_executor()
+    root = snapshots.root()
+    futures = {
+        layer: executor.submit(run_layer, layer, resolution, root) for layer in layers
+    }
+    return {layer: future.result() for layer, future in futures.items()}
 
-    # Velov part
-    if velov_used:
-        url_velov = "https://download.data.grandlyon.com/wfs/rdata?SERVICE=WFS&VERSION=2.0.0&request=GetFeature&typename=jcd_jcdecaux.jcdvelov&outputFormat=application/json; subtype=geojson&SRSNAME=EPSG:4171"
-        velov_filename = "velov.geojson"
 
-        velov = get_data(url_velov, velov_filename)
-        # remove closed stations
-        velov = velov[velov.status == "OPEN"]
-        velovdf_columns = [
-            "name",
-            "address",
-            "commune",
-            "bike_stands",
-            "geometry",
-            "gid",
-        ]
+def publish_heat(layers, resolution=RESOLUTION):
+    """Publie la grille et la chaleur des couches dans le magasin partagé, sans générer de carte"""
+    download_files(
+        ["communes"] + [name for layer in layers for name in LAYER_DATASETS[layer]]
+    )
+    create_hex_map(resolution)
+    run_layers(layers, resolution)
 
-        velov = velov[velovdf_columns]
 
-    if velov_used or own_bike_used:
-        # aménagements cyclables
-        ac_url = "https://download.data.grandlyon.com/wfs/grandlyon?SERVICE=WFS&VERSION=2.0.0&request=GetFeature&typename=pvo_patrimoine_voirie.pvoamenagementcyclable&outputFormat=application/json; subtype=geojson&SRSNAME=EPSG:4171"
-        ac_filename = "amenagements_cyclables.geojson"
-        ac = get_data(ac_url, ac_filename)
+def layer_snapshot_path(layer):
+    # dernier état publié du jeu de données de la couche, comparé au suivant par gid
+    return f"{store.store_folder()}layers/{layer}.parquet"
 
-    # Position Gares
-    if trains_used:
-        gares_url = "https://download.data.grandlyon.com/wfs/grandlyon?SERVICE=WFS&VERSION=2.0.0&request=GetFeature&typename=adr_voie_lieu.adrgarefer&outputFormat=application/json; subtype=geojson&SRSNAME=EPSG:4171"
-        gares_filename = "gares.geojson"
 
-        gares = get_data(gares_url, gares_filename)
-        gares_columns = ["nom", "geometry", "idexterne", "gid"]
+def save_layer_snapshot(layer, df):
+    """Garde le jeu de données publié d'une couche, base du prochain rafraîchissement incrémental"""
+    if LAYER_ENGINES[layer] not in DELTA_ENGINES or "gid" not in df.columns:
+        return
+    path = layer_snapshot_path(layer)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    df[["gid", "geometry"]].to_parquet(tmp_path)
+    os.replace(tmp_path, path)
 
-        print(gares.columns)
-        gares = gares[gares_columns]
 
-        # turn idexterne to int for future merge with traffic data
-        gares.idexterne = pd.to_numeric(gares.idexterne)
+def load_layer_snapshot(layer):
+    try:
+        return gpd.read_parquet(layer_snapshot_path(layer))
+    except FileNotFoundError:
+        return None
 
-        # remove the one line with no idxexterne info
-        gares = gares[~gares.idexterne.isna()]
 
-        # collect traffic data to give weight to bigger train stations
-        trafic_voyageurs_url = "https://data.sncf.com/api/explore/v2.1/catalog/datasets/frequentation-gares/exports/csv?lang=fr&timezone=Europe%2FBerlin&use_labels=true&delimiter=%3B"
-        trafic_voyageurs_filename = "trafic_voyageurs_gares.csv"
+def diff_layer(previous, current):
+    """Éléments (gid) ajoutés, supprimés et modifiés (géométrie) entre deux états d'une couche"""
+    old = pd.Series(shapely.to_wkb(previous.geometry.values), index=previous["gid"])
+    new = pd.Series(shapely.to_wkb(current.geometry.values), index=current["gid"])
+    common = old.index.intersection(new.index)
+    changed = common[old[common].to_numpy() != new[common].to_numpy()]
+    return (
+        new.index.difference(old.index),
+        old.index.difference(new.index),
+        changed,
+    )
 
-        trafic = get_data(trafic_voyageurs_url, trafic_voyageurs_filename)
 
-        gares_trafic = pd.merge(
-            left=gares,
-            right=trafic,
-            left_on="idexterne",
-            right_on="Code UIC",
-            how="left",
+def refresh_layer(layer, resolution=RESOLUTION):
+    """Télécharge le nouvel état du jeu de données d'une couche et met à jour sa chaleur publiée
+
+    Pour les moteurs de DELTA_ENGINES, seuls les éléments ajoutés, supprimés ou modifiés
+    depuis le dernier état publié sont recalculés : leurs contributions sont ajoutées ou
+    retirées des cellules concernées. Sinon (gares, pas d'état précédent ou état qui n'est pas
+    celui de la colonne publiée, gid absents ou en double) la colonne est recalculée entièrement.
+    Les attributs des popups des couches de CLUSTER_LAYERS sont publiés aussi.
+    Renvoie (mode, ajoutés, supprimés, modifiés), mode valant "à jour", "delta" ou "complet" ;
+    un recalcul complet compte tous les éléments comme ajoutés.
+    """
+    for name in LAYER_DATASETS[layer]:
+        # max_age=0 : revalidation immédiate auprès du serveur
+        download_file(DATASETS[name]["url"], DATASETS[name]["filename"], max_age=0)
+    df = LOADERS[layer]()
+    if layer in CLUSTER_LAYERS:
+        # avant la comparaison des clés de chaleur : des attributs seuls ont pu changer
+        publish_point_attributes(layer, popup_frame(layer, df))
+    hex_map = create_hex_map(resolution)
+    engine, params = LAYER_ENGINES[layer], LAYER_PARAMS[layer]
+    key = heat_cache_key(hex_map, df, engine, 1, **params)
+    published = store.heat_layers(resolution)
+    if published.get(layer) == key:
+        return "à jour", 0, 0, 0
+
+    previous = load_layer_snapshot(layer)
+    matrix = store.open_heat_matrix(resolution)
+    if (
+        engine not in DELTA_ENGINES
+        or previous is None
+        or matrix is None
+        # l'état précédent doit être celui dont la colonne publiée a été calculée (même
+        # grille) : la colonne et l'état sont écrits séparément, un processus concurrent ou
+        # un arrêt entre les deux écritures peut les désaccorder
+        or heat_cache_key(hex_map, previous, engine, 1, **params)
+        != published.get(layer)
+        or "gid" not in df.columns
+        or not df["gid"].is_unique
+        or not previous["gid"].is_unique
+    ):
+        heat_matrix(hex_map, {layer: df})
+        return "complet", len(df), 0, 0
+
+    added, removed, changed = diff_layer(previous, df)
+    heat = np.array(matrix[:, LAYERS.index(layer)], dtype=np.float64)
+    # les anciennes versions des éléments modifiés sont retirées, les nouvelles ajoutées
+    outgoing = previous[previous["gid"].isin(removed.union(changed))]
+    incoming = df[df["gid"].isin(added.union(changed))]
+    if len(outgoing):
+        heat -= ENGINES[engine](hex_map, outgoing, **params)
+    if len(incoming):
+        heat += ENGINES[engine](hex_map, incoming, **params)
+
+    save_cached_heat(key, heat)
+    store.write_heat_column(
+        resolution, LAYERS.index(layer), len(LAYERS), layer, heat, key
+    )
+    store.write_points(layer, layer_points(df), key)
+    save_layer_snapshot(layer, df)
+    return "delta", len(added), len(removed), len(changed)
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(DOWNLOAD_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def build_snapshot(resolution=RESOLUTION):
+    """Construit un nouvel instantané des données et l'active, renvoie son manifeste
+
+    La grille et le magasin de l'instantané actif y sont repris par liens physiques, puis
+    chaque couche est rafraîchie (refresh_layer : seuls les éléments changés sont recalculés,
+    les attributs des popups sont publiés). Les résolutions grossières en sont agrégées et les fichiers téléchargés et ingérés y sont
+    liés. L'instantané est construit dans un dossier temporaire, renommé une fois complet,
+    puis désigné par CURRENT ; le dossier temporaire est supprimé si la construction échoue.
+    """
+    current = snapshots.read_current()
+    # date UTC en tête du nom : l'ordre des noms est l'ordre de construction
+    now = time.gmtime()
+    name = f"{time.strftime('%Y%m%d-%H%M%S', now)}-{os.getpid()}"
+    folder = snapshots.snapshot_folder(name)
+    tmp_folder = f"{folder[:-1]}.tmp/"
+    try:
+        if current:
+            for part in ("grid", "store"):
+                source = f"{snapshots.snapshot_folder(current)}{part}"
+                if os.path.isdir(source):
+                    shutil.copytree(
+                        source,
+                        f"{tmp_folder}{part}",
+                        symlinks=True,
+                        copy_function=snapshots.link_file,
+                        ignore=shutil.ignore_patterns("*.lock", "*.tmp"),
+                    )
+
+        snapshots.set_root(tmp_folder)
+        download_file(
+            DATASETS["communes"]["url"], DATASETS["communes"]["filename"], max_age=0
         )
-        gares_trafic_columns = [
-            "nom",
-            "gid",
-            "geometry",
-            "Total Voyageurs 2021",
-        ]
-
-        gares = gares_trafic[gares_trafic_columns].rename(
-            columns={"Total Voyageurs 2021": "voyageurs"}
+        create_hex_map(resolution)
+        refreshed = {}
+        for layer in LAYERS:
+            refreshed[layer] = refresh_layer(layer, resolution)
+        # résolutions grossières agrégées d'avance : l'instantané n'est plus modifié une fois actif
+        if resolution == RESOLUTION:
+            for coarse in COARSE_RESOLUTIONS:
+                scores.roll_up(coarse)
+
+        sources = {}
+        for dataset, source in DATASETS.items():
+            path = ingested_path(dataset)
+            if not os.path.exists(path):
+                continue
+            raw_path = f"{DATA_FOLDER}{source['filename']}"
+            snapshots.link_file(raw_path, f"{tmp_folder}sources/{source['filename']}")
+            snapshots.link_file(path, f"{tmp_folder}parquet/{os.path.basename(path)}")
+            sources[dataset] = {
+                "filename": source["filename"],
+                "size": os.path.getsize(raw_path),
+                "sha256": file_digest(raw_path),
+            }
+        manifest = {
+            "name": name,
+            "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", now),
+            "previous": current,
+            "resolution": resolution,
+            "sources": sources,
+            "layers": store.heat_layers(resolution),
+            "refresh": {layer: result[0] for layer, result in refreshed.items()},
+        }
+        with open(f"{tmp_folder}manifest.json", "w") as file:
+            json.dump(manifest, file, indent=1, ensure_ascii=False)
+    except BaseException:
+        # instantané incomplet : rien n'en est gardé
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+        raise
+    finally:
+        snapshots.release()
+
+    os.replace(tmp_folder[:-1], folder[:-1])
+    snapshots.activate(name)
+    snapshots.prune()
+    return manifest
+
+
+def build_grid(resolution=RESOLUTION):
+    """Calcule la grille H3 des communes à cette résolution et l'enregistre en tableaux compacts
+
+    Le dossier store.grid_folder(resolution) contient :
+    - cells.npy : identifiants H3 (uint64), triés ;
+    - communes.npy : code de la commune de chaque cellule (int16), indice dans communes.json ;
+    - communes.json : nom et code INSEE de chaque commune.
+
+    À appeler sous store.write_lock("grid").
+    """
+    communes = load_dataset("communes")
+    if communes is None:
+        raise FileNotFoundError(
+            "Communes indisponibles : grille H3 impossible à calculer"
         )
-        # normalize the traffic data to get some reasonnable numbers
-        gares.voyageurs = 100 * gares.voyageurs / np.linalg.norm(gares.voyageurs)
-        # Project to NAD83 projected crs
-        gares = gares.to_crs(epsg=2263)
 
-        # Access the centroid attribute of each polygon
-        gares["centroid"] = gares.centroid
+    communes_columns = ["nom", "nomreduit", "insee", "trigramme", "geometry"]
+    communes = communes[communes_columns]
 
-        # Project to WGS84 geographic crs
-        # geometry (active) column
-        gares = gares.to_crs(epsg=4326)
+    # Resample to H3 cells
+    hex_map = communes.h3.polyfill_resample(resolution)
 
-        # Centroid column
-        gares["centroid"] = gares["centroid"].to_crs(epsg=4326)
+    # ordre stable des hexagones d'un processus à l'autre : les vecteurs de chaleur en cache y sont alignés
+    hex_map = hex_map[["nom"]].sort_index()
 
-        print(gares.columns)
+    cells = np.array([h3.str_to_int(cell) for cell in hex_map.index], dtype=np.uint64)
+    names = list(communes.nom)
+    codes = pd.Categorical(hex_map.nom, categories=names).codes.astype(np.int16)
 
-    if cars_used:
-        # infos stationnement
+    store.write_grid(
+        resolution, cells, codes, {"nom": names, "insee": list(communes.insee)}
+    )
+    print(f"Grille H3 de résolution {resolution} enregistrée : {len(cells)} hexagones")
 
-        parkings_url = "https://download.data.grandlyon.com/wfs/grandlyon?SERVICE=WFS&VERSION=2.0.0&request=GetFeature&typename=pvo_patrimoine_voirie.pvoparking&outputFormat=application/json; subtype=geojson&SRSNAME=EPSG:4171"
-        parkings_filename = "parkings.geojson"
-        parkings = get_data(parkings_url, parkings_filename)
-        parkings_columns = [
-            "nom",
-            "commune",
-            # "voieentree",
-            # "voiesortie",
-            # 'avancement',
-            # 'annee',
-            # "typeparking",
-            # "situation",
-            #'parkingtempsreel',
-            #  'gabarit',
-            # "capacite",
-            #'capacite2rm',
-            # "capacitevelo",
-            # "capaciteautopartage",
-            # "capacitepmr",
-            #'usage',
-            #'vocation',
-            "reglementation",
-            # 'fermeture',
-            # 'observation',
-            # 'codetype',
-            "gid",
-            "geometry",
-        ]
-        parkings = parkings[parkings_columns]
 
-        # infos autopartage
-        autopartage_url = "https://download.data.grandlyon.com/wfs/grandlyon?SERVICE=WFS&VERSION=2.0.0&request=GetFeature&typename=pvo_patrimoine_voirie.pvostationautopartage&outputFormat=application/json; subtype=geojson&SRSNAME=EPSG:4171"
-        autopartage_filename = "autopartage.geojson"
-        autopartage = get_data(autopartage_url, autopartage_filename)
+def grid_stale(resolution=RESOLUTION):
+    """La grille manque-t-elle ou précède-t-elle les communes déjà téléchargées ou ingérées ?
 
-        autopartage_columns = [
-            "nom",
-            # "identifiantstation",
-            "adresse",
-            "commune",
-            # "insee",
-            "typeautopartage",
-            # "nbemplacements",
-            # "localisation",
-            # "anneerealisation",
-            # "estouverte",
-            # "observation",
-            "gid",
-            "geometry",
+    Seules les dates des fichiers présents sont comparées : rien n'est téléchargé.
+    """
+    try:
+        grid_mtime = os.path.getmtime(f"{store.grid_folder(resolution)}communes.json")
+    except FileNotFoundError:
+        return True
+    path = snapshot_dataset_path("communes")
+    paths = (
+        [path]
+        if path
+        else [
+            ingested_path("communes"),
+            f"{DATA_FOLDER}{DATASETS['communes']['filename']}",
         ]
+    )
+    return any(
+        os.path.exists(path) and os.path.getmtime(path) > grid_mtime for path in paths
+    )
 
-        autopartage = autopartage[autopartage_columns]
-
-        # parcs relais
-        parcs_relais_url = "https://download.data.grandlyon.com/wfs/rdata?SERVICE=WFS&VERSION=2.0.0&request=GetFeature&typename=tcl_sytral.tclparcrelaisst&outputFormat=application/json; subtype=geojson&SRSNAME=EPSG:4171"
-        parcs_relais_filename = "parcs_relais.geojson"
 
-        pr = get_data(parcs_relais_url, parcs_relais_filename)
-        pr_columns = [
-            "nom",
-            "capacite",
-            # "place_handi",
-            # "horaires",
-            # "p_surv",
-            "gid",
-            "geometry",
-        ]
-        pr = pr[pr_columns]
-
-    # infos transports en commun
-    if rhone_buses_used:
-        cars_url = "https://download.data.grandlyon.com/wfs/rdata?SERVICE=WFS&VERSION=2.0.0&request=GetFeature&typename=cdr_cardurhone.cdrarret&outputFormat=application/json; subtype=geojson&SRSNAME=EPSG:4171"
-        cars_filename = "cars.geojson"
-        cars = get_data(cars_url, cars_filename)
-
-    if public_transports_used:
-        ## Points d'arrêt
-        points_arret_url = "https://download.data.grandlyon.com/wfs/rdata?SERVICE=WFS&VERSION=2.0.0&request=GetFeature&typename=tcl_sytral.tclarret&outputFormat=application/json; subtype=geojson&SRSNAME=EPSG:4171"
-        points_arret_filename = "points_arret.geojson"
-        pa = get_data(points_arret_url, points_arret_filename)
-        pa_columns = [
-            "nom",
-            "desserte",
-            "gid",
-            "geometry",
-        ]
-        pa = pa[pa_columns]
+def load_grid(resolution=RESOLUTION):
+    """Grille H3 de cette résolution : {"cells", "communes", "nom", "insee"}
 
-    if taxis_used:
-        ## taxis
-        taxis_url = "https://download.data.grandlyon.com/wfs/grandlyon?SERVICE=WFS&VERSION=2.0.0&request=GetFeature&typename=pvo_patrimoine_voirie.pvostationtaxi&outputFormat=application/json; subtype=geojson&SRSNAME=EPSG:4171"
-        taxis_filename = "stations_taxi.geojson"
-        taxis = get_data(taxis_url, taxis_filename)
-        taxis_columns = ["nom", "gid", "geometry"]
-        taxis = taxis[taxis_columns]
+    Les tableaux sont ouverts en mémoire mappée, partagée par tous les processus de l'hôte.
+    La grille n'est recalculée que si elle n'existe pas ou si les communes ont changé.
+    """
+    if grid_stale(resolution):
+        with store.write_lock("grid"):
+            # la grille a pu être recalculée par un autre processus pendant l'attente du verrou
+            if grid_stale(resolution):
+                build_grid(resolution)
 
-    if river_boat_used:
-        # points arrêt navette fluviale
-        navette_fluviale_url = "https://download.data.grandlyon.com/wfs/rdata?SERVICE=WFS&VERSION=2.0.0&request=GetFeature&typename=tca_transports_alternatifs.tcaarretvaporetto&outputFormat=application/json; subtype=geojson&SRSNAME=EPSG:4171"
-        navette_fluviale_filename = "navette_fluviale.geojson"
-        navette_fluviale = get_data(navette_fluviale_url, navette_fluviale_filename)
-        navette_fluviale_columns = ["nom", "gid", "geometry"]
-        navette_fluviale = navette_fluviale[navette_fluviale_columns]
+    cells, communes = store.open_grid(resolution)
+    return {"cells": cells, "communes": communes, **store.grid_communes(resolution)}
 
-    if pmr_used:
-        pmr_url = "https://download.data.grandlyon.com/ws/grandlyon/com_donnees_communales.comstationnementpmr_1_0_0/all.csv?maxfeatures=-1"
-        pmr_filename = "pmr.csv"
 
-        pmr = get_data(pmr_url, pmr_filename)
+@functools.lru_cache(maxsize=4)
+def grid_geometry(resolution=RESOLUTION, version=None):
+    """Identifiants H3 (chaînes) et polygones des cellules de la grille, construits au premier usage
 
-        num_fixer = lambda s: float(s.replace(",", "."))
+    version (scores.grid_version) change avec la grille : les polygones sont alors reconstruits.
+    """
+    cells = [h3.int_to_str(int(cell)) for cell in load_grid(resolution)["cells"]]
+    polygons = [
+        shapely.Polygon([(lng, lat) for lat, lng in h3.cell_to_boundary(cell)])
+        for cell in cells
+    ]
+    return pd.Index(cells, name="h3_polyfill"), np.array(polygons, dtype=object)
 
-        pmr.lat = pmr.lat.apply(num_fixer)
-        pmr.lon = pmr.lon.apply(num_fixer)
 
-        pmr = gpd.GeoDataFrame(pmr, geometry=gpd.points_from_xy(pmr.lon, pmr.lat))
-        pmr_columns = [
-            "nom",
-            # "adresse",
-            # "codepost",
-            "commune",
-            # "nb_places",
-            "gid",
-            "geometry",
-        ]
-        pmr = pmr[pmr_columns]
+def create_hex_map(resolution=RESOLUTION):
+    grid = load_grid(resolution)
+    index, polygons = grid_geometry(resolution, scores.grid_version(resolution))
+
+    hex_map = gpd.GeoDataFrame(
+        {"nom": np.array(grid["nom"], dtype=object)[grid["communes"]]},
+        geometry=polygons,
+        index=index,
+        crs="EPSG:4326",
+    )
 
-    ## HEX GRID Part
-    # create the heat column with zero values
+    hex_map["heat"] = 0
+    return hex_map
 
-    hex_map = create_hex_map()
 
-    # compute heat
-    if own_bike_used:
-        hex_map = compute_heat_from_points(
-            hex_map, stationnement_velo, "stationnement_velo", coeff=1
-        )
+def load_layer(layer):
+    """Jeu de données d'une couche de chaleur, d'après son entrée dans LAYER_SPECS"""
+    spec = LAYER_SPECS[layer]
+    if "loader" in spec:
+        return globals()[spec["loader"]]()
 
-    if velov_used:
-        hex_map = compute_heat_from_points(hex_map, velov, "velov", coeff=1)
+    columns = spec.get("columns")
+    filters = spec.get("filters", {})
+    # projection dès la lecture du parquet : colonnes gardées et colonnes filtrées
+    read_columns = columns and list(dict.fromkeys(columns + list(filters)))
+    df = load_dataset(spec["source"], columns=read_columns)
+    for column, value in filters.items():
+        df = df[df[column] == value]
+    return df[columns] if columns else df
 
-    if own_bike_used or velov_used:
-        hex_map = compute_heat_from_lines(hex_map, ac, "ac", coeff=0.5)
 
-    if trains_used:
-        hex_map = compute_heat_train_station(hex_map, gares, "gares")
+def load_gares():
+    gares = load_dataset("gares")
+    gares_columns = ["nom", "geometry", "idexterne", "gid"]
 
-    if public_transports_used:
-        hex_map = compute_heat_from_points(hex_map, pa, "points_access", coeff=2)
+    gares = gares[gares_columns]
 
-    if river_boat_used:
-        hex_map = compute_heat_train_station(
-            hex_map, navette_fluviale, "navette_fluv", coeff=1
-        )
-    if taxis_used:
-        hex_map = compute_heat_from_points(hex_map, taxis, "taxis", coeff=1)
+    # turn idexterne to int for future merge with traffic data
+    gares.idexterne = pd.to_numeric(gares.idexterne)
 
-    if rhone_buses_used:
-        hex_map = compute_heat_from_points(hex_map, cars, "cars", coeff=1)
+    # remove the one line with no idxexterne info
+    gares = gares[~gares.idexterne.isna()]
 
-    if cars_used:
-        hex_map = compute_heat_from_points(hex_map, parkings, "parkings", coeff=1)
-        hex_map = compute_heat_from_points(hex_map, autopartage, "autopartage", coeff=1)
-        hex_map = compute_heat_from_points(hex_map, pr, "pr", coeff=1)
+    # collect traffic data to give weight to bigger train stations
+    trafic = load_dataset("trafic_voyageurs_gares")
 
-    if pmr_used:
-        hex_map = compute_heat_from_points(hex_map, pmr, "pmr", coeff=1)
+    gares_trafic = pd.merge(
+        left=gares,
+        right=trafic,
+        left_on="idexterne",
+        right_on="Code UIC",
+        how="left",
+    )
+    gares_trafic_columns = [
+        "nom",
+        "gid",
+        "geometry",
+        "Total Voyageurs 2021",
+    ]
 
-    ## add the hex_map with heat first, then the points
-    hex_map.reset_index().drop(columns=["h3_polyfill"]).explore(
-        column="heat",
-        cmap="plasma",
-        style_kwds={"opacity": 0.05},
-        legend=True,
-        **kwargs,
+    gares = gares_trafic[gares_trafic_columns].rename(
+        columns={"Total Voyageurs 2021": "voyageurs"}
     )
+    # normalize the traffic data to get some reasonnable numbers
+    gares.voyageurs = 100 * gares.voyageurs / np.linalg.norm(gares.voyageurs)
+    # Project to NAD83 projected crs
+    gares = gares.to_crs(epsg=2263)
 
-    ## add the geometries from datasets used after the hexagon tiles
-    # It's a bit too taxing to draw markers for each stationnement vélo
-    if own_bike_used:
-        stationnement_velo["type"] = "stationnement vélo"
-        stationnement_velo[
-            ["type", "nom", "adresse", "commune", "capacite", "geometry"]
-        ].explore(
-            color=COLORS.get("velov"),
-            **kwargs,
-        )
-    if velov_used:
-        velov.drop(columns="gid").explore(
-            color=COLORS.get("velov"),
-            **kwargs,
-        )
+    # Access the centroid attribute of each polygon
+    gares["centroid"] = gares.centroid
 
-    if cars_used:
-        parkings["type"] = "parking"
-        parkings.drop(columns="gid").explore(color=COLORS.get("parkings"), **kwargs)
-        autopartage.drop(columns="gid").explore(
-            color=COLORS.get("autopartage"), **kwargs
-        )
-        pr.drop(columns="gid").explore(color=COLORS.get("relai"), **kwargs)
-
-    if trains_used:
-        gares.explore(color=COLORS.get("train_stations"), **kwargs)
-        # add the train marker to the centroid of each train station
-        for _, r in gares.iterrows():
-            lat = r["centroid"].y
-            lon = r["centroid"].x
-            folium.Marker(
-                location=[lat, lon],
-                popup=r["nom"],
-                icon=folium.Icon(color="gray", icon="train", prefix="fa"),
-            ).add_to(m)
+    # Project to WGS84 geographic crs
+    # geometry (active) column
+    gares = gares.to_crs(epsg=4326)
 
-    if public_transports_used:
-        pa["type"] = "arrêt transports en commun"
-        pa.drop(columns="gid").explore(color=COLORS.get("public_transports"), **kwargs)
+    # Centroid column
+    gares["centroid"] = gares["centroid"].to_crs(epsg=4326)
+    return gares
 
-    if river_boat_used:
-        ferry_marker = folium.Marker(
-            icon=folium.Icon(color="darkblue", icon="ferry", prefix="fa"),
-        )
-        navette_fluviale.drop(columns="gid").explore(
-            color=COLORS.get("river_boats"), marker_type=ferry_marker, **kwargs
-        )
 
-    if taxis_used:
-        taxis.drop(columns="gid").explore(color=COLORS.get("taxis"), **kwargs)
+# chargement du jeu de données de chaque couche de chaleur
+LOADERS = {layer: functools.partial(load_layer, layer) for layer in LAYERS}
 
-    if rhone_buses_used:
-        cars.drop(columns=["gid", "stop_id"]).explore(
-            color=COLORS.get("buses"), **kwargs
-        )
-    if pmr_used:
-        pmr["type"] = "Stationnement PMR"
-        pmr[["type", "commune", "nom", "geometry"]].explore(
-            color=COLORS.get("pmr"), **kwargs
+# jeux de données (clés de DATASETS) nécessaires à chaque couche de chaleur
+LAYER_DATASETS = {
+    layer: [spec["source"]] + spec.get("datasets", [])
+    for layer, spec in LAYER_SPECS.items()
+}
+
+# couches dessinées en marqueurs regroupés avec point_popups_url : attributs publiés pour les popups
+CLUSTER_LAYERS = {
+    layer
+    for layer, spec in LAYER_SPECS.items()
+    if spec["engine"] == "points" and spec["color"]
+}
+
+
+def gen_maps(
+    own_bike_used=False,
+    velov_used=False,
+    trains_used=False,
+    cars_used=False,
+    rhone_buses_used=False,
+    public_transports_used=False,
+    taxis_used=False,
+    river_boat_used=False,
+    pmr_used=False,
+    coeffs=None,
+    map_path=MAP_PATH,
+    progress=None,
+    heat_tiles_url=None,
+    point_popups_url=None,
+    export_zoom=EXPORT_ZOOM,
+    assemble=False,
+    communes=None,
+):
+    """Génère la carte de chaleur des modes de transport sélectionnés et l'enregistre dans map_path
+
+    coeffs ({couche: coeff}) remplace les coeffs par défaut de LAYER_COEFFS.
+    heat_tiles_url, si fournie (".../{z}/{x}/{y}.png"), dessine la chaleur avec ces tuiles
+    raster plutôt qu'avec un polygone par hexagone.
+    point_popups_url, si fournie (".../{layer}/"), dessine les couches de points en marqueurs
+    regroupés dont les popups sont chargées au clic depuis cette url suivie du rang du point.
+    export_zoom est le zoom maximal auquel les géométries écrites dans la page restent fidèles.
+    assemble, si vrai, assemble la page à partir des fragments des couches mis en cache par
+    version des données, sans folium (heat_tiles_url et point_popups_url sont alors ignorées) ;
+    la page HTML est renvoyée au lieu de la carte folium.
+    communes (codes INSEE) restreint la carte aux hexagones et aux éléments de ces communes ;
+    les hexagones sont alors dessinés en polygones, même avec heat_tiles_url.
+    progress, si fournie, est appelée avec le nom de chaque étape au moment où elle commence.
+    """
+    progress = progress or (lambda stage: None)
+
+    # map preparation
+
+    lyon = (45.75, 4.85)
+    tiles = [
+        "OpenStreetMap",
+        "Stamen Terrain",
+        "Stamen Toner",
+        "Stamen Watercolor",
+        "CartoDB positron",
+        "CartoDB dark_matter",
+    ]
+
+    m = folium.Map(location=lyon, zoom_start=11, tiles=tiles[4], control_scale=True)
+
+    # kwargs for gpd.explore()
+    kwargs = {
+        "m": m,
+        "marker_kwds": {"radius": 3},
+    }
+
+    progress("téléchargement")
+    layers = selected_layers(
+        own_bike_used=own_bike_used,
+        velov_used=velov_used,
+        trains_used=trains_used,
+        cars_used=cars_used,
+        rhone_buses_used=rhone_buses_used,
+        public_transports_used=public_transports_used,
+        taxis_used=taxis_used,
+        river_boat_used=river_boat_used,
+        pmr_used=pmr_used,
+    )
+    # téléchargements en parallèle : on attend le plus lent plutôt que la somme de tous
+    download_files(
+        ["communes"] + [name for layer in layers for name in LAYER_DATASETS[layer]]
+    )
+
+    ## HEX GRID Part
+    # create the heat column with zero values
+    progress("grille")
+    hex_map = create_hex_map()
+
+    progress("chaleur")
+    # chargement et chaleur des couches sélectionnées en parallèle, publiées dans le magasin
+    datasets = run_layers(layers)
+    matrix = published_matrix(hex_map)
+    positions = {}
+    # attributs publiés pour tout le jeu de données : les rangs sont communs à toutes les cartes.
+    # Un instantané servi n'est plus modifié : ses attributs sont publiés à sa construction.
+    if point_popups_url and not assemble and not snapshots.current_name():
+        for layer, df in datasets.items():
+            if layer in CLUSTER_LAYERS:
+                publish_point_attributes(layer, popup_frame(layer, df))
+    if communes:
+        # hexagones des communes puis éléments qui les recoupent, avant tout calcul ou rendu
+        mask = scores.commune_mask(communes)
+        hex_map, matrix = hex_map[mask], matrix[mask]
+        positions = {
+            layer: clip_positions(df, hex_map.geometry)
+            for layer, df in datasets.items()
+        }
+        datasets = {layer: df.iloc[positions[layer]] for layer, df in datasets.items()}
+    # compute heat : un seul produit matrice / vecteur avec les coeffs des couches sélectionnées
+    hex_map["heat"] = matrix @ layer_weights(datasets, coeffs)
+
+    if assemble:
+        progress("rendu")
+        html = assemble_map(hex_map, datasets, export_zoom, communes)
+        progress("enregistrement")
+        os.makedirs(os.path.dirname(map_path), exist_ok=True)
+        with open(map_path, "w") as file:
+            file.write(html)
+        print(f"Map assembled at {map_path}")
+        return html
+
+    progress("export")
+    # la page n'embarque que des géométries allégées et des valeurs arrondies
+    hex_map = export_geometries(hex_map, export_zoom)
+    hex_map["heat"] = hex_map["heat"].astype("float64").round(4)
+    datasets = {
+        layer: export_geometries(df, export_zoom) for layer, df in datasets.items()
+    }
+
+    progress("rendu")
+    if communes:
+        m.fit_bounds(map_bounds(hex_map))
+    ## add the hex_map with heat first, then the points
+    if heat_tiles_url and not communes:
+        # quelques tuiles par écran au lieu de dizaines de milliers de polygones
+        folium.TileLayer(
+            tiles=heat_tiles_url, attr="Grand Lyon", name="heat", overlay=True
+        ).add_to(m)
+        LinearColormap(
+            [to_hex(color) for color in colormaps["plasma"](np.linspace(0, 1, 9))],
+            vmin=0,
+            # même échelle que les tuiles, à tous les zooms
+            vmax=scores.heat_scale(layers),
+            caption="heat",
+        ).add_to(m)
+    else:
+        hex_map.reset_index().drop(columns=["h3_polyfill"]).explore(
+            column="heat",
+            cmap="plasma",
+            style_kwds={"opacity": 0.05},
+            legend=True,
+            **kwargs,
         )
+
+    ## add the geometries from datasets used after the hexagon tiles
+    for layer, df in datasets.items():
+        spec = LAYER_SPECS[layer]
+        if spec["color"] is None:
+            continue
+        color = COLORS[spec["color"]]
+        frame = popup_frame(layer, df)
+        if point_popups_url and spec["engine"] == "points":
+            popups_url = point_popups_url.format(layer=layer)
+            cluster_points(
+                layer, frame, color, popups_url, positions.get(layer)
+            ).add_to(m)
+        elif "marker" in spec:
+            icon, marker_color = spec["marker"]
+            marker = folium.Marker(
+                icon=folium.Icon(color=marker_color, icon=icon, prefix="fa")
+            )
+            frame.explore(color=color, marker_type=marker, **kwargs)
+        else:
+            frame.explore(color=color, **kwargs)
+
+        if "markers" in spec:
+            # marqueur au centroïde de chaque élément, le nom en popup
+            icon, marker_color = spec["markers"]
+            for point, nom in zip(df["centroid"], df["nom"]):
+                folium.Marker(
+                    location=[
+                        round(point.y, EXPORT_DECIMALS),
+                        round(point.x, EXPORT_DECIMALS),
+                    ],
+                    popup=nom,
+                    icon=folium.Icon(color=marker_color, icon=icon, prefix="fa"),
+                ).add_to(m)
+    progress("enregistrement")
     # create the export path
-    os.makedirs(EXPORT_PATH, exist_ok=True)
+    os.makedirs(os.path.dirname(map_path), exist_ok=True)
     # save the map
-    m.save(MAP_PATH)
-    print(f"Map created at {EXPORT_PATH}")
+    m.save(map_path)
+    print(f"Map created at {map_path}")
     return m
@@ -0,0 +1,177 @@
+import contextlib
+import json
+import os
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.urls import reverse
+
+from . import map_cache
+
+# l'état des tâches est écrit sur disque pour que tous les workers d'un même hôte puissent le lire
+JOBS_FOLDER = map_cache.DATA_FOLDER + "jobs/"
+# une tâche en cours sans nouvelle étape depuis ce délai (secondes) est considérée interrompue
+JOB_TIMEOUT = 30 * 60
+# les fichiers des tâches plus anciennes (secondes) sont supprimés
+JOB_MAX_AGE = 24 * 3600
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+_executor = None
+# tâches en cours dans ce processus, par clé de sélection : les soumissions identiques sont regroupées
+_running = {}
+_running_lock = threading.Lock()
+
+
+def get_executor():
+    """Pool de threads local qui exécute les générations de cartes, créé au premier usage"""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=getattr(settings, "MAP_JOB_WORKERS", 2),
+            thread_name_prefix="map-job",
+        )
+    return _executor
+
+
+def job_path(job_id):
+    return f"{JOBS_FOLDER}{job_id}.json"
+
+
+def read_job(job_id):
+    """État de la tâche job_id, ou None si elle n'existe pas
+
+    Une tâche en cours dont le processus a disparu, ou sans nouvelle étape depuis
+    JOB_TIMEOUT, est renvoyée en échec.
+    """
+    try:
+        with open(job_path(job_id)) as file:
+            job = json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    if job["status"] in (PENDING, RUNNING) and (
+        not process_alive(job.get("pid"))
+        or time.time() - job.get("updated", job["created"]) > JOB_TIMEOUT
+    ):
+        job["status"] = FAILED
+        job["error"] = "tâche interrompue"
+    return job
+
+
+def process_alive(pid):
+    """Le processus pid de cet hôte existe-t-il encore ?"""
+    if pid is None:
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def purge_jobs(max_age=JOB_MAX_AGE):
+    """Supprime les fichiers des tâches plus anciennes que max_age secondes"""
+    try:
+        entries = list(os.scandir(JOBS_FOLDER))
+    except FileNotFoundError:
+        return
+    limit = time.time() - max_age
+    for entry in entries:
+        # un autre processus a pu le supprimer entre-temps
+        with contextlib.suppress(FileNotFoundError):
+            if entry.stat().st_mtime < limit:
+                os.remove(entry.path)
+
+
+def write_job(job):
+    job["updated"] = time.time()
+    os.makedirs(JOBS_FOLDER, exist_ok=True)
+    # écriture atomique : un lecteur ne voit jamais un état à moitié écrit
+    tmp_path = f"{job_path(job['id'])}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(job, file)
+    os.replace(tmp_path, job_path(job["id"]))
+
+
+def submit(selection):
+    """Met en file la génération de la carte de cette sélection et renvoie l'identifiant de la tâche
+
+    Si une tâche pour la même sélection est déjà en cours, c'est son identifiant qui est renvoyé.
+    """
+    key = map_cache.selection_key(selection)
+    with _running_lock:
+        if key in _running:
+            return _running[key]
+        purge_jobs()
+        job = {
+            "id": uuid.uuid4().hex,
+            "pid": os.getpid(),
+            "selection": selection,
+            "status": PENDING,
+            "stages": [],
+            "created": time.time(),
+            "result": None,
+            "error": None,
+        }
+        write_job(job)
+        _running[key] = job["id"]
+
+    get_executor().submit(run_job, job)
+    return job["id"]
+
+
+def map_options(selection):
+    """Options de gen_maps fixées par les réglages (leur mode de rendu : map_cache.render_mode)"""
+    options = {}
+    if getattr(settings, "MAPS_ASSEMBLED_MAPS", False):
+        options["assemble"] = True
+    if getattr(settings, "MAPS_HEAT_TILES", False):
+        key = map_cache.selection_key(selection)
+        url = reverse("maps:heat_tile", kwargs={"key": key, "z": 0, "x": 0, "y": 0})
+        options["heat_tiles_url"] = url.replace("/0/0/0.png", "/{z}/{x}/{y}.png")
+    if getattr(settings, "MAPS_CLUSTER_POINTS", False):
+        url = reverse("maps:point_attributes", kwargs={"layer": "layer", "index": 0})
+        options["point_popups_url"] = url.replace("/layer/0", "/{layer}/")
+    return options
+
+
+def run_job(job):
+    def progress(stage):
+        job["stages"].append({"name": stage, "started": time.time()})
+        write_job(job)
+
+    job["status"] = RUNNING
+    write_job(job)
+    try:
+        # import ici : folium et geopandas ne sont chargés que pour générer une carte
+        from .gen_maps import gen_maps
+
+        options = map_options(job["selection"])
+        path = map_cache.get_or_generate(
+            job["selection"],
+            lambda map_path: gen_maps(
+                **job["selection"], map_path=map_path, progress=progress, **options
+            ),
+            map_cache.render_mode(options),
+        )
+    except Exception as error:
+        # détail dans les journaux du serveur, pas dans l'état lisible par le client
+        traceback.print_exc()
+        job["status"] = FAILED
+        job["error"] = f"échec de la génération ({type(error).__name__})"
+    else:
+        job["status"] = DONE
+        job["result"] = map_cache.map_key(path)
+    job["finished"] = time.time()
+    write_job(job)
+    with _running_lock:
+        _running.pop(map_cache.selection_key(job["selection"]), None)
@@ -0,0 +1,181 @@
+# Couches de chaleur et cases du formulaire qui les activent.
+# Module léger (numpy seulement) : utilisable par les vues sans charger gen_maps.
+import numpy as np
+
+from .map_cache import FLAGS
+
+# résolution H3 du calcul de la chaleur
+RESOLUTION = 9
+# résolutions plus grossières, agrégées depuis RESOLUTION (somme sur les cellules filles)
+COARSE_RESOLUTIONS = (7, 8)
+RESOLUTIONS = COARSE_RESOLUTIONS + (RESOLUTION,)
+# zoom web mercator à partir duquel chaque résolution est affichée : un hexagone y fait
+# au moins une dizaine de pixels de large (à la latitude de Lyon)
+RESOLUTION_ZOOMS = {7: 0, 8: 10, 9: 12}
+
+# registre des couches de chaleur, dans l'ordre des colonnes de la matrice de chaleur.
+# Chaque couche décrit :
+# - source : jeu de données (clé de gen_maps.DATASETS), datasets : autres jeux nécessaires ;
+# - columns : colonnes gardées (toutes si absent), filters : {colonne: valeur gardée} ;
+# - loader : nom d'une fonction de gen_maps, pour les couches qui ne se décrivent pas ainsi ;
+# - engine : moteur de calcul de la chaleur ("points", "lines" ou "stations"), coeff par défaut ;
+# - params : paramètres du moteur (ring_weights du moteur "stations" : poids de la chaleur
+#   de la gare à 0, 1, 2... anneaux de distance), valeurs JSON : ils entrent dans la clé du cache ;
+# - flags : cases du formulaire qui l'activent ;
+# - color : couleur sur la carte (clé de gen_maps.COLORS), None si la couche n'est pas dessinée ;
+# - label : type affiché dans les infobulles, popup_columns : colonnes des infobulles (toutes
+#   si absent), marker : (icône, couleur) font awesome des points (cercles si absent),
+#   markers : (icône, couleur) des marqueurs ajoutés au centroïde de chaque élément.
+LAYER_SPECS = {
+    "stationnement_velo": {
+        "source": "stationnement_velo",
+        # on filtre les stationnements seulement en projet
+        "filters": {"avancement": "Existant"},
+        "engine": "points",
+        "coeff": 1,
+        "flags": ["own_bike_used"],
+        "color": "velov",
+        "label": "stationnement vélo",
+        "popup_columns": ["nom", "adresse", "commune", "capacite"],
+    },
+    "velov": {
+        "source": "velov",
+        "columns": ["name", "address", "commune", "bike_stands", "geometry", "gid"],
+        # remove closed stations
+        "filters": {"status": "OPEN"},
+        "engine": "points",
+        "coeff": 1,
+        "flags": ["velov_used"],
+        "color": "velov",
+    },
+    "ac": {
+        "source": "amenagements_cyclables",
+        "engine": "lines",
+        "coeff": 0.5,
+        "flags": ["own_bike_used", "velov_used"],
+        "color": None,
+    },
+    "gares": {
+        "source": "gares",
+        # trafic voyageurs pour donner plus de poids aux grandes gares
+        "datasets": ["trafic_voyageurs_gares"],
+        "loader": "load_gares",
+        "engine": "stations",
+        "params": {"ring_weights": [1, 0.5]},
+        "coeff": 1,
+        "flags": ["trains_used"],
+        "color": "train_stations",
+        "markers": ("train", "gray"),
+    },
+    "points_access": {
+        "source": "points_arret",
+        "columns": ["nom", "desserte", "gid", "geometry"],
+        "engine": "points",
+        "coeff": 2,
+        "flags": ["public_transports_used"],
+        "color": "public_transports",
+        "label": "arrêt transports en commun",
+    },
+    "navette_fluv": {
+        "source": "navette_fluviale",
+        "columns": ["nom", "gid", "geometry"],
+        "engine": "stations",
+        "params": {"ring_weights": [1, 0.5]},
+        "coeff": 1,
+        "flags": ["river_boat_used"],
+        "color": "river_boats",
+        "marker": ("ferry", "darkblue"),
+    },
+    "taxis": {
+        "source": "stations_taxi",
+        "columns": ["nom", "gid", "geometry"],
+        "engine": "points",
+        "coeff": 1,
+        "flags": ["taxis_used"],
+        "color": "taxis",
+    },
+    "cars": {
+        "source": "cars",
+        "engine": "points",
+        "coeff": 1,
+        "flags": ["rhone_buses_used"],
+        "color": "buses",
+    },
+    "parkings": {
+        "source": "parkings",
+        "columns": ["nom", "commune", "reglementation", "gid", "geometry"],
+        "engine": "points",
+        "coeff": 1,
+        "flags": ["cars_used"],
+        "color": "parkings",
+        "label": "parking",
+    },
+    "autopartage": {
+        "source": "autopartage",
+        "columns": [
+            "nom",
+            "adresse",
+            "commune",
+            "typeautopartage",
+            "gid",
+            "geometry",
+        ],
+        "engine": "points",
+        "coeff": 1,
+        "flags": ["cars_used"],
+        "color": "autopartage",
+    },
+    "pr": {
+        "source": "parcs_relais",
+        "columns": ["nom", "capacite", "gid", "geometry"],
+        "engine": "points",
+        "coeff": 1,
+        "flags": ["cars_used"],
+        "color": "relai",
+    },
+    "pmr": {
+        "source": "pmr",
+        "columns": ["nom", "commune", "gid", "geometry"],
+        "engine": "points",
+        "coeff": 1,
+        "flags": ["pmr_used"],
+        "color": "pmr",
+        "label": "Stationnement PMR",
+        "popup_columns": ["commune", "nom"],
+    },
+}
+LAYERS = list(LAYER_SPECS)
+# coeff par défaut de chaque couche
+LAYER_COEFFS = {layer: spec["coeff"] for layer, spec in LAYER_SPECS.items()}
+
+# couches de chaleur activées par chaque case du formulaire
+FLAG_LAYERS = {
+    flag: [layer for layer, spec in LAYER_SPECS.items() if flag in spec["flags"]]
+    for flag in FLAGS
+}
+
+
+def selected_layers(**flags):
+    """Couches de chaleur des cases cochées, dans l'ordre de LAYERS (les autres clés sont ignorées)"""
+    layers = {layer for flag in FLAGS if flags.get(flag) for layer in FLAG_LAYERS[flag]}
+    return [layer for layer in LAYERS if layer in layers]
+
+
+def resolution_for_zoom(zoom):
+    """Résolution H3 affichée à ce niveau de zoom"""
+    return max(
+        resolution
+        for resolution, min_zoom in RESOLUTION_ZOOMS.items()
+        if zoom >= min_zoom
+    )
+
+
+def layer_weights(layers, coeffs=None):
+    """Vecteur des coeffs des couches sélectionnées (0 pour les autres), dans l'ordre de LAYERS
+
+    coeffs permet de remplacer les coeffs par défaut de LAYER_COEFFS.
+    """
+    coeffs = {**LAYER_COEFFS, **(coeffs or {})}
+    return np.array(
+        [coeffs[layer] if layer in layers else 0 for layer in LAYERS], dtype=np.float32
+    )
@@ -0,0 +1,54 @@
+import statistics
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+# chargement de l'application WSGI puis résolution des URLs, comme au premier appel d'un worker
+WSGI_IMPORT = (
+    "from datable_django_cartographie.wsgi import application; "
+    "from django.urls import resolve; resolve('/')"
+)
+MANAGE_CHECK = (
+    "import runpy, sys; sys.argv = ['manage.py', 'check']; "
+    "runpy.run_path('manage.py', run_name='__main__')"
+)
+# import du pipeline de cartes au démarrage, comme le faisait maps/views.py avant
+EAGER_PIPELINE = "import maps.gen_maps; "
+
+
+class Command(BaseCommand):
+    help = (
+        "Mesure le temps de démarrage (manage.py check et import WSGI), avec les imports "
+        "différés actuels et avec l'import du pipeline de cartes au démarrage"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--runs", type=int, default=5, help="nombre de mesures")
+
+    def measure(self, code, runs):
+        durations = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run(
+                [sys.executable, "-c", code],
+                cwd=settings.BASE_DIR,
+                check=True,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            durations.append(time.perf_counter() - start)
+        return statistics.median(durations)
+
+    def handle(self, *args, **options):
+        runs = options["runs"]
+        self.stdout.write(f"{'':<22} {'imports différés':>18} {'pipeline importé':>18}")
+        for label, code in [
+            ("manage.py check", MANAGE_CHECK),
+            ("import WSGI", WSGI_IMPORT),
+        ]:
+            lazy = self.measure(code, runs)
+            eager = self.measure(EAGER_PIPELINE + code, runs)
+            self.stdout.write(f"{label:<22} {lazy:>16.2f} s {eager:>16.2f} s")
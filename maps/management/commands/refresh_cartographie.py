@@ -0,0 +1,52 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from maps import snapshots
+from maps.layers import LAYERS
+
+
+class Command(BaseCommand):
+    help = (
+        "Télécharge le nouvel état des jeux de données et met à jour la chaleur publiée "
+        "des couches, en ne recalculant que les éléments qui ont changé"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "layers",
+            nargs="*",
+            help=f"couches à rafraîchir (toutes par défaut) : {', '.join(LAYERS)}",
+        )
+
+    def handle(self, *args, **options):
+        from maps import gen_maps
+
+        if snapshots.read_current():
+            # un instantané activé n'est plus modifié : le rafraîchissement en construit un nouveau
+            raise CommandError(
+                "des instantanés sont utilisés : lancer snapshot_cartographie"
+            )
+        layers = options["layers"] or LAYERS
+        unknown = [layer for layer in layers if layer not in LAYERS]
+        if unknown:
+            raise CommandError(f"couches inconnues : {', '.join(unknown)}")
+
+        start = time.perf_counter()
+        gen_maps.download_file(
+            gen_maps.DATASETS["communes"]["url"],
+            gen_maps.DATASETS["communes"]["filename"],
+        )
+        for layer in layers:
+            layer_start = time.perf_counter()
+            mode, added, removed, changed = gen_maps.refresh_layer(layer)
+            self.stdout.write(
+                f"{layer:<20} {mode:<8} +{added} -{removed} ~{changed}"
+                f" {time.perf_counter() - layer_start:8.2f} s"
+            )
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Rafraîchissement terminé en {time.perf_counter() - start:.2f} s"
+            )
+        )
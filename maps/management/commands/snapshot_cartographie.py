@@ -0,0 +1,42 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from maps import snapshots
+
+
+class Command(BaseCommand):
+    help = (
+        "Construit un nouvel instantané des données (sources, grille, chaleur des couches) "
+        "et l'active ; les processus qui servent les cartes basculent dessus une fois préchargé"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--list",
+            action="store_true",
+            help="liste les instantanés sans en construire",
+        )
+
+    def handle(self, *args, **options):
+        if options["list"]:
+            current = snapshots.read_current()
+            for name in snapshots.snapshots():
+                manifest = snapshots.read_manifest(name)
+                marker = "*" if name == current else " "
+                self.stdout.write(
+                    f"{marker} {name}  {manifest['created']}  {len(manifest['layers'])} couches"
+                )
+            return
+
+        from maps import gen_maps
+
+        start = time.perf_counter()
+        manifest = gen_maps.build_snapshot()
+        for layer, mode in manifest["refresh"].items():
+            self.stdout.write(f"{layer:<20} {mode}")
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Instantané {manifest['name']} activé en {time.perf_counter() - start:.2f} s"
+            )
+        )
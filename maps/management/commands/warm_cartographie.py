@@ -0,0 +1,94 @@
+import itertools
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.core.management.base import BaseCommand
+
+from maps import jobs, map_cache
+
+
+def render_selection(selection, options):
+    """Génère (si besoin) la carte d'une sélection avec les options des réglages (jobs.map_options),
+    exécutée dans un processus du pool"""
+    from maps.gen_maps import gen_maps
+
+    start = time.perf_counter()
+    map_cache.get_or_generate(
+        selection,
+        lambda map_path: gen_maps(**selection, map_path=map_path, **options),
+        map_cache.render_mode(options),
+    )
+    return selection, time.perf_counter() - start
+
+
+class Command(BaseCommand):
+    help = "Télécharge tous les jeux de données et construit la grille et la chaleur de chaque couche"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--render",
+            action="store_true",
+            help="génère aussi la carte de chacune des 512 combinaisons du formulaire",
+        )
+        parser.add_argument(
+            "--jobs",
+            type=int,
+            default=1,
+            help="nombre de processus pour générer les cartes (avec --render)",
+        )
+
+    def timed(self, label, function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        self.stdout.write(f"{label:<40} {time.perf_counter() - start:8.2f} s")
+        return result
+
+    def handle(self, *args, **options):
+        from maps import gen_maps
+
+        start = time.perf_counter()
+
+        self.stdout.write(self.style.MIGRATE_HEADING("Téléchargements"))
+        for name, source in gen_maps.DATASETS.items():
+            ok = self.timed(
+                name, gen_maps.download_file, source["url"], source["filename"]
+            )
+            if not ok:
+                self.stderr.write(
+                    self.style.ERROR(f"échec du téléchargement de {name}")
+                )
+
+        self.stdout.write(self.style.MIGRATE_HEADING("Grille"))
+        hex_map = self.timed(
+            f"grille H3 (résolution {gen_maps.RESOLUTION})", gen_maps.create_hex_map
+        )
+
+        self.stdout.write(self.style.MIGRATE_HEADING("Chaleur des couches"))
+        for layer, loader in gen_maps.LOADERS.items():
+            df = self.timed(f"{layer} : chargement", loader)
+            self.timed(f"{layer} : chaleur", gen_maps.heat_matrix, hex_map, {layer: df})
+
+        if options["render"]:
+            self.stdout.write(self.style.MIGRATE_HEADING("Cartes"))
+            selections = [
+                dict(zip(map_cache.FLAGS, values))
+                for values in itertools.product(
+                    [False, True], repeat=len(map_cache.FLAGS)
+                )
+            ]
+            with ProcessPoolExecutor(max_workers=options["jobs"]) as executor:
+                futures = [
+                    executor.submit(render_selection, s, jobs.map_options(s))
+                    for s in selections
+                ]
+                for future in as_completed(futures):
+                    selection, duration = future.result()
+                    self.stdout.write(
+                        f"carte {map_cache.selection_key(selection):<34} {duration:8.2f} s"
+                    )
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Préchauffage terminé en {time.perf_counter() - start:.2f} s"
+            )
+        )
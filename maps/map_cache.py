@@ -0,0 +1,289 @@
+import contextlib
+import gzip
+import hashlib
+import os
+import tempfile
+import threading
+
+# pas de verrou de fichier hors POSIX, seul le verrou entre threads s'applique
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# brotli est optionnel : sans lui, seule la variante gzip des cartes est écrite
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# même dossier que gen_maps.DATA_FOLDER : ce module ne doit pas importer gen_maps (folium, geopandas...)
+DATA_FOLDER = "data/"
+MAP_CACHE_FOLDER = DATA_FOLDER + "maps/"
+LOCKS_FOLDER = MAP_CACHE_FOLDER + "locks/"
+# taille maximale du cache de cartes sur disque, les moins récemment servies sont supprimées au-delà
+MAP_CACHE_MAX_BYTES = 500 * 1024 * 1024
+
+# variantes précompressées écrites à côté de chaque carte : (Content-Encoding, suffixe),
+# dans l'ordre de préférence
+ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+BROTLI_QUALITY = 9
+
+# cases du formulaire, dans l'ordre de la clé de sélection
+FLAGS = [
+    "own_bike_used",
+    "velov_used",
+    "trains_used",
+    "cars_used",
+    "rhone_buses_used",
+    "public_transports_used",
+    "taxis_used",
+    "river_boat_used",
+    "pmr_used",
+]
+
+# options de gen_maps qui changent la page générée, et leur lettre dans le mode de rendu
+RENDER_OPTIONS = {"assemble": "a", "heat_tiles_url": "t", "point_popups_url": "c"}
+
+
+def selection(data):
+    """Sélection normalisée {case: bool, "communes": [codes INSEE triés]} à partir des données du formulaire"""
+    return {
+        **{flag: bool(data.get(flag)) for flag in FLAGS},
+        "communes": sorted(data.get("communes") or []),
+    }
+
+
+def selection_key(selection):
+    """Clé de sélection : une chaîne de 0/1 dans l'ordre de FLAGS, par exemple "010001000",
+    suivie des codes INSEE des communes s'il y en a : "010001000-69123_69266" """
+    key = "".join("1" if selection[flag] else "0" for flag in FLAGS)
+    communes = selection.get("communes")
+    return f"{key}-{'_'.join(communes)}" if communes else key
+
+
+def file_key(key):
+    """Clé de sélection utilisable dans un nom de fichier : les codes des communes, dont la liste
+    dépasserait vite les 255 octets d'un nom de fichier, y sont remplacés par une empreinte
+    courte, par exemple "010001000-3f2a9b1d0e4c" ; la clé lisible reste celle des url"""
+    flags, _, codes = key.partition("-")
+    if not codes:
+        return flags
+    return f"{flags}-{hashlib.sha256(codes.encode()).hexdigest()[:12]}"
+
+
+def key_selection(key):
+    """Sélection d'une clé de sélection, ou None si la clé est invalide"""
+    flags, _, codes = key.partition("-")
+    if len(flags) != len(FLAGS) or set(flags) - {"0", "1"}:
+        return None
+    communes = codes.split("_") if codes else []
+    if any(len(code) != 5 or not code.isalnum() for code in communes):
+        return None
+    return {
+        **{flag: used == "1" for flag, used in zip(FLAGS, flags)},
+        "communes": communes,
+    }
+
+
+def data_version():
+    """Version des données : nom de l'instantané servi, sinon empreinte des fichiers téléchargés dans DATA_FOLDER"""
+    # import ici : snapshots importe ce module
+    from . import snapshots
+
+    name = snapshots.current_name()
+    if name:
+        return name
+    digest = hashlib.sha256()
+    try:
+        entries = sorted(
+            (entry for entry in os.scandir(DATA_FOLDER) if entry.is_file()),
+            key=lambda entry: entry.name,
+        )
+    except FileNotFoundError:
+        entries = []
+    for entry in entries:
+        stat = entry.stat()
+        digest.update(f"{entry.name}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()[:12]
+
+
+def render_mode(options):
+    """Mode de rendu d'une carte d'après les options de gen_maps qui changent la page générée :
+    "" pour le rendu par défaut, sinon par exemple "-mat" (carte assemblée, tuiles de chaleur)
+    ou "-mz14" (géométries exportées pour le zoom 14)"""
+    mode = "".join(
+        letter for option, letter in RENDER_OPTIONS.items() if options.get(option)
+    )
+    if options.get("export_zoom") is not None:
+        mode += f"z{options['export_zoom']}"
+    return f"-m{mode}" if mode else ""
+
+
+def map_path(selection, mode=""):
+    """Chemin de la carte en cache pour cette sélection, ce mode de rendu et la version actuelle des données"""
+    key = file_key(selection_key(selection))
+    return f"{MAP_CACHE_FOLDER}{key}{mode}-{data_version()}.html"
+
+
+def map_file(key):
+    """Chemin de la carte en cache de clé key ("<file_key><mode>-<version>"), ou None si elle n'existe pas"""
+    path = f"{MAP_CACHE_FOLDER}{key}.html"
+    try:
+        os.utime(path)
+    except OSError:
+        # absente, ou clé trop longue pour un nom de fichier
+        return None
+    return path
+
+
+def map_key(path):
+    """Clé "<file_key><mode>-<version>" d'une carte en cache, à partir de son chemin"""
+    return os.path.basename(path).removesuffix(".html")
+
+
+def cached_map(selection, mode=""):
+    """Chemin de la carte en cache pour cette sélection, ou None si elle n'a pas encore été générée"""
+    path = map_path(selection, mode)
+    try:
+        # on date l'accès pour l'éviction LRU
+        os.utime(path)
+    except FileNotFoundError:
+        return None
+    return path
+
+
+def new_map_path():
+    """Fichier temporaire, dans le dossier du cache, où générer une carte avant de la ranger"""
+    os.makedirs(MAP_CACHE_FOLDER, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=MAP_CACHE_FOLDER)
+    os.close(fd)
+    return tmp_path
+
+
+def compress_map(tmp_path, path):
+    """Écrit à côté de path les variantes compressées de la carte générée dans tmp_path"""
+    with open(tmp_path, "rb") as file:
+        content = file.read()
+    variants = {".gz": gzip.compress(content, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants[".br"] = brotli.compress(content, quality=BROTLI_QUALITY)
+    for suffix, compressed in variants.items():
+        with open(f"{tmp_path}{suffix}", "wb") as file:
+            file.write(compressed)
+        os.replace(f"{tmp_path}{suffix}", f"{path}{suffix}")
+
+
+def store_map(tmp_path, selection, mode=""):
+    """Range la carte générée dans tmp_path dans le cache, puis applique la limite de taille"""
+    path = map_path(selection, mode)
+    # variantes d'abord : une carte servie a toujours les siennes
+    compress_map(tmp_path, path)
+    os.replace(tmp_path, path)
+    evict()
+    return path
+
+
+def accepted_encodings(accept_encoding):
+    """Encodages acceptés par un en-tête Accept-Encoding : ceux dont la qualité q n'est pas nulle"""
+    accepted = set()
+    for value in accept_encoding.split(","):
+        encoding, *parameters = value.split(";")
+        quality = 1.0
+        for parameter in parameters:
+            name, _, number = parameter.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(number)
+                except ValueError:
+                    # qualité illisible : encodage considéré comme refusé
+                    quality = 0.0
+        if quality > 0:
+            accepted.add(encoding.strip().lower())
+    return accepted
+
+
+def encoded_variant(path, accept_encoding):
+    """(chemin, Content-Encoding) de la meilleure variante de path acceptée par le client
+
+    accept_encoding est l'en-tête Accept-Encoding de la requête ; renvoie (path, None) si
+    aucune variante compressée n'est acceptée ou n'existe.
+    """
+    accepted = accepted_encodings(accept_encoding)
+    for encoding, suffix in ENCODINGS:
+        if encoding in accepted and os.path.exists(f"{path}{suffix}"):
+            return f"{path}{suffix}", encoding
+    return path, None
+
+
+def evict(max_bytes=MAP_CACHE_MAX_BYTES, folder=MAP_CACHE_FOLDER, suffix=".html"):
+    """Supprime les fichiers suffix de folder les moins récemment servis jusqu'à repasser sous max_bytes"""
+    # les fichiers .tmp sont des cartes (ou des tuiles) en cours de génération
+    entries = [entry for entry in os.scandir(folder) if entry.name.endswith(suffix)]
+    entries.sort(key=lambda entry: entry.stat().st_mtime)
+    # taille de chaque fichier avec ses variantes compressées, supprimées avec lui
+    sizes = {
+        entry.path: entry.stat().st_size
+        + sum(
+            os.path.getsize(f"{entry.path}{suffix}")
+            for _, suffix in ENCODINGS
+            if os.path.exists(f"{entry.path}{suffix}")
+        )
+        for entry in entries
+    }
+    total = sum(sizes.values())
+    for entry in entries:
+        if total <= max_bytes:
+            break
+        total -= sizes[entry.path]
+        for path in [entry.path] + [f"{entry.path}{suffix}" for _, suffix in ENCODINGS]:
+            # un autre processus a pu le supprimer entre-temps
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+
+
+_locks_guard = threading.Lock()
+_locks = {}
+
+
+@contextlib.contextmanager
+def selection_lock(selection):
+    """Verrou exclusif sur une sélection, entre les threads du processus et entre les processus de l'hôte"""
+    key = file_key(selection_key(selection))
+    with _locks_guard:
+        thread_lock = _locks.setdefault(key, threading.Lock())
+    with thread_lock:
+        if fcntl is None:
+            yield
+            return
+        os.makedirs(LOCKS_FOLDER, exist_ok=True)
+        with open(f"{LOCKS_FOLDER}{key}.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def get_or_generate(selection, generate, mode=""):
+    """Chemin de la carte de cette sélection, générée par generate(chemin) si elle n'est pas en cache
+
+    Les requêtes identiques simultanées sont regroupées : la première génère la carte,
+    les autres attendent sur le verrou de la sélection puis servent la même carte.
+    mode (render_mode) distingue les cartes d'une même sélection générées avec d'autres options.
+    """
+    path = cached_map(selection, mode)
+    if path is not None:
+        return path
+    with selection_lock(selection):
+        # une requête identique a pu générer la carte pendant qu'on attendait le verrou
+        path = cached_map(selection, mode)
+        if path is None:
+            tmp_path = new_map_path()
+            try:
+                generate(tmp_path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+            path = store_map(tmp_path, selection, mode)
+    return path
@@ -0,0 +1,210 @@
+# Score d'accessibilité de points (lat, lon) sans générer de carte : conversion vectorisée des
+# points en cellules H3 puis recherche dichotomique dans la grille triée du magasin partagé.
+# Les résolutions grossières sont agrégées depuis la grille et la chaleur de RESOLUTION.
+# Ce module n'importe que numpy et h3, gen_maps n'est chargé que si la chaleur manque.
+import hashlib
+import json
+import os
+
+import h3
+import numpy as np
+
+from . import store
+from .layers import LAYERS, RESOLUTION, layer_weights
+
+_latlng_to_cell = np.frompyfunc(h3.api.basic_int.latlng_to_cell, 3, 1)
+_cell_to_parent = np.frompyfunc(h3.api.basic_int.cell_to_parent, 2, 1)
+_cell_to_center_child = np.frompyfunc(h3.api.basic_int.cell_to_center_child, 2, 1)
+
+
+def points_to_cells(lats, lons, resolution=RESOLUTION):
+    """Identifiants H3 (uint64) des points"""
+    if len(lats) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    return _latlng_to_cell(lats, lons, resolution).astype(np.uint64)
+
+
+def prepare(layers, resolution=RESOLUTION):
+    """Publie la grille et la chaleur des couches si elles manquent encore au magasin partagé"""
+    if resolution != RESOLUTION:
+        prepare(layers, RESOLUTION)
+        if rolled_up_stale(layers, resolution):
+            roll_up(resolution)
+        return
+
+    grid_ready = os.path.exists(f"{store.grid_folder(resolution)}communes.json")
+    matrix = store.open_heat_matrix(resolution) if grid_ready else None
+    published = store.heat_layers(resolution)
+    if (
+        not grid_ready
+        or (matrix is not None and len(matrix) != len(store.open_grid(resolution)[0]))
+        or any(layer not in published for layer in layers)
+    ):
+        # import ici : geopandas et folium ne sont chargés que pour le premier calcul
+        from .gen_maps import publish_heat
+
+        publish_heat(layers, resolution)
+
+
+def coarse_grid_stale(resolution):
+    """La grille de cette résolution grossière manque-t-elle ou précède-t-elle la grille fine ?"""
+    folder = store.grid_folder(resolution)
+    try:
+        return os.stat(f"{folder}cells.npy").st_mtime_ns < os.stat(
+            f"{store.grid_folder(RESOLUTION)}cells.npy"
+        ).st_mtime_ns or not os.path.exists(f"{folder}children.npy")
+    except FileNotFoundError:
+        return True
+
+
+def rolled_up_stale(layers, resolution):
+    """La grille ou la chaleur de ces couches à cette résolution grossière sont-elles à refaire ?"""
+    if coarse_grid_stale(resolution):
+        return True
+    published, fine = store.heat_layers(resolution), store.heat_layers(RESOLUTION)
+    return any(published.get(layer) != fine.get(layer) for layer in layers)
+
+
+def roll_up(resolution):
+    """Agrège la grille et la chaleur publiées à RESOLUTION vers une résolution plus grossière
+
+    Chaque cellule parente reçoit la somme de la chaleur de ses cellules filles de la grille,
+    et la commune de sa fille centrale (de sa première fille si la centrale est hors grille).
+    """
+    fine_cells, fine_communes = store.open_grid(RESOLUTION)
+    published = store.heat_layers(RESOLUTION)
+    matrix = store.open_heat_matrix(RESOLUTION)
+
+    parents = _cell_to_parent(fine_cells.tolist(), resolution).astype(np.uint64)
+    cells, first, inverse = np.unique(parents, return_index=True, return_inverse=True)
+    centers = _cell_to_center_child(cells.tolist(), RESOLUTION).astype(np.uint64)
+    index = np.searchsorted(fine_cells, centers)
+    index[index == len(fine_cells)] = 0
+    communes = np.where(
+        fine_cells[index] == centers, fine_communes[index], fine_communes[first]
+    )
+    # grille réécrite seulement si elle a changé : sa version sert d'ETag aux clients
+    if coarse_grid_stale(resolution):
+        with store.write_lock("grid"):
+            if coarse_grid_stale(resolution):
+                store.write_grid(
+                    resolution,
+                    cells,
+                    communes.astype(np.int16),
+                    store.grid_communes(RESOLUTION),
+                    np.bincount(inverse, minlength=len(cells)).astype(np.int32),
+                )
+
+    if matrix is None or len(matrix) != len(fine_cells):
+        matrix, published = np.zeros((len(fine_cells), 0), dtype=np.float32), {}
+    # somme des colonnes par cellule parente
+    coarse = np.zeros((len(cells), len(LAYERS)), dtype=np.float32)
+    for column in range(matrix.shape[1]):
+        coarse[:, column] = np.bincount(
+            inverse, weights=matrix[:, column], minlength=len(cells)
+        )
+    store.write_heat_matrix(resolution, coarse, published)
+    print(f"Grille H3 de résolution {resolution} agrégée : {len(cells)} hexagones")
+
+
+def score(lats, lons, layers, coeffs=None, resolution=RESOLUTION):
+    """Cellule H3, commune et chaleur de chaque point pour ces couches de chaleur
+
+    Renvoie {"cell", "nom", "heat"}, des listes alignées sur les points. nom et heat valent
+    None pour les points hors de la grille des communes. Aux résolutions grossières, heat est
+    la somme de la chaleur des cellules filles (heat_vector en donne la moyenne).
+    """
+    prepare(layers, resolution)
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    cells = points_to_cells(lats, lons, resolution)
+
+    grid_cells, grid_communes = store.open_grid(resolution)
+    index = np.searchsorted(grid_cells, cells)
+    index[index == len(grid_cells)] = 0
+    found = (
+        grid_cells[index] == cells if len(grid_cells) else np.zeros(len(cells), bool)
+    )
+    index = index[found]
+
+    names = np.full(len(cells), None, dtype=object)
+    names[found] = np.array(store.grid_communes(resolution)["nom"], dtype=object)[
+        grid_communes[index]
+    ]
+    heat = np.full(len(cells), None, dtype=object)
+    matrix = store.open_heat_matrix(resolution)
+    if matrix is None:
+        heat[found] = 0.0
+    else:
+        heat[found] = (matrix[index] @ layer_weights(layers, coeffs)).tolist()
+
+    return {
+        "cell": [f"{cell:x}" for cell in cells.tolist()],
+        "nom": names.tolist(),
+        "heat": heat.tolist(),
+    }
+
+
+def commune_codes(values, resolution=RESOLUTION):
+    """Codes INSEE triés des communes désignées par leur code INSEE ou leur nom
+
+    La casse des noms est ignorée ; ValueError si une commune n'est pas dans la grille.
+    """
+    prepare([], resolution)
+    communes = store.grid_communes(resolution)
+    codes = {code.casefold(): code for code in communes["insee"]}
+    codes.update(
+        {nom.casefold(): code for nom, code in zip(communes["nom"], communes["insee"])}
+    )
+    values = [value.strip() for value in values]
+    unknown = [value for value in values if value.casefold() not in codes]
+    if unknown:
+        raise ValueError(f"communes inconnues : {', '.join(unknown)}")
+    return sorted({codes[value.casefold()] for value in values})
+
+
+def commune_mask(communes, resolution=RESOLUTION):
+    """Masque des cellules de la grille situées dans ces communes (codes INSEE)"""
+    grid_communes = store.open_grid(resolution)[1]
+    insee = np.array(store.grid_communes(resolution)["insee"])
+    return np.isin(insee[grid_communes], communes)
+
+
+def grid_version(resolution=RESOLUTION):
+    """Version de la grille publiée, change à chaque recalcul de la grille"""
+    return str(os.stat(f"{store.grid_folder(resolution)}cells.npy").st_mtime_ns)
+
+
+def grid_cells(resolution=RESOLUTION):
+    """Identifiants H3 (chaînes) des cellules de la grille, dans l'ordre des vecteurs de chaleur"""
+    prepare([], resolution)
+    return [f"{cell:x}" for cell in store.open_grid(resolution)[0].tolist()]
+
+
+def heat_version(layers, resolution=RESOLUTION):
+    """Version de la chaleur de ces couches : grille et clés de cache des colonnes publiées"""
+    published = store.heat_layers(resolution)
+    versions = [grid_version(resolution)] + [published.get(layer) for layer in layers]
+    return hashlib.sha256(json.dumps(versions).encode()).hexdigest()[:16]
+
+
+def heat_vector(layers, coeffs=None, resolution=RESOLUTION):
+    """Chaleur affichée de chaque cellule de la grille (float32 petit-boutiste), dans l'ordre de grid_cells
+
+    Aux résolutions grossières, c'est la chaleur moyenne de leurs cellules filles : les
+    couleurs gardent la même échelle (heat_scale) à tous les zooms.
+    """
+    prepare(layers, resolution)
+    matrix = store.open_heat_matrix(resolution)
+    if matrix is None:
+        return np.zeros(len(store.open_grid(resolution)[0]), dtype="<f4")
+    heat = matrix @ layer_weights(layers, coeffs)
+    if resolution != RESOLUTION:
+        heat = heat / store.grid_children(resolution)
+    return heat.astype("<f4")
+
+
+def heat_scale(layers, coeffs=None):
+    """Chaleur maximale des cellules de RESOLUTION : haut de l'échelle de couleurs à tous les zooms"""
+    heat = heat_vector(layers, coeffs)
+    return float(heat.max()) if len(heat) else 0.0
@@ -0,0 +1,169 @@
+# Instantanés versionnés des données : chaque dossier SNAPSHOTS_FOLDER/<nom>/ contient les fichiers
+# téléchargés (sources/), les fichiers ingérés (parquet/), la grille (grid/), le magasin de
+# chaleur (store/) et un manifest.json. Le fichier CURRENT désigne l'instantané servi, il est
+# remplacé de façon atomique ; un instantané n'est plus modifié une fois activé.
+# Chaque processus surveille CURRENT dans un thread et précharge le nouvel instantané avant
+# de basculer dessus. Sans instantané, les données sont servies depuis DATA_FOLDER.
+import json
+import os
+import shutil
+import threading
+import time
+
+from .map_cache import DATA_FOLDER
+
+SNAPSHOTS_FOLDER = DATA_FOLDER + "snapshots/"
+CURRENT_PATH = SNAPSHOTS_FOLDER + "CURRENT"
+# intervalle de vérification de CURRENT par les processus qui servent les données
+SNAPSHOT_POLL_SECONDS = 30
+# instantanés gardés (en plus de l'actif) : les processus pas encore basculés les lisent encore
+SNAPSHOTS_KEPT = 2
+
+# instantané servi par ce processus ; pinned : dossier imposé par set_root (construction)
+_state = {"name": None, "folder": None, "pinned": False}
+_lock = threading.Lock()
+_watcher = None
+
+
+def snapshot_folder(name):
+    return f"{SNAPSHOTS_FOLDER}{name}/"
+
+
+def read_current():
+    """Nom de l'instantané désigné par CURRENT, ou None"""
+    try:
+        with open(CURRENT_PATH) as file:
+            return file.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def root():
+    """Dossier des données servies par ce processus (se termine par /)"""
+    if _state["folder"] is None or (_watcher is None and not _state["pinned"]):
+        with _lock:
+            if _state["folder"] is None:
+                name = read_current()
+                _state["name"] = name
+                _state["folder"] = snapshot_folder(name) if name else DATA_FOLDER
+            if _watcher is None and not _state["pinned"]:
+                start_watcher()
+    return _state["folder"]
+
+
+def current_name():
+    """Nom de l'instantané servi par ce processus, None sans instantané ou pendant une construction"""
+    root()
+    return _state["name"]
+
+
+def set_root(folder):
+    """Impose le dossier des données de ce processus, pour construire un instantané"""
+    with _lock:
+        _state.update(name=None, folder=folder, pinned=True)
+
+
+def release():
+    """Annule set_root : le dossier servi redevient celui désigné par CURRENT"""
+    with _lock:
+        _state.update(name=None, folder=None, pinned=False)
+
+
+def start_watcher():
+    global _watcher
+    _watcher = threading.Thread(target=watch, name="snapshots", daemon=True)
+    _watcher.start()
+
+
+def watch():
+    """Bascule sur le nouvel instantané désigné par CURRENT, une fois préchargé"""
+    global _watcher
+    while not _state["pinned"]:
+        time.sleep(SNAPSHOT_POLL_SECONDS)
+        name = read_current()
+        if name is None or name == _state["name"] or _state["pinned"]:
+            continue
+        folder = snapshot_folder(name)
+        try:
+            preload(folder)
+        except OSError as error:
+            print(f"Préchargement de l'instantané {name} impossible : {error}")
+            continue
+        with _lock:
+            if _state["pinned"]:
+                break
+            old_folder = _state["folder"]
+            _state.update(name=name, folder=folder)
+        print(f"Instantané {name} activé")
+        from . import store
+
+        store.forget(old_folder)
+    # dossier imposé par set_root : plus rien à surveiller jusqu'à release()
+    _watcher = None
+
+
+def preload(folder):
+    """Ouvre et lit les tableaux et fichiers JSON d'un instantané : ils sont en cache à la bascule"""
+    from . import store
+
+    for dirpath, _, filenames in os.walk(folder):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if filename.endswith(".npy"):
+                # lecture de toutes les pages : elles sont dans le cache du système à la bascule
+                store.open_array(path).view("u1").sum()
+            elif filename.endswith(".json"):
+                store.open_json(path)
+
+
+def read_manifest(name):
+    with open(f"{snapshot_folder(name)}manifest.json") as file:
+        return json.load(file)
+
+
+def snapshots():
+    """Noms des instantanés complets, du plus ancien au plus récent"""
+    try:
+        entries = os.scandir(SNAPSHOTS_FOLDER)
+    except FileNotFoundError:
+        return []
+    return sorted(
+        entry.name
+        for entry in entries
+        if entry.is_dir() and os.path.exists(f"{entry.path}/manifest.json")
+    )
+
+
+def link_file(path, target):
+    """Copie path en target par lien physique (sans dupliquer les données) si possible"""
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+        os.link(path, target)
+    except OSError:
+        shutil.copy2(path, target)
+
+
+def activate(name):
+    """Désigne l'instantané name comme instantané servi (remplacement atomique de CURRENT)"""
+    tmp_path = f"{CURRENT_PATH}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as file:
+        file.write(name)
+    os.replace(tmp_path, CURRENT_PATH)
+
+
+def prune(kept=SNAPSHOTS_KEPT):
+    """Supprime les anciens instantanés, sauf l'actif et les kept plus récents"""
+    current = read_current()
+    names = [name for name in snapshots() if name != current]
+    for name in names[: max(len(names) - kept, 0)]:
+        shutil.rmtree(snapshot_folder(name), ignore_errors=True)
+
+
+def _after_fork():
+    global _watcher
+    # les threads ne survivent pas au fork (gunicorn --preload) : surveillant relancé au besoin
+    _watcher = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
@@ -0,0 +1,271 @@
+# Magasin de données partagé entre les workers : grille, matrice de chaleur et coordonnées
+# des points sont des fichiers .npy ouverts en mémoire mappée, le cache de pages du système
+# en garde une seule copie pour tous les processus de l'hôte.
+# Les fichiers sont rangés dans le dossier des données servies (snapshots.root()).
+# Ce module n'importe que numpy : il ne charge ni geopandas ni folium.
+import contextlib
+import json
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+
+from . import snapshots
+
+try:
+    import fcntl
+except ImportError:  # pas de verrou de fichier hors POSIX
+    fcntl = None
+
+_manifest = {"path": None, "mtime": None, "content": {}}
+_arrays = {}
+_json = {}
+# verrous des écritures : "store" pour le magasin, "grid" pour les grilles
+_write_locks = {"store": threading.Lock(), "grid": threading.Lock()}
+
+
+def grid_folder(resolution):
+    return f"{snapshots.root()}grid/r{resolution}/"
+
+
+def store_folder():
+    return f"{snapshots.root()}store/"
+
+
+def manifest_path():
+    return f"{store_folder()}manifest.json"
+
+
+def read_manifest():
+    """Manifeste du magasin, relu seulement quand le fichier a changé"""
+    path = manifest_path()
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return {}
+    if (path, mtime) != (_manifest["path"], _manifest["mtime"]):
+        with open(path) as file:
+            content = json.load(file)
+        _manifest.update(path=path, mtime=mtime, content=content)
+    return _manifest["content"]
+
+
+def open_array(path):
+    """Tableau .npy en lecture seule et mémoire mappée, rouvert s'il a été remplacé"""
+    mtime = os.stat(path).st_mtime_ns
+    cached = _arrays.get(path)
+    if cached is None or cached[0] != mtime:
+        cached = _arrays[path] = (mtime, np.load(path, mmap_mode="r"))
+    return cached[1]
+
+
+def write_array(path, array):
+    """Écrit un tableau .npy de façon atomique : les lecteurs gardent l'ancienne version jusqu'au renommage"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as file:
+        np.save(file, array)
+    os.replace(tmp_path, path)
+
+
+@contextlib.contextmanager
+def write_lock(name="store"):
+    """Verrou des écritures dans le magasin (name="grid" : dans les grilles), entre threads et
+    entre processus ; il n'est pas réentrant
+    """
+    with _write_locks[name]:
+        if fcntl is None:
+            yield
+            return
+        os.makedirs(store_folder(), exist_ok=True)
+        lock_path = (
+            f"{store_folder()}.lock"
+            if name == "store"
+            else f"{store_folder()}.{name}.lock"
+        )
+        with open(lock_path, "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def update_manifest(section, name, value):
+    """Enregistre manifest[section][name] = value, ou remplace la section par value si name est None
+
+    À appeler sous write_lock.
+    """
+    _manifest["mtime"] = None
+    manifest = read_manifest()
+    if name is None:
+        manifest[section] = value or {}
+    else:
+        manifest.setdefault(section, {})[name] = value
+    path = manifest_path()
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(manifest, file, indent=1)
+    os.replace(tmp_path, path)
+
+
+def heat_matrix_path(resolution):
+    return f"{store_folder()}r{resolution}/heat_matrix.npy"
+
+
+def heat_layers(resolution):
+    """{couche: clé du cache de chaleur} des colonnes remplies de la matrice de chaleur"""
+    return read_manifest().get(f"heat_r{resolution}", {})
+
+
+def open_heat_matrix(resolution):
+    """Matrice (n_hex × n_couches) de la chaleur des couches, en mémoire mappée, ou None"""
+    try:
+        return open_array(heat_matrix_path(resolution))
+    except FileNotFoundError:
+        return None
+
+
+def write_heat_column(resolution, column, n_layers, layer, heat, key):
+    """Remplit la colonne column (couche layer) de la matrice de chaleur partagée"""
+    with write_lock():
+        path = heat_matrix_path(resolution)
+        try:
+            matrix = np.load(path)
+        except FileNotFoundError:
+            matrix = None
+        if matrix is None or matrix.shape != (len(heat), n_layers):
+            # nouvelle grille : les colonnes déjà publiées ne sont plus valables
+            matrix = np.zeros((len(heat), n_layers), dtype=np.float32)
+            update_manifest(f"heat_r{resolution}", None, None)
+        matrix[:, column] = heat
+        write_array(path, matrix)
+        update_manifest(f"heat_r{resolution}", layer, key)
+
+
+def write_heat_matrix(resolution, matrix, keys):
+    """Remplace toute la matrice de chaleur d'une résolution, keys : {couche: clé du cache de chaleur}"""
+    with write_lock():
+        write_array(heat_matrix_path(resolution), matrix)
+        update_manifest(f"heat_r{resolution}", None, keys)
+
+
+def points_path(layer):
+    return f"{store_folder()}points/{layer}.npy"
+
+
+def open_points(layer):
+    """Coordonnées (lon, lat) et gid des points d'une couche, en mémoire mappée, ou None"""
+    try:
+        return open_array(points_path(layer))
+    except FileNotFoundError:
+        return None
+
+
+def write_points(layer, points, key):
+    """Enregistre les points d'une couche : tableau structuré lon, lat, gid aligné sur le jeu de données"""
+    with write_lock():
+        write_array(points_path(layer), points)
+        update_manifest("points", layer, key)
+
+
+def open_grid(resolution):
+    """Identifiants H3 (uint64) et codes commune (int16) de la grille, en mémoire mappée"""
+    folder = grid_folder(resolution)
+    return open_array(f"{folder}cells.npy"), open_array(f"{folder}communes.npy")
+
+
+def write_grid(resolution, cells, codes, communes, children=None):
+    """Enregistre la grille d'une résolution : cellules triées, code commune de chaque cellule
+    et {"nom": [...], "insee": [...]} des communes ; children : nombre de cellules fines
+    agrégées dans chaque cellule d'une grille grossière
+
+    La grille est écrite dans un nouveau dossier r{resolution}.{version}/, puis le lien
+    symbolique r{resolution} est remplacé de façon atomique : les lecteurs voient l'ancienne
+    ou la nouvelle grille, jamais un dossier absent ou à moitié écrit. La version précédente
+    est gardée pour les lecteurs en cours, les plus anciennes sont supprimées.
+    À appeler sous write_lock("grid"), après avoir vérifié que la grille est toujours à refaire.
+    """
+    link = grid_folder(resolution)[:-1]
+    parent, prefix = os.path.dirname(link), f"r{resolution}."
+    version = f"{prefix}{time.time_ns()}.{os.getpid()}"
+    folder = f"{parent}/{version}/"
+    os.makedirs(folder)
+    np.save(f"{folder}cells.npy", cells)
+    np.save(f"{folder}communes.npy", codes)
+    if children is not None:
+        np.save(f"{folder}children.npy", children)
+    with open(f"{folder}communes.json", "w") as file:
+        json.dump(communes, file)
+
+    previous = os.readlink(link) if os.path.islink(link) else None
+    if previous is None and os.path.isdir(link):
+        # grille d'avant les versions : renommée une fois en version, puis remplacée par le lien
+        previous = f"{prefix}0.legacy"
+        os.replace(link, f"{parent}/{previous}")
+    # lien relatif : il reste valable dans la copie d'un instantané
+    tmp_link = f"{link}.{os.getpid()}.{threading.get_ident()}.tmp"
+    os.symlink(version, tmp_link)
+    os.replace(tmp_link, link)
+
+    for entry in os.scandir(parent):
+        if (
+            entry.name.startswith(prefix)
+            and entry.name not in (version, previous)
+            and entry.is_dir(follow_symlinks=False)
+        ):
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def grid_children(resolution):
+    """Nombre de cellules fines agrégées dans chaque cellule d'une grille grossière, en mémoire mappée"""
+    return open_array(f"{grid_folder(resolution)}children.npy")
+
+
+def open_json(path):
+    """Contenu d'un fichier JSON, relu seulement quand le fichier a changé"""
+    mtime = os.stat(path).st_mtime_ns
+    cached = _json.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path) as file:
+            cached = _json[path] = (mtime, json.load(file))
+    return cached[1]
+
+
+def grid_communes(resolution):
+    """Noms et codes INSEE des communes de la grille : {"nom": [...], "insee": [...]}"""
+    return open_json(f"{grid_folder(resolution)}communes.json")
+
+
+def point_attributes_path(layer):
+    return f"{store_folder()}points/{layer}.json"
+
+
+def point_attributes(layer):
+    """Attributs (liste de dicts) des points d'une couche, dans l'ordre de ses lignes, ou None"""
+    try:
+        return open_json(point_attributes_path(layer))
+    except FileNotFoundError:
+        return None
+
+
+def write_point_attributes(layer, records, key):
+    """Enregistre les attributs des points d'une couche, affichés dans les popups"""
+    with write_lock():
+        path = point_attributes_path(layer)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(records, file, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        update_manifest("attributes", layer, key)
+
+
+def forget(folder):
+    """Ferme les tableaux et oublie les fichiers JSON d'un dossier de données qui n'est plus servi"""
+    prefixes = (f"{folder}grid/", f"{folder}store/")
+    for cache in (_arrays, _json):
+        for path in [path for path in cache if path.startswith(prefixes)]:
+            cache.pop(path, None)
@@ -1,3 +1,1171 @@
-from django.test import TestCase
+import gzip
+import hashlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
 
-# Create your tests here.
+import geopandas as gpd
+import h3
+import numpy as np
+import pandas as pd
+import shapely
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase
+from django.urls import reverse
+
+from . import fragments, gen_maps, jobs, map_cache, scores, snapshots, store, tiles
+from .forms import TransportationModesForm
+from .layers import RESOLUTION
+
+
+class DatasetHandler(BaseHTTPRequestHandler):
+    """Serveur de données local : sert server.files[chemin] avec un ETag"""
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        content = self.server.files.get(self.path)
+        if content is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        etag = f'"{hash(content)}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class DownloadTests(SimpleTestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), DatasetHandler)
+        self.server.files = {"/a.csv": b"a;b\n1;2\n", "/b.csv": b"c;d\n3;4\n"}
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        data_folder = tempfile.TemporaryDirectory()
+        self.addCleanup(data_folder.cleanup)
+        self.data_folder = data_folder.name + "/"
+        patcher = mock.patch.object(gen_maps, "DATA_FOLDER", self.data_folder)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def url(self, path):
+        return f"http://127.0.0.1:{self.server.server_port}{path}"
+
+    def read(self, filename):
+        with open(self.data_folder + filename, "rb") as file:
+            return file.read()
+
+    def test_download_writes_file(self):
+        self.assertTrue(gen_maps.download_file(self.url("/a.csv"), "a.csv"))
+        self.assertEqual(self.read("a.csv"), b"a;b\n1;2\n")
+        # pas de fichier temporaire laissé dans le dossier
+        self.assertEqual(
+            sorted(os.listdir(self.data_folder + "downloads/")), ["a.csv.json"]
+        )
+
+    def test_fresh_file_is_not_requested_again(self):
+        gen_maps.download_file(self.url("/a.csv"), "a.csv")
+        gen_maps.download_file(self.url("/a.csv"), "a.csv")
+        self.assertEqual(self.server.requests, ["/a.csv"])
+
+    def test_revalidation(self):
+        gen_maps.download_file(self.url("/a.csv"), "a.csv")
+        mtime = os.path.getmtime(self.data_folder + "a.csv")
+        # non modifié : 304, le fichier n'est pas réécrit
+        self.assertTrue(gen_maps.download_file(self.url("/a.csv"), "a.csv", max_age=0))
+        self.assertEqual(os.path.getmtime(self.data_folder + "a.csv"), mtime)
+        # modifié : nouveau contenu
+        self.server.files["/a.csv"] = b"a;b\n5;6\n"
+        self.assertTrue(gen_maps.download_file(self.url("/a.csv"), "a.csv", max_age=0))
+        self.assertEqual(self.read("a.csv"), b"a;b\n5;6\n")
+
+    def test_failure_keeps_previous_file(self):
+        self.assertFalse(gen_maps.download_file(self.url("/missing.csv"), "m.csv"))
+        gen_maps.download_file(self.url("/a.csv"), "a.csv")
+        del self.server.files["/a.csv"]
+        self.assertTrue(gen_maps.download_file(self.url("/a.csv"), "a.csv", max_age=0))
+        self.assertEqual(self.read("a.csv"), b"a;b\n1;2\n")
+
+    def test_download_files_in_parallel(self):
+        datasets = {
+            "a": {"url": self.url("/a.csv"), "filename": "a.csv"},
+            "b": {"url": self.url("/b.csv"), "filename": "b.csv"},
+        }
+        with mock.patch.object(gen_maps, "DATASETS", datasets):
+            self.assertEqual(
+                gen_maps.download_files(["a", "b"]), {"a": True, "b": True}
+            )
+        self.assertEqual(self.read("b.csv"), b"c;d\n3;4\n")
+
+
+class JobTests(SimpleTestCase):
+    def setUp(self):
+        jobs_folder = tempfile.TemporaryDirectory()
+        self.addCleanup(jobs_folder.cleanup)
+        self.jobs_folder = jobs_folder.name + "/"
+        patcher = mock.patch.object(jobs, "JOBS_FOLDER", self.jobs_folder)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def job(self, **fields):
+        job = {
+            "id": "job",
+            "pid": os.getpid(),
+            "selection": jobs.map_cache.selection({"taxis_used": True}),
+            "status": jobs.RUNNING,
+            "stages": [],
+            "created": time.time(),
+            "result": None,
+            "error": None,
+            **fields,
+        }
+        os.makedirs(self.jobs_folder, exist_ok=True)
+        with open(jobs.job_path(job["id"]), "w") as file:
+            json.dump(job, file)
+        return job
+
+    def test_failure_stores_short_error(self):
+        job = self.job(status=jobs.PENDING)
+        error = FileNotFoundError("/srv/secret/data/communes.geojson")
+        with mock.patch.object(
+            jobs.map_cache, "get_or_generate", side_effect=error
+        ), mock.patch.object(jobs.traceback, "print_exc"):
+            jobs.run_job(job)
+        job = jobs.read_job("job")
+        self.assertEqual(job["status"], jobs.FAILED)
+        self.assertEqual(job["error"], "échec de la génération (FileNotFoundError)")
+
+    def test_running_job_of_dead_process_fails(self):
+        process = subprocess.Popen([sys.executable, "-c", "pass"])
+        process.wait()
+        self.job(pid=process.pid)
+        self.assertEqual(jobs.read_job("job")["status"], jobs.FAILED)
+
+    def test_running_job_expires(self):
+        self.job(updated=time.time() - jobs.JOB_TIMEOUT - 1)
+        self.assertEqual(jobs.read_job("job")["status"], jobs.FAILED)
+        self.job(updated=time.time())
+        self.assertEqual(jobs.read_job("job")["status"], jobs.RUNNING)
+
+    def test_purge_removes_old_jobs(self):
+        self.job(id="old")
+        self.job(id="new")
+        old = time.time() - jobs.JOB_MAX_AGE - 1
+        os.utime(jobs.job_path("old"), (old, old))
+        jobs.purge_jobs()
+        self.assertEqual(os.listdir(self.jobs_folder), ["new.json"])
+
+
+def synthetic_hex_map(k=4):
+    """Grille des cellules à moins de k anneaux d'une cellule de Lyon, comme create_hex_map"""
+    center = h3.latlng_to_cell(45.76, 4.84, RESOLUTION)
+    cells = sorted(h3.grid_disk(center, k))
+    polygons = [
+        shapely.Polygon([(lng, lat) for lat, lng in h3.cell_to_boundary(cell)])
+        for cell in cells
+    ]
+    return gpd.GeoDataFrame(
+        {"nom": "Lyon"},
+        geometry=polygons,
+        index=pd.Index(cells, name="h3_polyfill"),
+        crs="EPSG:4326",
+    )
+
+
+def synthetic_points(hex_map, count, seed=0):
+    """Points tirés près des centres des hexagones (plusieurs par hexagone), et un hors grille"""
+    rng = np.random.default_rng(seed)
+    centers = shapely.centroid(hex_map.geometry.to_numpy())
+    centers = centers[rng.integers(len(hex_map), size=count)]
+    # décalage bien inférieur à la taille d'un hexagone (~170 m)
+    offsets = rng.uniform(-0.0004, 0.0004, size=(count, 2))
+    points = [
+        shapely.Point(center.x + dx, center.y + dy)
+        for center, (dx, dy) in zip(centers, offsets)
+    ]
+    return gpd.GeoDataFrame(
+        {"gid": np.arange(count + 1)},
+        geometry=points + [shapely.Point(5.5, 46.5)],
+        crs="EPSG:4326",
+    )
+
+
+def empty_frame():
+    return gpd.GeoDataFrame({"gid": []}, geometry=[], crs="EPSG:4326")
+
+
+class HeatEngineTests(SimpleTestCase):
+    """Moteurs vectorisés comparés aux boucles contains / crosses qu'ils remplacent"""
+
+    def setUp(self):
+        self.hex_map = synthetic_hex_map()
+
+    def contains_loop(self, df, weights=None):
+        weights = np.ones(len(df)) if weights is None else weights
+        return np.array(
+            [
+                sum(
+                    weight
+                    for geometry, weight in zip(df.geometry, weights)
+                    if geometry is not None
+                    and (polygon.contains(geometry) or polygon.overlaps(geometry))
+                )
+                for polygon in self.hex_map.geometry
+            ],
+            dtype=float,
+        )
+
+    def test_points_heat(self):
+        df = synthetic_points(self.hex_map, 300)
+        # géométries absente et vide : ignorées
+        df = pd.concat(
+            [
+                df,
+                gpd.GeoDataFrame(
+                    {"gid": [-1, -2]}, geometry=[None, shapely.Point()], crs=df.crs
+                ),
+            ]
+        )
+        heat = gen_maps.points_heat(self.hex_map, df)
+        np.testing.assert_array_equal(heat, self.contains_loop(df))
+        self.assertEqual(heat.sum(), 300)
+
+    def test_lines_heat(self):
+        points = synthetic_points(self.hex_map, 80).geometry.to_numpy()
+        lines = [
+            shapely.LineString([a, b]) for a, b in zip(points[:-1:2], points[1::2])
+        ]
+        df = gpd.GeoDataFrame({"gid": range(len(lines))}, geometry=lines)
+        expected = np.array(
+            [
+                sum(line.crosses(polygon) for line in df.geometry)
+                for polygon in self.hex_map.geometry
+            ],
+            dtype=float,
+        )
+        np.testing.assert_array_equal(gen_maps.lines_heat(self.hex_map, df), expected)
+
+    def test_stations_heat(self):
+        df = synthetic_points(self.hex_map, 20)
+        # une gare étendue chevauche plusieurs hexagones
+        center = shapely.centroid(self.hex_map.geometry.iloc[len(self.hex_map) // 2])
+        df.loc[len(df)] = [100, center.buffer(0.003)]
+        df["voyageurs"] = np.arange(len(df), dtype=float)
+        df.loc[3, "voyageurs"] = np.nan
+        weights = np.nan_to_num(df["voyageurs"].to_numpy())
+        np.testing.assert_allclose(
+            gen_maps.stations_heat(self.hex_map, df), self.contains_loop(df, weights)
+        )
+
+    def test_diffuse_heat(self):
+        source = np.zeros(len(self.hex_map))
+        source[[0, 10, 30, 31]] = [1, 2, 3, 4]
+        ring_weights = (1, 0.5, 0.25)
+        cells = list(self.hex_map.index)
+        expected = ring_weights[0] * source
+        for i, cell in enumerate(cells):
+            if source[i]:
+                continue
+            for distance, weight in enumerate(ring_weights[1:], 1):
+                for neighbour in h3.grid_ring(cell, distance):
+                    if neighbour in cells:
+                        expected[i] += weight * source[cells.index(neighbour)]
+        np.testing.assert_allclose(
+            gen_maps.diffuse_heat(self.hex_map, source, ring_weights), expected
+        )
+        np.testing.assert_array_equal(
+            gen_maps.diffuse_heat(self.hex_map, source, (2,)), 2 * source
+        )
+
+    def test_empty_inputs(self):
+        zeros = np.zeros(len(self.hex_map))
+        for engine in (
+            gen_maps.points_heat,
+            gen_maps.lines_heat,
+            gen_maps.stations_heat,
+        ):
+            with self.subTest(engine=engine.__name__):
+                np.testing.assert_array_equal(
+                    engine(self.hex_map, empty_frame()), zeros
+                )
+        np.testing.assert_array_equal(
+            gen_maps.diffuse_heat(self.hex_map, zeros, (1, 0.5)), zeros
+        )
+
+
+# communes de la grille synthétique
+SYNTHETIC_COMMUNES = {
+    "nom": [f"Commune {i}" for i in range(50)],
+    "insee": [f"69{i:03d}" for i in range(50)],
+}
+
+
+class StoreTestCase(SimpleTestCase):
+    """Données servies depuis un dossier temporaire, avec la grille de synthetic_hex_map"""
+
+    def setUp(self):
+        data_folder = tempfile.TemporaryDirectory()
+        self.addCleanup(data_folder.cleanup)
+        self.data_folder = data_folder.name + "/"
+        snapshots.set_root(self.data_folder)
+        self.addCleanup(snapshots.release)
+        for name, value in {
+            "DATA_FOLDER": self.data_folder,
+            "INGESTED_FOLDER": self.data_folder + "parquet/",
+            "HEAT_CACHE_FOLDER": self.data_folder + "heat_cache/",
+        }.items():
+            patcher = mock.patch.object(gen_maps, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.hex_map = synthetic_hex_map()
+        # hexagones répartis à tour de rôle entre les communes
+        self.codes = np.arange(len(self.hex_map)) % len(SYNTHETIC_COMMUNES["nom"])
+        self.hex_map["nom"] = np.array(SYNTHETIC_COMMUNES["nom"])[self.codes]
+        self.write_grid()
+
+    def write_grid(self, resolution=RESOLUTION):
+        """Enregistre la grille de synthetic_hex_map, à la place de gen_maps.build_grid"""
+        cells = [h3.str_to_int(cell) for cell in self.hex_map.index]
+        store.write_grid(
+            resolution,
+            np.array(cells, dtype=np.uint64),
+            self.codes.astype(np.int16),
+            SYNTHETIC_COMMUNES,
+        )
+
+
+class RefreshTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        velov = synthetic_points(self.hex_map, 40)
+        velov["name"] = velov["address"] = velov["commune"] = "x"
+        velov["bike_stands"] = 10
+        velov["status"] = "OPEN"
+        self.frames = {
+            "velov": velov,
+            "navette_fluviale": synthetic_points(self.hex_map, 5, seed=1).assign(
+                nom="x"
+            ),
+        }
+        for patcher in (
+            mock.patch.object(gen_maps, "download_file", return_value=True),
+            mock.patch.object(gen_maps, "load_dataset", side_effect=self.load_dataset),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def load_dataset(self, name, columns=None):
+        df = self.frames[name]
+        return df[columns] if columns else df
+
+    def column(self, layer):
+        matrix = store.open_heat_matrix(RESOLUTION)
+        return np.asarray(matrix[:, gen_maps.LAYERS.index(layer)])
+
+    def assert_recomputed(self, layer):
+        """La colonne publiée et sa clé sont celles d'un recalcul complet"""
+        df = gen_maps.LOADERS[layer]()
+        engine, params = gen_maps.LAYER_ENGINES[layer], gen_maps.LAYER_PARAMS[layer]
+        np.testing.assert_allclose(
+            self.column(layer), gen_maps.ENGINES[engine](self.hex_map, df, **params)
+        )
+        key = gen_maps.heat_cache_key(self.hex_map, df, engine, 1, **params)
+        self.assertEqual(store.heat_layers(RESOLUTION)[layer], key)
+        self.assertEqual(len(store.open_points(layer)), len(df))
+
+    def test_delta_equals_full_recompute(self):
+        self.assertEqual(gen_maps.refresh_layer("velov"), ("complet", 41, 0, 0))
+        self.assert_recomputed("velov")
+
+        velov = self.frames["velov"].copy()
+        # ajout, déplacement, fermeture et suppression d'une station
+        velov.loc[len(velov)] = velov.iloc[0].copy()
+        velov.loc[len(velov) - 1, "gid"] = 1000
+        velov.loc[1, "geometry"] = velov.loc[2, "geometry"]
+        velov.loc[3, "status"] = "CLOSED"
+        self.frames["velov"] = velov.drop(index=4)
+        self.assertEqual(gen_maps.refresh_layer("velov"), ("delta", 1, 2, 1))
+        self.assert_recomputed("velov")
+
+        self.assertEqual(gen_maps.refresh_layer("velov"), ("à jour", 0, 0, 0))
+
+    def test_station_layer_is_recomputed(self):
+        gen_maps.refresh_layer("velov")
+        self.assertEqual(gen_maps.refresh_layer("navette_fluv")[0], "complet")
+        self.frames["navette_fluviale"] = self.frames["navette_fluviale"].iloc[1:]
+        self.assertEqual(gen_maps.refresh_layer("navette_fluv")[0], "complet")
+        self.assert_recomputed("navette_fluv")
+
+    def test_duplicate_gids_are_recomputed(self):
+        gen_maps.refresh_layer("velov")
+        velov = self.frames["velov"].copy()
+        velov.loc[5, "gid"] = velov.loc[6, "gid"]
+        self.frames["velov"] = velov.drop(index=0)
+        self.assertEqual(gen_maps.refresh_layer("velov")[0], "complet")
+        self.assert_recomputed("velov")
+
+    def test_state_of_another_column_is_recomputed(self):
+        gen_maps.refresh_layer("velov")
+        with open(gen_maps.layer_snapshot_path("velov"), "rb") as file:
+            state = file.read()
+        # colonne republiée en v2 mais état resté en v1 (arrêt entre les deux écritures)
+        self.frames["velov"] = self.frames["velov"].iloc[1:]
+        gen_maps.refresh_layer("velov")
+        with open(gen_maps.layer_snapshot_path("velov"), "wb") as file:
+            file.write(state)
+        self.frames["velov"] = self.frames["velov"].iloc[1:]
+        self.assertEqual(gen_maps.refresh_layer("velov")[0], "complet")
+        self.assert_recomputed("velov")
+
+    def test_missing_previous_state_is_recomputed(self):
+        gen_maps.refresh_layer("velov")
+        os.remove(gen_maps.layer_snapshot_path("velov"))
+        self.frames["velov"] = self.frames["velov"].iloc[1:]
+        self.assertEqual(gen_maps.refresh_layer("velov")[0], "complet")
+        self.assert_recomputed("velov")
+
+
+class HeatScoreTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        rng = np.random.default_rng(0)
+        self.matrix = rng.random((len(self.hex_map), len(gen_maps.LAYERS)))
+        self.matrix = self.matrix.astype(np.float32)
+        keys = {layer: "k" for layer in gen_maps.LAYERS}
+        store.write_heat_matrix(RESOLUTION, self.matrix, keys)
+        self.url = reverse("maps:heat_score")
+        # centres de deux hexagones de la grille, puis un point hors de la grille
+        self.positions = [3, 20]
+        self.points = [h3.cell_to_latlng(self.hex_map.index[i]) for i in self.positions]
+        self.points.append((46.5, 5.5))
+
+    def expected_heat(self, position, layers):
+        return float(self.matrix[position] @ scores.layer_weights(layers))
+
+    def test_get(self):
+        lat, lon = self.points[0]
+        response = self.client.get(
+            self.url, {"lat": lat, "lon": lon, "velov_used": "on"}
+        )
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data["cell"], self.hex_map.index[3])
+        self.assertEqual(data["nom"], "Commune 3")
+        self.assertEqual(data["resolution"], RESOLUTION)
+        self.assertIn("velov", data["layers"])
+        self.assertAlmostEqual(
+            data["heat"], self.expected_heat(3, data["layers"]), places=5
+        )
+
+    def test_json_batch(self):
+        response = self.client.post(
+            self.url,
+            json.dumps({"points": self.points, "taxis_used": True}),
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(
+            data["cell"][:2], [self.hex_map.index[i] for i in self.positions]
+        )
+        self.assertEqual(data["nom"], ["Commune 3", "Commune 20", None])
+        expected = [self.expected_heat(i, data["layers"]) for i in self.positions]
+        np.testing.assert_allclose(data["heat"][:2], expected, rtol=1e-5)
+        # hors de la grille : pas de commune ni de chaleur
+        self.assertIsNone(data["heat"][2])
+
+    def test_csv_upload(self):
+        rows = "".join(f"{lon},{lat}\n" for lat, lon in self.points)
+        upload = SimpleUploadedFile("points.csv", f"lon,lat\n{rows}".encode())
+        response = self.client.post(self.url, {"file": upload, "velov_used": "on"})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data["nom"], ["Commune 3", "Commune 20", None])
+        expected = [self.expected_heat(i, data["layers"]) for i in self.positions]
+        np.testing.assert_allclose(data["heat"][:2], expected, rtol=1e-5)
+
+    def test_coarse_resolutions(self):
+        lat, lon = self.points[0]
+        key = map_cache.selection_key(map_cache.selection({"taxis_used": True}))
+        url = reverse("maps:heat_vector", kwargs={"key": key})
+        for resolution in gen_maps.COARSE_RESOLUTIONS:
+            with self.subTest(resolution=resolution):
+                data = self.client.get(
+                    self.url,
+                    {
+                        "lat": lat,
+                        "lon": lon,
+                        "taxis_used": "on",
+                        "resolution": resolution,
+                    },
+                ).json()
+                parents = np.array(
+                    [h3.cell_to_parent(cell, resolution) for cell in self.hex_map.index]
+                )
+                children = parents == data["cell"]
+                weights = scores.layer_weights(data["layers"])
+                heat = (self.matrix[children] @ weights).sum()
+                # score : somme des cellules filles
+                self.assertAlmostEqual(data["heat"], heat, places=4)
+                # carte : moyenne des cellules filles
+                response = self.client.get(url, {"resolution": resolution})
+                vector = np.frombuffer(response.content, dtype="<f4")
+                cells = scores.grid_cells(resolution)
+                self.assertAlmostEqual(
+                    float(vector[cells.index(data["cell"])]),
+                    heat / children.sum(),
+                    places=4,
+                )
+
+    def test_invalid_requests(self):
+        cases = {
+            "résolution": self.client.get(
+                self.url, {"lat": 45.76, "lon": 4.84, "resolution": 3}
+            ),
+            "sans latitude": self.client.get(self.url, {"lon": 4.84}),
+            "json invalide": self.client.post(
+                self.url, "{", content_type="application/json"
+            ),
+            "hors limites": self.client.get(self.url, {"lat": 95, "lon": 4.84}),
+        }
+        for case, response in cases.items():
+            with self.subTest(case=case):
+                self.assertEqual(response.status_code, 400)
+                self.assertIn("error", response.json())
+
+
+class MapCacheTests(SimpleTestCase):
+    def setUp(self):
+        cache_folder = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_folder.cleanup)
+        self.cache_folder = cache_folder.name + "/"
+        for patcher in (
+            mock.patch.object(map_cache, "MAP_CACHE_FOLDER", self.cache_folder),
+            mock.patch.object(map_cache, "LOCKS_FOLDER", self.cache_folder + "locks/"),
+            mock.patch.object(map_cache, "data_version", return_value="v"),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_identical_requests_generate_once(self):
+        selection = map_cache.selection({"velov_used": True})
+        calls = []
+
+        def generate(path):
+            calls.append(path)
+            # génération lente : les autres requêtes arrivent pendant ce temps
+            time.sleep(0.2)
+            with open(path, "w") as file:
+                file.write("<html></html>")
+
+        barrier = threading.Barrier(5)
+        paths = []
+
+        def request():
+            barrier.wait()
+            paths.append(map_cache.get_or_generate(selection, generate))
+
+        threads = [threading.Thread(target=request) for _ in range(5)]
+        with mock.patch.object(map_cache, "evict"):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(paths, [map_cache.map_path(selection)] * 5)
+        self.assertTrue(os.path.exists(paths[0]))
+
+    def test_compressed_variants(self):
+        tmp_path = self.cache_folder + "map.tmp"
+        path = self.cache_folder + "map.html"
+        content = b"<html>" + b"heat " * 1000 + b"</html>"
+        with open(tmp_path, "wb") as file:
+            file.write(content)
+        map_cache.compress_map(tmp_path, path)
+        os.replace(tmp_path, path)
+        with open(path + ".gz", "rb") as file:
+            self.assertEqual(gzip.decompress(file.read()), content)
+        if map_cache.brotli is not None:
+            with open(path + ".br", "rb") as file:
+                self.assertEqual(map_cache.brotli.decompress(file.read()), content)
+        # brotli préféré s'il est installé
+        best = ("br", ".br") if map_cache.brotli is not None else ("gzip", ".gz")
+
+        cases = {
+            "": (path, None),
+            "gzip": (path + ".gz", "gzip"),
+            "gzip, deflate, br": (path + best[1], best[0]),
+            "br;q=0, gzip;q=0.5": (path + ".gz", "gzip"),
+            "GZIP": (path + ".gz", "gzip"),
+            "gzip;q=0": (path, None),
+            "gzip;q=0.0": (path, None),
+            "gzip; q=0.00": (path, None),
+            "gzip;q=abc": (path, None),
+            "identity": (path, None),
+        }
+        for accept_encoding, expected in cases.items():
+            with self.subTest(accept_encoding=accept_encoding):
+                self.assertEqual(
+                    map_cache.encoded_variant(path, accept_encoding), expected
+                )
+
+    def write(self, name, size, age):
+        path = self.cache_folder + name
+        with open(path, "wb") as file:
+            file.write(b"x" * size)
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+
+    def test_evict_removes_least_recently_served(self):
+        self.write("a.html", 100, age=30)
+        self.write("a.html.gz", 50, age=30)
+        self.write("b.html", 100, age=20)
+        self.write("c.html", 100, age=10)
+        # carte en cours de génération : jamais évincée
+        self.write("d.tmp", 500, age=40)
+        map_cache.evict(max_bytes=250, folder=self.cache_folder)
+        self.assertEqual(
+            sorted(os.listdir(self.cache_folder)), ["b.html", "c.html", "d.tmp"]
+        )
+        # sous la limite : rien n'est supprimé
+        map_cache.evict(max_bytes=200, folder=self.cache_folder)
+        self.assertEqual(len(os.listdir(self.cache_folder)), 3)
+
+
+class SnapshotTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.snapshots_folder = self.data_folder + "snapshots/"
+        for patcher in (
+            mock.patch.object(snapshots, "SNAPSHOTS_FOLDER", self.snapshots_folder),
+            mock.patch.object(
+                snapshots, "CURRENT_PATH", self.snapshots_folder + "CURRENT"
+            ),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def make(self, name):
+        """Instantané minimal : un tableau du magasin et un manifeste"""
+        folder = snapshots.snapshot_folder(name)
+        os.makedirs(f"{folder}store")
+        np.save(f"{folder}store/heat.npy", np.arange(3))
+        with open(f"{folder}manifest.json", "w") as file:
+            json.dump({"name": name}, file)
+
+    def test_activate(self):
+        self.assertIsNone(snapshots.read_current())
+        self.make("s1")
+        snapshots.activate("s1")
+        self.assertEqual(snapshots.read_current(), "s1")
+        self.assertEqual(os.listdir(self.snapshots_folder), ["CURRENT", "s1"])
+
+    def test_prune_keeps_active_and_recent(self):
+        for name in ("s1", "s2", "s3", "s4"):
+            self.make(name)
+        # instantané en construction : pas de manifeste, ignoré
+        os.makedirs(f"{self.snapshots_folder}s5.tmp")
+        self.assertEqual(snapshots.snapshots(), ["s1", "s2", "s3", "s4"])
+        snapshots.activate("s1")
+        snapshots.prune(kept=2)
+        self.assertEqual(snapshots.snapshots(), ["s1", "s3", "s4"])
+
+    def test_watcher_switches_to_new_snapshot(self):
+        self.make("s1")
+        self.make("s2")
+        snapshots.activate("s1")
+        snapshots.release()
+        # nouveau surveillant, qui vérifie CURRENT très souvent
+        with mock.patch.object(snapshots, "_watcher", None), mock.patch.object(
+            snapshots, "SNAPSHOT_POLL_SECONDS", 0.01
+        ):
+            self.assertEqual(snapshots.root(), snapshots.snapshot_folder("s1"))
+            watcher = snapshots._watcher
+            snapshots.activate("s2")
+            deadline = time.time() + 5
+            while snapshots.current_name() != "s2" and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(snapshots.root(), snapshots.snapshot_folder("s2"))
+            # préchargé avant la bascule
+            self.assertIn(
+                f"{snapshots.snapshot_folder('s2')}store/heat.npy", store._arrays
+            )
+            # dossier imposé : le surveillant s'arrête
+            snapshots.set_root(self.data_folder)
+            watcher.join(5)
+            self.assertFalse(watcher.is_alive())
+
+    def start_build(self):
+        """Jeux de données synthétiques de toutes les couches, téléchargements simulés"""
+        frames = {}
+        for layer, spec in gen_maps.LAYER_SPECS.items():
+            if spec["engine"] == "lines":
+                points = synthetic_points(self.hex_map, 20).geometry.to_numpy()
+                lines = [shapely.LineString(pair) for pair in zip(points, points[1:])]
+                df = gpd.GeoDataFrame({"gid": range(len(lines))}, geometry=lines)
+            else:
+                df = synthetic_points(self.hex_map, 10, seed=len(frames))
+            columns = spec.get("columns", []) + spec.get("popup_columns", [])
+            for column in columns + ["nom"]:
+                if column not in df.columns:
+                    df[column] = "x"
+            for column, value in spec.get("filters", {}).items():
+                df[column] = value
+            frames[spec["source"]] = df
+        frames["gares"]["idexterne"] = np.arange(len(frames["gares"]))
+        frames["trafic_voyageurs_gares"] = pd.DataFrame(
+            {"Code UIC": np.arange(10), "Total Voyageurs 2021": np.arange(10) * 1000}
+        )
+        # fichiers téléchargé et ingéré des communes, repris dans l'instantané
+        raw_content = b'{"type": "FeatureCollection", "features": []}'
+        with open(self.data_folder + "communes.geojson", "wb") as file:
+            file.write(raw_content)
+        os.makedirs(gen_maps.INGESTED_FOLDER)
+        with open(gen_maps.ingested_path("communes"), "wb") as file:
+            file.write(b"parquet")
+
+        for patcher in (
+            mock.patch.object(gen_maps, "download_file", return_value=True),
+            mock.patch.object(
+                gen_maps,
+                "load_dataset",
+                side_effect=lambda name, columns=None: frames[name],
+            ),
+            mock.patch.object(gen_maps, "build_grid", side_effect=self.write_grid),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        return frames
+
+    def test_build_snapshot(self):
+        frames = self.start_build()
+        raw_content = b'{"type": "FeatureCollection", "features": []}'
+        first = gen_maps.build_snapshot()
+        folder = snapshots.snapshot_folder(first["name"])
+        self.assertEqual(snapshots.read_current(), first["name"])
+        self.assertEqual(set(first["refresh"].values()), {"complet"})
+        self.assertEqual(set(first["layers"]), set(gen_maps.LAYERS))
+        self.assertEqual(
+            first["sources"]["communes"]["sha256"],
+            hashlib.sha256(raw_content).hexdigest(),
+        )
+        self.assertTrue(os.path.islink(f"{folder}grid/r{RESOLUTION}"))
+        # attributs des popups publiés à la construction
+        self.assertTrue(os.path.exists(f"{folder}store/points/velov.json"))
+        for coarse in gen_maps.COARSE_RESOLUTIONS:
+            self.assertTrue(os.path.exists(f"{folder}grid/r{coarse}/children.npy"))
+        matrix = np.load(f"{folder}store/r{RESOLUTION}/heat_matrix.npy")
+
+        # le nom de l'instantané est daté à la seconde
+        time.sleep(1)
+        frames["velov"] = frames["velov"].iloc[1:]
+        second = gen_maps.build_snapshot()
+        self.assertEqual(second["previous"], first["name"])
+        self.assertEqual(second["refresh"].pop("velov"), "delta")
+        self.assertEqual(set(second["refresh"].values()), {"à jour"})
+        self.assertEqual(snapshots.snapshots(), [first["name"], second["name"]])
+        self.assertEqual(snapshots.read_current(), second["name"])
+        # l'instantané précédent n'est pas modifié par le suivant
+        np.testing.assert_array_equal(
+            np.load(f"{folder}store/r{RESOLUTION}/heat_matrix.npy"), matrix
+        )
+        self.assertFalse(
+            np.array_equal(
+                np.load(
+                    f"{snapshots.snapshot_folder(second['name'])}"
+                    f"store/r{RESOLUTION}/heat_matrix.npy"
+                ),
+                matrix,
+            )
+        )
+
+    def test_failed_build_leaves_nothing(self):
+        self.start_build()
+        with mock.patch.object(
+            gen_maps, "refresh_layer", side_effect=RuntimeError("téléchargement")
+        ), self.assertRaises(RuntimeError):
+            gen_maps.build_snapshot()
+        self.assertIsNone(snapshots.read_current())
+        self.assertEqual(os.listdir(self.snapshots_folder), [])
+
+    def test_served_snapshot_is_not_modified(self):
+        self.start_build()
+        manifest = gen_maps.build_snapshot()
+        folder = snapshots.snapshot_folder(manifest["name"])
+        self.assertEqual(snapshots.root(), folder)
+
+        def files():
+            stats = {
+                os.path.join(dirpath, name): os.stat(os.path.join(dirpath, name))
+                for dirpath, _, names in os.walk(folder)
+                for name in names
+            }
+            return {
+                path: (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+                for path, stat in stats.items()
+            }
+
+        before = files()
+        gen_maps.gen_maps(
+            velov_used=True,
+            map_path=self.data_folder + "map.html",
+            point_popups_url="/points/{layer}/",
+        )
+        self.assertEqual(files(), before)
+
+
+class RollUpTests(StoreTestCase):
+    def test_parent_heat_is_sum_of_children(self):
+        rng = np.random.default_rng(0)
+        matrix = rng.random((len(self.hex_map), len(gen_maps.LAYERS)))
+        matrix = matrix.astype(np.float32)
+        keys = {layer: "k" for layer in gen_maps.LAYERS}
+        store.write_heat_matrix(RESOLUTION, matrix, keys)
+
+        for resolution in gen_maps.COARSE_RESOLUTIONS:
+            with self.subTest(resolution=resolution):
+                scores.roll_up(resolution)
+                parents = np.array(
+                    [h3.cell_to_parent(cell, resolution) for cell in self.hex_map.index]
+                )
+                cells = [f"{cell:x}" for cell in store.open_grid(resolution)[0]]
+                self.assertEqual(cells, sorted(set(parents), key=h3.str_to_int))
+                coarse = store.open_heat_matrix(resolution)
+                children = store.grid_children(resolution)
+                for i, cell in enumerate(cells):
+                    np.testing.assert_allclose(
+                        coarse[i], matrix[parents == cell].sum(axis=0), rtol=1e-5
+                    )
+                    self.assertEqual(children[i], (parents == cell).sum())
+                self.assertEqual(store.heat_layers(resolution), keys)
+                # chaleur affichée : moyenne des cellules filles
+                layers = ["velov", "taxis"]
+                np.testing.assert_allclose(
+                    scores.heat_vector(layers, resolution=resolution),
+                    coarse @ scores.layer_weights(layers) / children,
+                    rtol=1e-5,
+                )
+
+
+class CommuneFilterTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        taxis = synthetic_points(self.hex_map, 60).assign(nom="x")
+        self.frames = {"stations_taxi": taxis}
+        for patcher in (
+            mock.patch.object(gen_maps, "download_file", return_value=True),
+            mock.patch.object(
+                gen_maps,
+                "load_dataset",
+                side_effect=lambda name, columns=None: self.frames[name],
+            ),
+            mock.patch.object(
+                fragments, "FRAGMENTS_FOLDER", self.data_folder + "fragments/"
+            ),
+            mock.patch.object(map_cache, "data_version", return_value="v"),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_form_field(self):
+        form = TransportationModesForm({"communes": " commune 3, 69010,,"})
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.cleaned_data["communes"], ["69003", "69010"])
+        form = TransportationModesForm({"communes": "Commune 3, Paris"})
+        self.assertFalse(form.is_valid())
+        self.assertIn("Paris", form.errors["communes"][0])
+        # toutes les communes : pas de limite de nombre
+        form = TransportationModesForm(
+            {"communes": ",".join(SYNTHETIC_COMMUNES["nom"])}
+        )
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.cleaned_data["communes"], SYNTHETIC_COMMUNES["insee"])
+
+    def test_commune_mask(self):
+        mask = scores.commune_mask(["69003", "69010"])
+        np.testing.assert_array_equal(mask, np.isin(self.codes, [3, 10]))
+
+    def test_clip_positions(self):
+        df = self.frames["stations_taxi"]
+        hexagons = self.hex_map.geometry[np.isin(self.codes, [3, 10, 20])]
+        expected = [
+            i
+            for i, geometry in enumerate(df.geometry)
+            if any(hexagon.intersects(geometry) for hexagon in hexagons)
+        ]
+        self.assertTrue(expected)
+        np.testing.assert_array_equal(gen_maps.clip_positions(df, hexagons), expected)
+
+    def generate(self, communes, **options):
+        path = self.data_folder + "map.html"
+        gen_maps.gen_maps(taxis_used=True, map_path=path, communes=communes, **options)
+        with open(path) as file:
+            return file.read()
+
+    def test_filtered_assembled_map(self):
+        html = self.generate(["69003", "69010"], assemble=True)
+        # hexagones des deux communes seulement, identifiés par leur nom
+        self.assertEqual(html.count('"Commune '), np.isin(self.codes, [3, 10]).sum())
+        self.assertIn("fitBounds", html)
+        # pas de fragments par sous-ensemble de communes dans le cache
+        self.assertFalse(os.path.exists(fragments.FRAGMENTS_FOLDER))
+        html = self.generate(None, assemble=True)
+        self.assertEqual(html.count('"Commune '), len(self.hex_map))
+        folder = fragments.fragments_folder(f"v-z{gen_maps.EXPORT_ZOOM}")
+        self.assertEqual(sorted(os.listdir(folder)), ["hexagons.js", "taxis.js"])
+
+    def test_filtered_folium_map(self):
+        html = self.generate(["69003"])
+        self.assertIn("fit_bounds", html.replace("fitBounds", "fit_bounds"))
+        self.assertIn("Commune 3", html)
+        self.assertNotIn("Commune 4", html)
+
+    def test_many_communes(self):
+        communes = SYNTHETIC_COMMUNES["insee"][:45]
+        selection = map_cache.selection({"taxis_used": True, "communes": communes})
+        with mock.patch.object(
+            map_cache, "MAP_CACHE_FOLDER", self.data_folder + "maps/"
+        ), mock.patch.object(
+            map_cache, "LOCKS_FOLDER", self.data_folder + "maps/locks/"
+        ), mock.patch.object(
+            map_cache, "evict"
+        ):
+            path = map_cache.get_or_generate(
+                selection,
+                lambda map_path: gen_maps.gen_maps(
+                    **selection, map_path=map_path, assemble=True
+                ),
+            )
+            self.assertLess(len(os.path.basename(path)), 100)
+            self.assertEqual(map_cache.map_file(map_cache.map_key(path)), path)
+        # la clé des url garde les codes lisibles
+        key = map_cache.selection_key(selection)
+        self.assertEqual(map_cache.key_selection(key)["communes"], communes)
+        with open(path) as file:
+            self.assertEqual(
+                file.read().count('"Commune '), np.isin(self.codes, range(45)).sum()
+            )
+
+
+class ClusterPointsTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        taxis = synthetic_points(self.hex_map, 20).assign(nom="station")
+        # station sans coordonnées : pas de marqueur, les suivantes gardent leur rang
+        taxis.loc[5, "geometry"] = None
+        self.taxis = taxis
+
+    def markers(self, df, positions=None):
+        return gen_maps.cluster_points("taxis", df, "red", "/points/taxis/", positions)
+
+    def expected(self, positions):
+        return [
+            [round(point.y, 6), round(point.x, 6), int(i)]
+            for i, point in zip(positions, self.taxis.geometry.iloc[positions])
+            if point is not None
+        ]
+
+    def test_markers_keep_dataset_ranks(self):
+        positions = np.array([2, 5, 7, 11])
+        self.assertEqual(
+            self.markers(self.taxis.iloc[positions], positions).data,
+            self.expected(positions),
+        )
+        self.assertEqual(
+            self.markers(self.taxis).data, self.expected(np.arange(len(self.taxis)))
+        )
+
+    def test_markers_from_published_points(self):
+        gen_maps.heat_matrix(self.hex_map, {"taxis": self.taxis})
+        positions = np.array([0, 5, 9, 20])
+        with mock.patch.object(gen_maps, "layer_points") as layer_points:
+            markers = self.markers(self.taxis.iloc[positions], positions)
+        layer_points.assert_not_called()
+        self.assertEqual(markers.data, self.expected(positions))
+
+    def test_point_attributes(self):
+        frame = self.taxis[["nom", "geometry"]]
+        gen_maps.publish_point_attributes("taxis", frame)
+        url = reverse("maps:point_attributes", kwargs={"layer": "taxis", "index": 3})
+        self.assertEqual(self.client.get(url).json(), {"nom": "station"})
+        # seul un attribut change : les popups sont republiées
+        frame = frame.assign(nom=[f"station {i}" for i in range(len(frame))])
+        gen_maps.publish_point_attributes("taxis", frame)
+        self.assertEqual(self.client.get(url).json(), {"nom": "station 3"})
+        url = reverse("maps:point_attributes", kwargs={"layer": "taxis", "index": 99})
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+
+class HeatCacheTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.gares = synthetic_points(self.hex_map, 10).assign(voyageurs=1000.0)
+        self.engine = mock.Mock(wraps=gen_maps.station_diffusion_heat)
+        patcher = mock.patch.dict(gen_maps.ENGINES, {"stations": self.engine})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def heat(self, df, coeff=1, ring_weights=(1, 0.5)):
+        return gen_maps.layer_heat(
+            self.hex_map, df, "gares", "stations", coeff, ring_weights=ring_weights
+        )
+
+    def test_key_follows_data_and_parameters(self):
+        def key(df, coeff=1, **params):
+            return gen_maps.heat_cache_key(
+                self.hex_map, df, "stations", coeff, **params
+            )
+
+        moved = self.gares.copy()
+        moved.loc[0, "geometry"] = moved.loc[1, "geometry"]
+        keys = {
+            key(self.gares),
+            key(moved),
+            key(self.gares.assign(voyageurs=10.0)),
+            key(self.gares, coeff=2),
+            key(self.gares, ring_weights=[1, 0.25]),
+            gen_maps.heat_cache_key(self.hex_map, self.gares, "points", 1),
+        }
+        self.assertEqual(len(keys), 6)
+        self.assertEqual(key(self.gares), key(self.gares.copy()))
+
+    def test_miss_then_hit(self):
+        heat = self.heat(self.gares)
+        self.assertEqual(self.engine.call_count, 1)
+        np.testing.assert_array_equal(self.heat(self.gares), heat)
+        self.assertEqual(self.engine.call_count, 1)
+
+        # une géométrie changée : nouveau calcul, puis en cache
+        moved = self.gares.copy()
+        moved.loc[0, "geometry"] = moved.loc[1, "geometry"]
+        self.heat(moved)
+        self.heat(moved)
+        self.assertEqual(self.engine.call_count, 2)
+        # un paramètre changé : de même
+        self.heat(self.gares, ring_weights=(1, 0.25))
+        self.heat(self.gares, ring_weights=(1, 0.25))
+        self.assertEqual(self.engine.call_count, 3)
+        np.testing.assert_array_equal(self.heat(self.gares, coeff=2), 2 * heat)
+        self.assertEqual(self.engine.call_count, 4)
+
+    def test_cache_is_bounded(self):
+        size = np.zeros(len(self.hex_map)).nbytes + 128
+        with mock.patch.object(gen_maps, "HEAT_CACHE_MAX_BYTES", 3 * size):
+            for coeff in range(1, 6):
+                self.heat(self.gares, coeff=coeff)
+                time.sleep(0.01)
+        self.assertEqual(len(os.listdir(gen_maps.HEAT_CACHE_FOLDER)), 3)
+        # les plus récents sont gardés
+        self.heat(self.gares, coeff=5)
+        self.assertEqual(self.engine.call_count, 5)
+
+
+class TileTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        rng = np.random.default_rng(0)
+        matrix = rng.random((len(self.hex_map), len(gen_maps.LAYERS)))
+        keys = {layer: "k" for layer in gen_maps.LAYERS}
+        store.write_heat_matrix(RESOLUTION, matrix.astype(np.float32), keys)
+        patcher = mock.patch.object(tiles, "TILES_FOLDER", self.data_folder + "tiles/")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.layers = ["velov", "taxis"]
+        self.key = map_cache.selection_key(
+            map_cache.selection({"velov_used": True, "taxis_used": True})
+        )
+
+    def tile_of(self, lat, lon, z):
+        """(x, y) de la tuile de zoom z qui contient ce point"""
+        n = 2**z
+        x = int((lon + 180) / 360 * n)
+        y = int((1 - np.arcsinh(np.tan(np.radians(lat))) / np.pi) / 2 * n)
+        return x, y
+
+    def test_tile_latlng(self):
+        z = 14
+        x, y = self.tile_of(45.76, 4.84, z)
+        lats, lons = tiles.tile_latlng(z, x, y)
+        self.assertEqual(lats.shape, (tiles.TILE_SIZE, tiles.TILE_SIZE))
+        # centres des pixels à l'intérieur de la tuile, latitudes décroissantes vers le bas
+        self.assertTrue(
+            tiles.tile_lat(y + 1, z) < lats.min() < lats.max() < tiles.tile_lat(y, z)
+        )
+        self.assertTrue(
+            tiles.tile_lon(x, z) < lons.min() < lons.max() < tiles.tile_lon(x + 1, z)
+        )
+        self.assertTrue((np.diff(lats[:, 0]) < 0).all())
+        self.assertTrue((np.diff(lons[0]) > 0).all())
+        self.assertTrue(tiles.tile_intersects(z, x, y, (45.7, 4.8, 45.8, 4.9)))
+        self.assertFalse(tiles.tile_intersects(z, x, y, (48.8, 2.3, 48.9, 2.4)))
+
+    def test_render_tile(self):
+        from PIL import Image
+
+        z = 14
+        x, y = self.tile_of(45.76, 4.84, z)
+        heat = scores.heat_vector(self.layers)
+        png = tiles.render_tile(heat, z, x, y, RESOLUTION, 2 * heat.max())
+        pixels = np.asarray(Image.open(io.BytesIO(png)).convert("RGBA")).reshape(-1, 4)
+
+        lats, lons = tiles.tile_latlng(z, x, y)
+        positions = self.hex_map.index.get_indexer(
+            [
+                h3.latlng_to_cell(lat, lon, RESOLUTION)
+                for lat, lon in zip(lats.ravel(), lons.ravel())
+            ]
+        )
+        inside = positions >= 0
+        self.assertTrue(inside.any() and not inside.all())
+        # transparent hors de la grille, couleur plasma de la chaleur rapportée au maximum sinon
+        self.assertTrue((pixels[~inside] == 0).all())
+        levels = np.round(heat[positions[inside]] / (2 * heat.max()) * 255).astype(int)
+        np.testing.assert_array_equal(pixels[inside], tiles.plasma()[levels])
+
+    def test_tile_outside_grid_is_empty(self):
+        x, y = self.tile_of(48.85, 2.35, 14)
+        with mock.patch.object(tiles, "render_tile") as render_tile:
+            png = tiles.tile(self.layers, self.key, 14, x, y)
+        render_tile.assert_not_called()
+        self.assertEqual(png, tiles.empty_tile())
+        self.assertFalse(os.path.exists(tiles.TILES_FOLDER))
+
+    def test_tile_cache(self):
+        x, y = self.tile_of(45.76, 4.84, 14)
+        with mock.patch.object(tiles, "render_tile", wraps=tiles.render_tile) as render:
+            png = tiles.tile(self.layers, self.key, 14, x, y)
+            self.assertEqual(tiles.tile(self.layers, self.key, 14, x, y), png)
+        self.assertEqual(render.call_count, 1)
+        self.assertEqual(len(os.listdir(tiles.TILES_FOLDER)), 1)
+
+    def test_tile_cache_eviction(self):
+        x, y = self.tile_of(45.76, 4.84, 15)
+        with mock.patch.object(tiles, "TILE_EVICT_EVERY", 2), mock.patch.object(
+            tiles.map_cache, "evict"
+        ) as evict:
+            for dx in range(4):
+                tiles.tile(self.layers, self.key, 15, x + dx - 2, y)
+        # éviction une fois toutes les TILE_EVICT_EVERY tuiles rangées, dans le dossier des tuiles
+        self.assertEqual(
+            evict.call_args_list,
+            [mock.call(tiles.TILE_CACHE_MAX_BYTES, tiles.TILES_FOLDER, ".png")] * 2,
+        )
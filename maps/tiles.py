@@ -0,0 +1,169 @@
+# Tuiles raster XYZ (PNG 256×256) de la chaleur d'une sélection, avec l'échelle plasma de la carte.
+# Chaque pixel est converti en cellule H3 puis cherché dans la grille triée du magasin partagé ;
+# les tuiles sont gardées dans un cache disque borné, par sélection et version de la chaleur.
+import functools
+import io
+import os
+import tempfile
+import threading
+
+import h3
+import numpy as np
+
+from . import map_cache, scores, store
+from .layers import RESOLUTION, resolution_for_zoom
+
+TILES_FOLDER = map_cache.DATA_FOLDER + "tiles/"
+# taille maximale du cache de tuiles, les moins récemment servies sont supprimées au-delà
+TILE_CACHE_MAX_BYTES = 200 * 1024 * 1024
+# l'éviction parcourt tout le dossier : on ne la lance qu'une fois pour ce nombre de tuiles
+TILE_EVICT_EVERY = 200
+TILE_SIZE = 256
+# opacité des hexagones, comme le remplissage par défaut de explore()
+TILE_OPACITY = 0.5
+MAX_ZOOM = 20
+
+_stored = 0
+_stored_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=1)
+def plasma():
+    """Table de 256 couleurs RGBA (uint8) de l'échelle plasma"""
+    # import ici : matplotlib n'est chargé qu'au premier rendu de tuile
+    from matplotlib import colormaps
+
+    colors = colormaps["plasma"](np.linspace(0, 1, 256), bytes=True)
+    colors[:, 3] = round(255 * TILE_OPACITY)
+    return colors
+
+
+@functools.lru_cache(maxsize=4)
+def grid_bounds(resolution, version):
+    """(sud, ouest, nord, est) de la grille de cette version, à une cellule près"""
+    cells = store.open_grid(resolution)[0].tolist()
+    centers = np.array([h3.cell_to_latlng(h3.int_to_str(cell)) for cell in cells])
+    # marge : deux côtés d'hexagone, en degrés (~111 km par degré)
+    margin = 2 * h3.average_hexagon_edge_length(resolution, unit="km") / 111
+    return (
+        centers[:, 0].min() - margin,
+        centers[:, 1].min() - margin,
+        centers[:, 0].max() + margin,
+        centers[:, 1].max() + margin,
+    )
+
+
+def tile_lat(row, z):
+    """Latitude du bord haut de la ligne row (éventuellement fractionnaire) des tuiles de zoom z"""
+    return np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * row / 2**z))))
+
+
+def tile_lon(column, z):
+    """Longitude du bord gauche de la colonne column des tuiles de zoom z"""
+    return column / 2**z * 360 - 180
+
+
+def tile_latlng(z, x, y, size=TILE_SIZE):
+    """Latitudes et longitudes (tableaux size×size) des centres des pixels d'une tuile web mercator"""
+    steps = (np.arange(size) + 0.5) / size
+    lats, lons = tile_lat(y + steps, z), tile_lon(x + steps, z)
+    return np.repeat(lats, size).reshape(size, size), np.tile(lons, (size, 1))
+
+
+def tile_intersects(z, x, y, bounds):
+    """La tuile z/x/y recoupe-t-elle le rectangle bounds (sud, ouest, nord, est) ?"""
+    south, west, north, east = bounds
+    return not (
+        tile_lon(x, z) > east
+        or tile_lon(x + 1, z) < west
+        or tile_lat(y, z) < south
+        or tile_lat(y + 1, z) > north
+    )
+
+
+def render_tile(heat, z, x, y, resolution=RESOLUTION, max_heat=None):
+    """PNG d'une tuile : couleur plasma de la chaleur rapportée à max_heat (par défaut le
+    maximum de heat), transparent hors de la grille"""
+    from PIL import Image
+
+    lats, lons = tile_latlng(z, x, y)
+    cells = scores.points_to_cells(lats.ravel(), lons.ravel(), resolution)
+    grid_cells = store.open_grid(resolution)[0]
+    index = np.searchsorted(grid_cells, cells)
+    index[index == len(grid_cells)] = 0
+    found = grid_cells[index] == cells
+
+    if max_heat is None:
+        max_heat = heat.max() if len(heat) else 0
+    levels = np.zeros(len(cells), dtype=np.uint8)
+    if max_heat > 0:
+        levels[found] = np.round(heat[index[found]] / max_heat * 255)
+    pixels = plasma()[levels]
+    pixels[~found] = 0
+
+    buffer = io.BytesIO()
+    Image.fromarray(pixels.reshape(TILE_SIZE, TILE_SIZE, 4), "RGBA").save(
+        buffer, "PNG", optimize=True
+    )
+    return buffer.getvalue()
+
+
+@functools.lru_cache(maxsize=1)
+def empty_tile():
+    """PNG d'une tuile entièrement transparente"""
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new("RGBA", (TILE_SIZE, TILE_SIZE)).save(buffer, "PNG", optimize=True)
+    return buffer.getvalue()
+
+
+def store_tile(path, png):
+    """Range une tuile dans le cache, de façon atomique, puis applique la limite de taille de temps en temps"""
+    global _stored
+    os.makedirs(TILES_FOLDER, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=TILES_FOLDER)
+    with os.fdopen(fd, "wb") as file:
+        file.write(png)
+    os.replace(tmp_path, path)
+    with _stored_lock:
+        _stored += 1
+        evict = _stored % TILE_EVICT_EVERY == 0
+    if evict:
+        map_cache.evict(TILE_CACHE_MAX_BYTES, TILES_FOLDER, ".png")
+
+
+def tile(layers, key, z, x, y):
+    """PNG de la tuile z/x/y de la chaleur de ces couches (clé de sélection key), depuis le cache si possible
+
+    La résolution des hexagones dépend du zoom (resolution_for_zoom), l'échelle des couleurs
+    est la même à tous les zooms (scores.heat_scale), comme la légende de la carte.
+    """
+    resolution = resolution_for_zoom(z)
+    scores.prepare(layers, resolution)
+    version = scores.heat_version(layers, resolution)
+    if not tile_intersects(
+        z, x, y, grid_bounds(resolution, scores.grid_version(resolution))
+    ):
+        return empty_tile()
+
+    path = f"{TILES_FOLDER}{map_cache.file_key(key)}-{version}-{z}-{x}-{y}.png"
+    try:
+        with open(path, "rb") as file:
+            png = file.read()
+        # on date l'accès pour l'éviction LRU
+        os.utime(path)
+        return png
+    except FileNotFoundError:
+        pass
+
+    png = render_tile(
+        scores.heat_vector(layers, resolution=resolution),
+        z,
+        x,
+        y,
+        resolution,
+        scores.heat_scale(layers),
+    )
+    store_tile(path, png)
+    return png
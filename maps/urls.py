@@ -8,4 +8,20 @@ app_name = "maps"
 urlpatterns = [
     path("", views.IndexView.as_view(), name="index"),
     path("display_map", views.display_map, name="display_map"),
+    path("heat_score", views.heat_score, name="heat_score"),
+    path("map_job/<slug:job_id>", views.map_job, name="map_job"),
+    path("map/<slug:key>", views.cached_map, name="cached_map"),
+    path("client_map/<slug:key>", views.client_map, name="client_map"),
+    path("grid/cells", views.grid_cells, name="grid_cells"),
+    path("heat/<slug:key>", views.heat_vector, name="heat_vector"),
+    path(
+        "tiles/<slug:key>/<int:z>/<int:x>/<int:y>.png",
+        views.heat_tile,
+        name="heat_tile",
+    ),
+    path(
+        "points/<slug:layer>/<int:index>",
+        views.point_attributes,
+        name="point_attributes",
+    ),
 ] + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
@@ -1,6 +1,17 @@
-from django.shortcuts import render
-from .gen_maps import gen_maps, MAP_PATH
+import csv
+import io
+import json
+import os
+
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse
+from django.shortcuts import redirect, render
+from django.utils.cache import patch_vary_headers
+from django.views.decorators.cache import cache_control
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition
 from django.views.generic import TemplateView
+from . import jobs, map_cache
 from .forms import TransportationModesForm
 
 # Create your views here.
@@ -10,6 +21,20 @@ class IndexView(TemplateView):
     template_name = "maps/index.html"
 
 
+def map_response(request, path):
+    """Carte HTML du cache, dans sa variante précompressée si le client l'accepte"""
+    variant, encoding = map_cache.encoded_variant(
+        path, request.headers.get("Accept-Encoding", "")
+    )
+    response = FileResponse(
+        open(variant, "rb"), content_type="text/html", filename=os.path.basename(path)
+    )
+    if encoding:
+        response["Content-Encoding"] = encoding
+    patch_vary_headers(response, ["Accept-Encoding"])
+    return response
+
+
 def display_map(request):
     # if this is a POST request we need to process the form data
     if request.method == "POST":
@@ -18,32 +43,250 @@ def display_map(request):
         # check whether it's valid:
         if form.is_valid():
             # retrieve the values from the form
-            own_bike_used = form.cleaned_data["own_bike_used"]
-            velov_used = form.cleaned_data["velov_used"]
-            trains_used = form.cleaned_data["trains_used"]
-            cars_used = form.cleaned_data["cars_used"]
-            rhone_buses_used = form.cleaned_data["rhone_buses_used"]
-            public_transports_used = form.cleaned_data["public_transports_used"]
-            taxis_used = form.cleaned_data["taxis_used"]
-            river_boat_used = form.cleaned_data["river_boat_used"]
-            pmr_used = form.cleaned_data["pmr_used"]
-
-            m = gen_maps(
-                own_bike_used=own_bike_used,
-                velov_used=velov_used,
-                trains_used=trains_used,
-                cars_used=cars_used,
-                rhone_buses_used=rhone_buses_used,
-                public_transports_used=public_transports_used,
-                taxis_used=taxis_used,
-                river_boat_used=river_boat_used,
-                pmr_used=pmr_used,
+            selection = map_cache.selection(form.cleaned_data)
+
+            # rendu dans le navigateur : la page ne charge que les identifiants H3 et la chaleur
+            # (sans filtre de communes, qu'elle n'applique pas)
+            if (
+                getattr(settings, "MAPS_CLIENT_RENDERING", False)
+                and not selection["communes"]
+            ):
+                return redirect(
+                    "maps:client_map", key=map_cache.selection_key(selection)
+                )
+
+            # la carte de cette sélection a déjà été générée dans ce mode : on la sert directement
+            options = jobs.map_options(selection)
+            mode = map_cache.render_mode(options)
+            path = map_cache.cached_map(selection, mode)
+            if path is not None:
+                return map_response(request, path)
+
+            # sinon la génération est confiée au pool de tâches, le client suit son avancement
+            if getattr(settings, "MAPS_ASYNC_JOBS", True):
+                return redirect("maps:map_job", job_id=jobs.submit(selection))
+
+            # import ici : folium et geopandas ne sont chargés que pour générer une carte
+            from .gen_maps import gen_maps
+
+            path = map_cache.get_or_generate(
+                selection,
+                lambda map_path: gen_maps(**selection, map_path=map_path, **options),
+                mode,
             )
 
             # return render(request, "maps/display_map.html", context={'map': m._repr_html_()})
-            return render(request, "maps/full_map.html")
+            return map_response(request, path)
+
+        # formulaire invalide (commune inconnue) : réaffiché avec ses erreurs
+        return render(request, "maps/form_before_map.html", {"form": form})
 
     # if a GET (or any other method) we'll create a blank form
     else:
         context = {"form": TransportationModesForm()}
         return render(request, "maps/form_before_map.html", context)
+
+
+def points_from_csv(file):
+    """Latitudes et longitudes des colonnes lat et lon d'un fichier CSV envoyé"""
+    # lecture en une fois : bien plus rapide que ligne à ligne
+    reader = csv.reader(io.StringIO(file.read().decode("utf-8-sig")))
+    header = next(reader)
+    lat_column, lon_column = header.index("lat"), header.index("lon")
+    rows = [row for row in reader if row]
+    return [row[lat_column] for row in rows], [row[lon_column] for row in rows]
+
+
+def request_resolution(request):
+    """Résolution H3 demandée par ?resolution= ou ?zoom= (RESOLUTION par défaut), ValueError si invalide"""
+    # import ici : numpy n'est chargé qu'au premier appel
+    from .layers import RESOLUTION, RESOLUTIONS, resolution_for_zoom
+
+    if "resolution" in request.GET:
+        resolution = int(request.GET["resolution"])
+        if resolution not in RESOLUTIONS:
+            raise ValueError(f"résolution {resolution} non disponible")
+        return resolution
+    if "zoom" in request.GET:
+        return resolution_for_zoom(int(request.GET["zoom"]))
+    return RESOLUTION
+
+
+def resolution_or_404(request):
+    try:
+        return request_resolution(request)
+    except ValueError as error:
+        raise Http404(str(error))
+
+
+@csrf_exempt
+def heat_score(request):
+    """Cellule H3, commune et chaleur d'un ou plusieurs points, en JSON, sans générer de carte
+
+    - GET ?lat=45.76&lon=4.83&velov_used=on : un seul point ;
+    - POST JSON {"points": [[lat, lon], ...], "velov_used": true, ...} : un lot de points ;
+    - POST d'un fichier CSV "file" avec des colonnes lat et lon, les cases en champs du formulaire.
+    Les cases sont celles de TransportationModesForm. Un lot renvoie une liste par attribut.
+    ?resolution=7 ou ?zoom=11 choisit la résolution des cellules (RESOLUTION par défaut).
+    À une résolution grossière, heat est la somme de la chaleur des cellules filles de la
+    cellule ; la carte (heat_vector, tuiles) la divise par leur nombre, pour les couleurs
+    seulement.
+    """
+    try:
+        resolution = request_resolution(request)
+    except ValueError as error:
+        return JsonResponse({"error": f"résolution invalide : {error}"}, status=400)
+    try:
+        if request.method == "GET":
+            data = request.GET
+            lats, lons = [data["lat"]], [data["lon"]]
+        elif "file" in request.FILES:
+            data = request.POST
+            lats, lons = points_from_csv(request.FILES["file"])
+        else:
+            data = json.loads(request.body)
+            lats = [point[0] for point in data["points"]]
+            lons = [point[1] for point in data["points"]]
+        lats = [float(lat) for lat in lats]
+        lons = [float(lon) for lon in lons]
+    except (KeyError, IndexError, StopIteration, TypeError, ValueError) as error:
+        return JsonResponse({"error": f"points invalides : {error!r}"}, status=400)
+    if not all(-90 <= lat <= 90 for lat in lats) or not all(
+        -180 <= lon <= 180 for lon in lons
+    ):
+        return JsonResponse({"error": "coordonnées hors limites"}, status=400)
+
+    # import ici : numpy et h3 ne sont chargés qu'au premier score demandé
+    from . import scores
+    from .layers import selected_layers
+
+    form = TransportationModesForm(data)
+    form.is_valid()
+    layers = selected_layers(**map_cache.selection(form.cleaned_data))
+    result = scores.score(lats, lons, layers, resolution=resolution)
+    if request.method == "GET":
+        return JsonResponse(
+            {
+                "lat": lats[0],
+                "lon": lons[0],
+                "resolution": resolution,
+                "layers": layers,
+                **{name: values[0] for name, values in result.items()},
+            }
+        )
+    # lot : les listes sont dans l'ordre des points envoyés, qui ne sont pas renvoyés
+    return JsonResponse({"resolution": resolution, "layers": layers, **result})
+
+
+def map_job(request, job_id):
+    """Avancement d'une tâche de génération de carte, redirige vers la carte quand elle est prête"""
+    job = jobs.read_job(job_id)
+    if job is None:
+        raise Http404("Tâche inconnue")
+
+    if request.GET.get("format") == "json":
+        return JsonResponse(job)
+
+    if job["status"] == jobs.DONE:
+        return redirect("maps:cached_map", key=job["result"])
+
+    return render(request, "maps/map_job.html", context={"job": job})
+
+
+def cached_map(request, key):
+    path = map_cache.map_file(key)
+    if path is None:
+        raise Http404("Carte inconnue")
+    return map_response(request, path)
+
+
+def selection_layers(key):
+    """Couches de chaleur d'une clé de sélection, 404 si la clé est invalide"""
+    selection = map_cache.key_selection(key)
+    if selection is None:
+        raise Http404("Sélection inconnue")
+    # import ici : numpy n'est chargé qu'au premier appel
+    from .layers import selected_layers
+
+    return selected_layers(**selection)
+
+
+def client_map(request, key):
+    """Carte de chaleur dessinée dans le navigateur à partir des identifiants H3 (h3-js)"""
+    selection_layers(key)
+    from .layers import RESOLUTION_ZOOMS
+
+    return render(
+        request,
+        "maps/client_map.html",
+        context={"key": key, "resolution_zooms": RESOLUTION_ZOOMS},
+    )
+
+
+def grid_cells_etag(request):
+    from . import scores
+
+    resolution = resolution_or_404(request)
+    scores.prepare([], resolution)
+    return scores.grid_version(resolution)
+
+
+@cache_control(public=True, max_age=24 * 3600)
+@condition(etag_func=grid_cells_etag)
+def grid_cells(request):
+    """Identifiants H3 des cellules de la grille, communs à toutes les sélections
+
+    ?resolution= ou ?zoom= choisit la résolution de la grille.
+    """
+    from . import scores
+
+    return JsonResponse({"cells": scores.grid_cells(resolution_or_404(request))})
+
+
+def heat_vector_etag(request, key):
+    from . import scores
+
+    layers = selection_layers(key)
+    resolution = resolution_or_404(request)
+    scores.prepare(layers, resolution)
+    return scores.heat_version(layers, resolution)
+
+
+@cache_control(public=True, max_age=3600)
+@condition(etag_func=heat_vector_etag)
+def heat_vector(request, key):
+    """Chaleur d'une sélection, en float32 dans l'ordre de grid_cells : 4 octets par cellule
+
+    ?resolution= ou ?zoom= choisit la résolution, comme pour grid_cells. L'en-tête X-Heat-Max
+    donne le haut de l'échelle des couleurs, le même à toutes les résolutions.
+    """
+    from . import scores
+
+    layers = selection_layers(key)
+    heat = scores.heat_vector(layers, resolution=resolution_or_404(request))
+    response = HttpResponse(heat.tobytes(), content_type="application/octet-stream")
+    response["X-Heat-Max"] = str(scores.heat_scale(layers))
+    return response
+
+
+@cache_control(public=True, max_age=3600)
+def heat_tile(request, key, z, x, y):
+    """Tuile PNG z/x/y de la chaleur d'une sélection"""
+    # import ici : numpy et h3 ne sont chargés qu'à la première tuile
+    from . import tiles
+
+    if z > tiles.MAX_ZOOM or x >= 2**z or y >= 2**z:
+        raise Http404("Tuile inconnue")
+    png = tiles.tile(selection_layers(key), key, z, x, y)
+    return HttpResponse(png, content_type="image/png")
+
+
+def point_attributes(request, layer, index):
+    """Attributs d'un point d'une couche, pour la popup d'un marqueur regroupé"""
+    # import ici : numpy n'est chargé qu'à la première popup
+    from . import store
+
+    attributes = store.point_attributes(layer)
+    if attributes is None or index >= len(attributes):
+        raise Http404("Point inconnu")
+    return JsonResponse(attributes[index])